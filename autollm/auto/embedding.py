@@ -1,10 +1,18 @@
-from typing import Any
+from typing import Any, List, Optional
 
 from litellm import aembedding as lite_aembedding
 from litellm import embedding as lite_embedding
-from llama_index.bridge.pydantic import Field
+from llama_index.bridge.pydantic import Field, PrivateAttr
 from llama_index.embeddings.base import BaseEmbedding, Embedding
 
+from autollm.utils.deadlines import get_timeout_kwargs
+from autollm.utils.embedding_batcher import (
+    DEFAULT_MAX_BATCH_SIZE,
+    DEFAULT_MAX_WAIT_SECONDS,
+    EmbeddingMicroBatcher,
+)
+from autollm.utils.stub_backends import StubEmbedding, is_stub_model, parse_stub_model
+
 
 class AutoEmbedding(BaseEmbedding):
     """
@@ -12,10 +20,27 @@ class AutoEmbedding(BaseEmbedding):
 
     This class interfaces with the LiteLLM library to use its embedding functionality, making it compatible
     with a wide range of LLM models.
+
+    Concurrent async query embeddings are micro-batched: queries arriving within query_batch_wait_ms of each
+    other are embedded with a single call, up to query_batch_size queries per call.
+
+    Model names starting with "stub/" embed offline with a StubEmbedding for tests and benchmarks, with its
+    settings as query parameters, e.g. "stub/embedding?dimension=384&latency_ms=20".
     """
 
     # Define the model attribute using Pydantic's Field
     model: str = Field(default="text-embedding-ada-002", description="The name of the embedding model.")
+    query_batch_size: int = Field(
+        default=DEFAULT_MAX_BATCH_SIZE,
+        description="The maximum number of queries embedded in one call.",
+        gt=0)
+    query_batch_wait_ms: float = Field(
+        default=DEFAULT_MAX_WAIT_SECONDS * 1000,
+        description="The time a query waits for others to join its batch. 0 disables micro-batching.",
+        ge=0)
+
+    _query_batcher: EmbeddingMicroBatcher = PrivateAttr()
+    _stub_embedding: Optional[StubEmbedding] = PrivateAttr(default=None)
 
     def __init__(self, model: str, **kwargs: Any) -> None:
         """
@@ -27,6 +52,12 @@ class AutoEmbedding(BaseEmbedding):
         """
         super().__init__(**kwargs)
         self.model = model  # Set the model ID for embedding
+        if is_stub_model(model):
+            self._stub_embedding = StubEmbedding(**parse_stub_model(model))
+        self._query_batcher = EmbeddingMicroBatcher(
+            embed_batch=self._aembed_batch,
+            max_batch_size=self.query_batch_size,
+            max_wait_seconds=self.query_batch_wait_ms / 1000)
 
     def _get_query_embedding(self, query: str) -> Embedding:
         """
@@ -38,12 +69,11 @@ class AutoEmbedding(BaseEmbedding):
         Returns:
             Embedding: The embedding vector.
         """
-        response = lite_embedding(model=self.model, input=[query])
-        return self._parse_embedding_response(response)
+        return self._embed_batch([query])[0]
 
     async def _aget_query_embedding(self, query: str) -> Embedding:
         """
-        Asynchronously get the embedding for a query string.
+        Asynchronously get the embedding for a query string, batched with the concurrent queries.
 
         Args:
             query (str): The query text to embed.
@@ -51,8 +81,22 @@ class AutoEmbedding(BaseEmbedding):
         Returns:
             Embedding: The embedding vector.
         """
-        response = await lite_aembedding(model=self.model, input=[query])
-        return self._parse_embedding_response(response)
+        if self.query_batch_wait_ms > 0:
+            return await self._query_batcher.embed(query)
+
+        return (await self._aembed_batch([query]))[0]
+
+    def _embed_batch(self, texts: List[str]) -> List[Embedding]:
+        if self._stub_embedding is not None:
+            return self._stub_embedding._get_text_embeddings(texts)
+        response = lite_embedding(model=self.model, input=texts, **get_timeout_kwargs())
+        return self._parse_embedding_responses(response)
+
+    async def _aembed_batch(self, texts: List[str]) -> List[Embedding]:
+        if self._stub_embedding is not None:
+            return await self._stub_embedding._aget_text_embeddings(texts)
+        response = await lite_aembedding(model=self.model, input=texts, **get_timeout_kwargs())
+        return self._parse_embedding_responses(response)
 
     def _get_text_embedding(self, text: str) -> Embedding:
         """
@@ -76,23 +120,45 @@ class AutoEmbedding(BaseEmbedding):
         Returns:
             Embedding: The embedding vector.
         """
-        return await self._aget_query_embedding(text)
+        return (await self._aembed_batch([text]))[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        """
+        Synchronously get the embeddings for a batch of text strings with a single call.
+
+        Args:
+            texts (List[str]): The texts to embed.
+
+        Returns:
+            List[Embedding]: The embedding vectors in the order of the texts.
+        """
+        return self._embed_batch(texts)
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        """
+        Asynchronously get the embeddings for a batch of text strings with a single call.
+
+        Args:
+            texts (List[str]): The texts to embed.
+
+        Returns:
+            List[Embedding]: The embedding vectors in the order of the texts.
+        """
+        return await self._aembed_batch(texts)
 
-    def _parse_embedding_response(self, response):
+    def _parse_embedding_responses(self, response) -> List[Embedding]:
         """
-        Parse the embedding response from LiteLLM and extract the embedding data.
+        Parse a batched embedding response from LiteLLM and extract the embeddings in input order.
 
         Args:
             response: The response object from LiteLLM's embedding function.
 
         Returns:
-            List[float]: The extracted embedding list.
+            List[List[float]]: The extracted embedding lists.
         """
         try:
-            if 'data' in response and len(response['data']) > 0 and 'embedding' in response['data'][0]:
-                return response['data'][0]['embedding']
-            else:
-                raise ValueError("Invalid response structure from embedding function.")
-        except (TypeError, KeyError, IndexError) as e:
+            data = sorted(response['data'], key=lambda item: item.get('index', 0))
+            return [item['embedding'] for item in data]
+        except (TypeError, KeyError) as e:
             # Handle any parsing errors
             raise ValueError(f"Error parsing embedding response: {e}")
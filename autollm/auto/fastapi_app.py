@@ -1,24 +1,468 @@
-from typing import Optional, Sequence
+import asyncio
+import json
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import (
+    Any,
+    AsyncGenerator,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from llama_index import Document
 from llama_index.indices.query.base import BaseQueryEngine
 from pydantic import BaseModel, Field
 
+from autollm.callbacks.budget import BudgetExceededError, BudgetManager
+from autollm.callbacks.metrics import MetricsRegistry
+from autollm.callbacks.tracing import InMemorySpanExporter, RequestTrace, Tracer, create_tracer, trace_request
+from autollm.callbacks.usage import RequestUsage, track_request_usage
+from autollm.serve.admission import AdmissionController, AdmissionRejectedError, AdmissionTicket
+from autollm.serve.coalescing import QueryCoalescer, normalize_query
 from autollm.serve.docs import description, openapi_url, tags_metadata, terms_of_service, title, version
-from autollm.serve.utils import load_config_and_initialize_engines, stream_text_data
+from autollm.serve.ingestion import (
+    IngestionQueueFullError,
+    IngestionSourceError,
+    create_ingestion_manager,
+    read_ingestion_documents,
+)
+from autollm.serve.registry import TASK_FAILED, ReloadInProgressError, TaskRegistry, TaskRegistryReloader
+from autollm.serve.utils import (
+    NDJSON_MEDIA_TYPE,
+    SSE_HEADERS,
+    add_metrics_handler,
+    add_tracing_handler,
+    add_usage_handler,
+    astream_query,
+    estimate_task_query_usage,
+    format_batch_result,
+    format_sse_event,
+    get_task_name_to_params,
+    stream_sse_events,
+)
+from autollm.utils.deadlines import DeadlineExceededError, deadline_scope, get_deadline, get_remaining_seconds
+from autollm.utils.env_utils import load_config_and_dotenv
+from autollm.utils.logging import logger
+from autollm.utils.retriever_query_engine import DEFAULT_BATCH_CONCURRENCY
+
+DEFAULT_TASK_NAME = "default"
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+MAX_BATCH_QUERIES = 1000
+MAX_BATCH_CONCURRENCY = 32
+# The status code of the requests whose client disconnected before they were answered
+CLIENT_CLOSED_REQUEST = 499
+DEADLINE_EXCEEDED_DETAIL = "The deadline of the request passed"
 
 
 class FromConfigQueryPayload(BaseModel):
     task: str = Field(..., description="Task to execute")
     user_query: str = Field(..., description="User's query")
-    streaming: Optional[bool] = Field(False, description="Flag to enable streaming of response")
+    streaming: Optional[bool] = Field(
+        False, description="Flag to stream the response tokens as server-sent events")
+    timeout_seconds: Optional[float] = Field(
+        None,
+        gt=0,
+        description="Seconds until the request is cancelled, overrides the X-Request-Timeout header")
 
 
 class FromEngineQueryPayload(BaseModel):
     user_query: str = Field(..., description="User's query")
-    streaming: Optional[bool] = Field(False, description="Flag to enable streaming of response")
+    streaming: Optional[bool] = Field(
+        False, description="Flag to stream the response tokens as server-sent events")
+    timeout_seconds: Optional[float] = Field(
+        None,
+        gt=0,
+        description="Seconds until the request is cancelled, overrides the X-Request-Timeout header")
+
+
+class FromConfigBatchQueryPayload(BaseModel):
+    task: str = Field(..., description="Task to execute")
+    queries: List[str] = Field(..., description=f"User queries, at most {MAX_BATCH_QUERIES}")
+    max_concurrency: int = Field(
+        DEFAULT_BATCH_CONCURRENCY,
+        ge=1,
+        le=MAX_BATCH_CONCURRENCY,
+        description="Maximum number of queries answered by the LLM at a time")
+    timeout_seconds: Optional[float] = Field(
+        None,
+        gt=0,
+        description="Seconds until the request is cancelled, overrides the X-Request-Timeout header")
+
+
+class FromEngineBatchQueryPayload(BaseModel):
+    queries: List[str] = Field(..., description=f"User queries, at most {MAX_BATCH_QUERIES}")
+    max_concurrency: int = Field(
+        DEFAULT_BATCH_CONCURRENCY,
+        ge=1,
+        le=MAX_BATCH_CONCURRENCY,
+        description="Maximum number of queries answered by the LLM at a time")
+    timeout_seconds: Optional[float] = Field(
+        None,
+        gt=0,
+        description="Seconds until the request is cancelled, overrides the X-Request-Timeout header")
+
+
+class FromConfigRetrievePayload(BaseModel):
+    task: str = Field(..., description="Task whose index is searched")
+    query: str = Field(..., description="Search query")
+    top_k: Optional[int] = Field(
+        None, ge=1, description="Number of nodes to return, the task's top_k if not set")
+    filters: Optional[Dict[str, Any]] = Field(None, description="Metadata values the nodes must have")
+    fields: Optional[List[str]] = Field(
+        None, description="Returned node fields among id, score, text and metadata, all if not set")
+
+
+class IngestPayload(BaseModel):
+    task: str = Field(..., description="Task whose index gets the documents")
+    input_files: Optional[List[str]] = Field(None, description="Paths of files on the server to ingest")
+    input_dir: Optional[str] = Field(
+        None, description="Path of a directory on the server to ingest recursively")
+    urls: Optional[List[str]] = Field(None, description="URLs of web pages to ingest")
+
+
+class FromEngineRetrievePayload(BaseModel):
+    query: str = Field(..., description="Search query")
+    top_k: Optional[int] = Field(
+        None, ge=1, description="Number of nodes to return, the engine's top_k if not set")
+    filters: Optional[Dict[str, Any]] = Field(None, description="Metadata values the nodes must have")
+    fields: Optional[List[str]] = Field(
+        None, description="Returned node fields among id, score, text and metadata, all if not set")
+
+
+async def _run_retrieval(
+        query_engine: BaseQueryEngine,
+        query: str,
+        top_k: Optional[int] = None,
+        filters: Optional[Dict[str, Any]] = None,
+        fields: Optional[List[str]] = None) -> dict:
+    """Retrieve the nodes relevant to a query without calling the LLM, and build the HTTP response."""
+    asearch = getattr(query_engine, "asearch", None)
+    if asearch is None:
+        raise HTTPException(status_code=400, detail="The query engine does not support retrieval")
+    try:
+        nodes = await asearch(query, top_k=top_k, filters=filters, fields=fields)
+    except ValueError as e:
+        # The errors of the vector store may show its internals, e.g. the path of the table
+        logger.warning(f"Invalid retrieval request: {e}")
+        raise HTTPException(
+            status_code=400, detail="Invalid retrieval request, check its top_k, filters and fields")
+    return {"nodes": nodes}
+
+
+def _run_batch_query(
+        query_engine: BaseQueryEngine,
+        queries: List[str],
+        max_concurrency: int,
+        on_finish: Optional[Callable[[RequestUsage], None]] = None,
+        on_cancelled: Optional[Callable[[str], None]] = None,
+        trace: Optional[RequestTrace] = None) -> StreamingResponse:
+    """
+    Answer a batch of queries, streaming a line of newline-delimited JSON per query as its answer completes.
+
+    on_finish is called once with the total LLM usage of the batch, when the batch finished or was cancelled.
+    The batch is cancelled when the client disconnects or the deadline of the request passes.
+    """
+    abatch_query = getattr(query_engine, "abatch_query", None)
+    if abatch_query is None:
+        if on_finish is not None:
+            on_finish(RequestUsage())
+        raise HTTPException(status_code=400, detail="The query engine does not support batch queries")
+
+    usage = RequestUsage()
+    # The response is streamed after the endpoint returned, out of its deadline scope
+    deadline = get_deadline()
+
+    async def produce():
+        try:
+            with deadline_scope(deadline=deadline), track_request_usage(usage), trace_request(trace):
+                async for position, response in abatch_query(queries, max_concurrency=max_concurrency):
+                    yield format_batch_result(position, response)
+        finally:
+            if on_finish is not None:
+                on_finish(usage)
+
+    deadline_line = json.dumps({"error": DEADLINE_EXCEEDED_DETAIL}) + "\n"
+    events = _stream_until_deadline(produce(), deadline, deadline_line, on_cancelled)
+    return StreamingResponse(events, media_type=NDJSON_MEDIA_TYPE)
+
+
+def _get_timeout(timeout_seconds: Optional[float], timeout_header: Optional[str]) -> Optional[float]:
+    """Get the timeout of a request from its payload, or else from its X-Request-Timeout header."""
+    if timeout_seconds is not None or timeout_header is None:
+        return timeout_seconds
+    try:
+        timeout_seconds = float(timeout_header)
+    except ValueError:
+        timeout_seconds = 0.0
+    if not timeout_seconds > 0:
+        raise HTTPException(status_code=400, detail="X-Request-Timeout must be a positive number of seconds")
+    return timeout_seconds
+
+
+async def _wait_for_disconnect(request: Request) -> None:
+    # The body was already read, the next message arrives when the client disconnects
+    while (await request.receive())["type"] != "http.disconnect":
+        pass
+
+
+async def _run_cancellable(
+        request: Request,
+        awaitable: Awaitable[Any],
+        on_cancelled: Optional[Callable[[str], None]] = None) -> Any:
+    """
+    Run the work of a request until it completes, the client disconnects or the deadline of the request
+    passes.
+
+    The work is cancelled in the last two cases, on_cancelled is called with "disconnect" or "deadline" and
+    the request fails with 499 or 504.
+    """
+    work = asyncio.ensure_future(awaitable)
+    disconnect = asyncio.ensure_future(_wait_for_disconnect(request))
+    try:
+        done, _ = await asyncio.wait({work, disconnect},
+                                     timeout=get_remaining_seconds(),
+                                     return_when=asyncio.FIRST_COMPLETED)
+    except BaseException:
+        work.cancel()
+        raise
+    finally:
+        disconnect.cancel()
+
+    reason = "disconnect" if disconnect in done else "deadline"
+    if work in done:
+        try:
+            return work.result()
+        except DeadlineExceededError:
+            # A call was about to be made after the deadline
+            reason = "deadline"
+    else:
+        work.cancel()
+        # Let the work release its resources before failing the request
+        await asyncio.wait({work})
+
+    if on_cancelled is not None:
+        on_cancelled(reason)
+    if reason == "disconnect":
+        raise HTTPException(status_code=CLIENT_CLOSED_REQUEST, detail="The client closed the request")
+    raise HTTPException(status_code=504, detail=DEADLINE_EXCEEDED_DETAIL)
+
+
+async def _stream_until_deadline(
+        events: AsyncIterator[str],
+        deadline: Optional[float],
+        deadline_event: str,
+        on_cancelled: Optional[Callable[[str], None]] = None) -> AsyncGenerator[str, None]:
+    """
+    Stream the events of a response until the deadline, then send deadline_event and stop the stream. The
+    stream is also stopped, by the server, when the client disconnects. on_cancelled is called with "deadline"
+    or "disconnect" when the stream did not end by itself.
+    """
+    iterator = events.__aiter__()
+    while True:
+        timeout = None if deadline is None else max(deadline - time.monotonic(), 0.0)
+        try:
+            event = await asyncio.wait_for(iterator.__anext__(), timeout=timeout)
+        except StopAsyncIteration:
+            return
+        except asyncio.TimeoutError:
+            if on_cancelled is not None:
+                on_cancelled("deadline")
+            yield deadline_event
+            return
+        except asyncio.CancelledError:
+            if on_cancelled is not None:
+                on_cancelled("disconnect")
+            raise
+        yield event
+
+
+def _check_batch_size(queries: List[str]) -> None:
+    if not queries:
+        raise HTTPException(status_code=400, detail="queries cannot be empty")
+    if len(queries) > MAX_BATCH_QUERIES:
+        raise HTTPException(status_code=400, detail=f"A batch can have at most {MAX_BATCH_QUERIES} queries")
+
+
+def _create_admission_controller(
+        admission: Optional[dict], metrics_registry: Optional[MetricsRegistry]) -> AdmissionController:
+    """Create the admission controller of an app, reporting its queues in the metrics. None admits all."""
+
+    def update_metrics(task: str, running: int, queued: int) -> None:
+        if metrics_registry is not None:
+            metrics_registry.set_gauge("autollm_admission_running_requests", {"task": task}, running)
+            metrics_registry.set_gauge("autollm_admission_queue_depth", {"task": task}, queued)
+
+    if not admission:
+        return AdmissionController()
+    return AdmissionController.from_config(admission, on_change=update_metrics)
+
+
+async def _acquire_slot(
+        admission_controller: AdmissionController, task: str,
+        metrics_registry: Optional[MetricsRegistry]) -> AdmissionTicket:
+    """Wait for a slot of the task, reject the request with 429 or 503 and Retry-After if none is free."""
+    try:
+        return await admission_controller.acquire(task)
+    except AdmissionRejectedError as e:
+        if metrics_registry is not None:
+            metrics_registry.inc(
+                "autollm_admission_rejected_total", {
+                    "task": task,
+                    "status": str(e.status_code)
+                })
+        raise HTTPException(
+            status_code=e.status_code, detail=str(e), headers={"Retry-After": str(math.ceil(e.retry_after))})
+
+
+def _start_trace(tracer: Optional[Tracer], name: str, task: str) -> Optional[RequestTrace]:
+    return tracer.start_trace(name, {"task": task}) if tracer is not None else None
+
+
+def _end_trace_on_finish(
+        tracer: Optional[Tracer], trace: Optional[RequestTrace],
+        finish: Callable[[RequestUsage], None]) -> Callable[[RequestUsage], None]:
+    """Wrap the function finishing a request to export its trace, with its LLM usage, once it finished."""
+    if trace is None:
+        return finish
+
+    def finish_and_end_trace(usage: RequestUsage) -> None:
+        finish(usage)
+        trace.attributes.update(usage.to_dict())
+        tracer.end_trace(trace)
+
+    return finish_and_end_trace
+
+
+def _set_trace_headers(
+        result: Any, response: Optional[Response], tracer: Optional[Tracer],
+        trace: Optional[RequestTrace]) -> None:
+    """
+    Send the trace id of a request in the X-Trace-Id header, and the durations of its stages in the
+    Server-Timing header when enabled. Streamed responses only get the trace id, their headers are sent before
+    the answer.
+    """
+    if trace is None:
+        return
+    if isinstance(result, Response):
+        result.headers["X-Trace-Id"] = trace.trace_id
+        return
+    response.headers["X-Trace-Id"] = trace.trace_id
+    if tracer.server_timing:
+        response.headers["Server-Timing"] = trace.format_server_timing()
+
+
+def _add_traces_endpoint(app: FastAPI, tracer: Optional[Tracer]) -> None:
+    """Add the /traces endpoint returning the last traces kept in memory, the most recent first."""
+    if tracer is None or not isinstance(tracer.exporter, InMemorySpanExporter):
+        return
+
+    @app.get("/traces")
+    async def traces(limit: int = 20):
+        return [trace.to_dict() for trace in tracer.exporter.get_traces(limit)]
+
+
+async def _run_query(
+        query_engine: BaseQueryEngine,
+        user_query: str,
+        streaming: bool,
+        coalescer: QueryCoalescer,
+        key: Hashable,
+        on_finish: Optional[Callable[[RequestUsage], None]] = None,
+        on_coalesced: Optional[Callable[[], None]] = None,
+        on_cancelled: Optional[Callable[[str], None]] = None,
+        trace: Optional[RequestTrace] = None):
+    """
+    Run a query, or join the identical query in flight under the same key, and build its HTTP response.
+
+    on_finish is called once with the LLM usage of the request: the usage of the query for the request that
+    ran it, and zero usage for the requests that joined it, once they got the answer or their stream ended. A
+    streamed answer is stopped at the deadline of the request, with an "error" event, and on_cancelled is
+    called when it is stopped before its end.
+    """
+
+    finished = False
+
+    def finish(usage: RequestUsage) -> None:
+        nonlocal finished
+        if not finished:
+            finished = True
+            if on_finish is not None:
+                on_finish(usage)
+
+    joined = coalescer.is_inflight(key, streaming)
+    if joined and on_coalesced is not None:
+        on_coalesced()
+
+    usage = RequestUsage()
+    if streaming:
+        started = False
+
+        async def produce():
+            nonlocal started
+            started = True
+            try:
+                with track_request_usage(usage), trace_request(trace):
+                    response = await astream_query(query_engine, user_query)
+            except BaseException:
+                finish(usage)
+                raise
+            # The usage is final once the LLM finished streaming
+            async for event in stream_sse_events(response, usage, on_finish=lambda: finish(usage)):
+                yield event
+
+        try:
+            events = await coalescer.stream(key, produce)
+        except asyncio.CancelledError:
+            # A stream cancelled before it started never finishes the request, the cancellation runs first
+            asyncio.get_running_loop().call_soon(lambda: started or finish(usage))
+            raise
+        except BaseException:
+            if joined:
+                finish(RequestUsage())
+            raise
+        if joined:
+            events = _finish_after_stream(events, lambda: finish(RequestUsage()))
+        deadline_event = format_sse_event("error", {"detail": DEADLINE_EXCEEDED_DETAIL})
+        events = _stream_until_deadline(events, get_deadline(), deadline_event, on_cancelled)
+        return StreamingResponse(events, media_type="text/event-stream", headers=SSE_HEADERS)
+
+    async def aquery():
+        with track_request_usage(usage), trace_request(trace):
+            return await query_engine.aquery(user_query)
+
+    def execute() -> asyncio.Future:
+        # Finish when the query is done, also when it is cancelled before it started
+        task = asyncio.ensure_future(aquery())
+        task.add_done_callback(lambda task: finish(usage))
+        return task
+
+    try:
+        response = await coalescer.run(key, execute)
+    finally:
+        if joined:
+            finish(RequestUsage())
+    return response.response
+
+
+async def _finish_after_stream(events: AsyncIterator[str],
+                               on_finish: Callable[[], None]) -> AsyncGenerator[str, None]:
+    """Stream the events, then call on_finish once the stream ended, failed or was closed."""
+    try:
+        async for event in events:
+            yield event
+    finally:
+        on_finish()
 
 
 class AutoFastAPI:
@@ -33,10 +477,23 @@ class AutoFastAPI:
             api_title: str = None,
             api_description: str = None,
             api_version: str = None,
-            api_term_of_service: str = None) -> FastAPI:
+            api_term_of_service: str = None,
+            enable_metrics: bool = True,
+            budgets: Optional[dict] = None,
+            lazy_init: bool = False,
+            prewarm_tasks: Optional[Sequence[str]] = None,
+            max_loaded_engines: Optional[int] = None,
+            enable_coalescing: bool = True,
+            admission: Optional[dict] = None,
+            enable_reload: bool = False,
+            ingestion: Union[None, bool, dict] = None,
+            read_only: bool = False,
+            tracing: Union[None, bool, dict] = None) -> FastAPI:
         """
-        Create an FastAPI instance from config.yaml and optionally a .env file. The app has a single endpoint
-        /query that takes a QueryPayload and returns a QueryResponse.
+        Create an FastAPI instance from config.yaml and optionally a .env file. The app has a /query endpoint
+        that takes a QueryPayload and returns a QueryResponse, and /query/batch, /retrieve, /health, /metrics,
+        /ingest, /admin/reload and /traces endpoints depending on the settings below. See the "serving"
+        section of the README for the endpoints and the config.yaml sections.
 
         ```python
         from autollm.auto.fastapi_app import QueryPayload, AutoFastAPI
@@ -65,6 +522,26 @@ class AutoFastAPI:
             api_description (str): Description of the API.
             api_version (str): Version of the API.
             api_term_of_service (str): Term of service of the API.
+            enable_metrics (bool): Flag to enable the /metrics endpoint.
+            budgets (dict): Budget configuration, overrides the "budgets" section of config.yaml.
+            lazy_init (bool): Flag to build the query engines of the tasks on their first request.
+            prewarm_tasks (Sequence[str]): Tasks whose query engines are built in the background at startup
+                when lazy_init is set.
+            max_loaded_engines (int): The maximum number of query engines built from config.yaml kept in
+                memory.
+            enable_coalescing (bool): Flag to answer concurrent identical queries with a single query engine
+                call.
+            admission (dict): Admission control configuration, overrides the "admission" section of
+                config.yaml.
+            enable_reload (bool): Flag to enable the /admin/reload endpoint, requires config_file_path.
+            ingestion (Union[None, bool, dict]): True or a dict with the batch_size, max_pending_jobs,
+                allowed_root and allowed_urls of the ingestion jobs enables the /ingest endpoints, overrides
+                the "ingestion" section of config.yaml.
+            read_only (bool): Flag to serve the LanceDB indexes built by a builder process read-only, building
+                the query engines after the worker processes are forked. Requires config_file_path.
+            tracing (Union[None, bool, dict]): True or a dict with the "exporter" ("memory", "jsonl" or
+                "otlp"), its parameters and "server_timing" enables tracing, overrides the "tracing" section
+                of config.yaml.
 
         Returns:
             FastAPI: The initialized FastAPI instance.
@@ -79,6 +556,21 @@ class AutoFastAPI:
         if task_name_to_query_engine is not None and not isinstance(task_name_to_query_engine, dict):
             raise ValueError("task_name_to_query_engine must be a dictionary")
 
+        if enable_reload and config_file_path is None:
+            raise ValueError("enable_reload requires config_file_path")
+
+        if read_only and (config_file_path is None or documents is not None):
+            raise ValueError(
+                "read_only requires config_file_path and no documents, the indexes are built by "
+                "`python -m autollm.serve.build`")
+
+        @asynccontextmanager
+        async def lifespan(app: FastAPI):
+            # Read-only workers build their engines here, after the server forked them
+            if lazy_init and (prewarm_tasks or read_only):
+                reloader.registry.prewarm(prewarm_tasks)
+            yield
+
         app = FastAPI(
             title=title if api_title is None else api_title,
             description=description if api_description is None else api_description,
@@ -86,29 +578,296 @@ class AutoFastAPI:
             openapi_url=openapi_url,
             terms_of_service=terms_of_service if api_term_of_service is None else api_term_of_service,
             openapi_tags=tags_metadata,
+            lifespan=lifespan,
         )
 
+        task_name_to_params = {}
         if config_file_path is not None:
-            task_name_to_query_engine = load_config_and_initialize_engines(
-                config_file_path, env_file_path, documents)
+            config = load_config_and_dotenv(config_file_path, env_file_path)
+            task_name_to_params = get_task_name_to_params(config, read_only=read_only)
+            if budgets is None:
+                budgets = config.get('budgets')
+            if admission is None:
+                admission = config.get('admission')
+            if ingestion is None and not read_only:
+                ingestion = config.get('ingestion')
+            if tracing is None:
+                tracing = config.get('tracing')
+
+        if read_only:
+            if ingestion:
+                raise ValueError("read_only workers do not run ingestion jobs, the builder process does")
+            lazy_init = True
+
+        budget_manager = BudgetManager.from_config(budgets) if budgets else None
+        metrics_registry = MetricsRegistry() if enable_metrics else None
+        tracer = create_tracer(tracing)
+        admission_controller = _create_admission_controller(admission, metrics_registry)
+        coalescer = QueryCoalescer()
+
+        def count_ingested(task: str, num_documents: int) -> None:
+            if metrics_registry is not None:
+                metrics_registry.inc("autollm_ingested_documents_total", {"task": task}, num_documents)
+
+        ingestion_manager = create_ingestion_manager(ingestion, on_batch=count_ingested)
+
+        def add_handlers(task_name: str, task_query_engine: BaseQueryEngine) -> None:
+            add_usage_handler(task_query_engine)
+            if metrics_registry is not None:
+                add_metrics_handler(task_query_engine, task_name, metrics_registry)
+            if tracer is not None:
+                add_tracing_handler(task_query_engine)
+
+        task_registry = TaskRegistry(
+            task_name_to_params=task_name_to_params,
+            documents=documents,
+            query_engines=task_name_to_query_engine,
+            max_loaded_engines=max_loaded_engines,
+            on_engine_built=add_handlers)
+        reloader = TaskRegistryReloader(
+            task_registry,
+            load_task_params=lambda: get_task_name_to_params(
+                load_config_and_dotenv(config_file_path, env_file_path), read_only=read_only))
+        for task_name, task_query_engine in (task_name_to_query_engine or {}).items():
+            add_handlers(task_name, task_query_engine)
+        if not lazy_init:
+            for task_name in task_registry.task_names:
+                task_registry.get(task_name)
+
+        if enable_metrics:
+
+            @app.get("/metrics", response_class=PlainTextResponse)
+            async def metrics():
+                return PlainTextResponse(
+                    metrics_registry.render_prometheus(), media_type=PROMETHEUS_CONTENT_TYPE)
+
+        _add_traces_endpoint(app, tracer)
+
+        @app.get("/health")
+        async def health():
+            tasks = reloader.registry.get_status()
+            status = "degraded" if any(task["status"] == TASK_FAILED for task in tasks.values()) else "ok"
+            return {"status": status, "tasks": tasks}
+
+        async def admit(task: str, user_queries: List[str],
+                        api_key: Optional[str]) -> Callable[[RequestUsage], None]:
+            """
+            Wait for a slot of the task and reserve the estimated usage of the queries before doing any work,
+            reject the request right away if they are not available. Returns the function finishing the
+            request with its actual usage.
+            """
+            ticket = await _acquire_slot(admission_controller, task, metrics_registry)
+            reservation = None
+            if budget_manager is not None:
+                estimates = [
+                    estimate_task_query_usage(user_query, reloader.registry.task_name_to_params.get(task))
+                    for user_query in user_queries
+                ]
+                tokens = sum(tokens for tokens, _ in estimates)
+                cost_usd = sum(cost_usd for _, cost_usd in estimates)
+                try:
+                    reservation = budget_manager.reserve(task, api_key, tokens, cost_usd)
+                except BudgetExceededError as e:
+                    ticket.release()
+                    raise HTTPException(
+                        status_code=429,
+                        detail=str(e),
+                        headers={"Retry-After": str(math.ceil(e.retry_after))})
+
+            finished = False
+
+            def finish(usage: RequestUsage) -> None:
+                nonlocal finished
+                if finished:
+                    return
+                finished = True
+                ticket.release()
+                if reservation is not None:
+                    budget_manager.settle(reservation, usage.total_tokens, usage.cost_usd)
+
+            return finish
+
+        async def get_query_engine(
+                task: str, finish: Callable[[RequestUsage], None]) -> Tuple[BaseQueryEngine, Callable]:
+            """
+            Get the query engine of the task from the current registry, built on its first request, and the
+            function finishing the request. A reload does not close the registry before the request finished.
+            """
+            registry, release = reloader.lease()
+
+            def finish_request(usage: RequestUsage) -> None:
+                release()
+                finish(usage)
+
+            try:
+                return await registry.aget(task), finish_request
+            except Exception as e:
+                finish_request(RequestUsage())
+                raise HTTPException(
+                    status_code=503, detail=f"Query engine of task '{task}' is unavailable: {e}")
+            except BaseException:
+                # Cancelled while the engine is built, by the deadline or a disconnect of the client
+                finish_request(RequestUsage())
+                raise
+
+        def get_cancelled_counter(task: str) -> Callable[[str], None]:
+
+            def count_cancelled(reason: str) -> None:
+                if metrics_registry is not None:
+                    metrics_registry.inc("autollm_cancelled_requests_total", {"task": task, "reason": reason})
+
+            return count_cancelled
 
         @app.post("/query")
-        async def query(payload: FromConfigQueryPayload):
+        async def query(request: Request, response: Response, payload: FromConfigQueryPayload):
             task = payload.task
             user_query = payload.user_query
 
-            if task not in task_name_to_query_engine:
+            if task not in reloader.registry:
                 raise HTTPException(status_code=400, detail="Invalid task name")
+            x_api_key = request.headers.get("X-API-Key")
+            timeout_seconds = _get_timeout(payload.timeout_seconds, request.headers.get("X-Request-Timeout"))
 
-            # Use the appropriate query engine for the task
-            query_engine: BaseQueryEngine = task_name_to_query_engine[task]
-            response = query_engine.query(user_query)
+            def count_coalesced() -> None:
+                if metrics_registry is not None:
+                    metrics_registry.inc("autollm_coalesced_requests_total", {"task": task})
 
-            # Check if the response should be streamed
-            if payload.streaming:
-                return StreamingResponse(stream_text_data(response.response))
+            async def answer():
+                trace = _start_trace(tracer, "query", task)
+                admission_start = time.time()
+                finish = await admit(task, [user_query], x_api_key)
+                if trace is not None:
+                    trace.add_stage("admission", admission_start)
+                # Read with the lease of get_query_engine, before its first suspension, so that requests to
+                # the engines of different reloads never share an execution
+                generation = reloader.generation
+                query_engine, finish = await get_query_engine(task, finish)
+                key = (generation, task, normalize_query(user_query)) if enable_coalescing else object()
+                # The request is finished once the query finished, or the LLM finished streaming
+                result = await _run_query(
+                    query_engine,
+                    user_query,
+                    streaming=payload.streaming,
+                    coalescer=coalescer,
+                    key=key,
+                    on_finish=_end_trace_on_finish(tracer, trace, finish),
+                    on_coalesced=count_coalesced,
+                    on_cancelled=get_cancelled_counter(task),
+                    trace=trace)
+                _set_trace_headers(result, response, tracer, trace)
+                return result
 
-            return response.response
+            with deadline_scope(timeout_seconds):
+                return await _run_cancellable(request, answer(), on_cancelled=get_cancelled_counter(task))
+
+        @app.post("/query/batch")
+        async def batch_query(request: Request, payload: FromConfigBatchQueryPayload):
+            task = payload.task
+            if task not in reloader.registry:
+                raise HTTPException(status_code=400, detail="Invalid task name")
+            _check_batch_size(payload.queries)
+            x_api_key = request.headers.get("X-API-Key")
+            timeout_seconds = _get_timeout(payload.timeout_seconds, request.headers.get("X-Request-Timeout"))
+
+            async def answer():
+                trace = _start_trace(tracer, "query_batch", task)
+                admission_start = time.time()
+                # The whole batch takes one slot and is reserved at once, it is rejected or runs to the end
+                finish = await admit(task, payload.queries, x_api_key)
+                if trace is not None:
+                    trace.add_stage("admission", admission_start)
+                query_engine, finish = await get_query_engine(task, finish)
+                result = _run_batch_query(
+                    query_engine,
+                    payload.queries,
+                    payload.max_concurrency,
+                    on_finish=_end_trace_on_finish(tracer, trace, finish),
+                    on_cancelled=get_cancelled_counter(task),
+                    trace=trace)
+                _set_trace_headers(result, None, tracer, trace)
+                return result
+
+            with deadline_scope(timeout_seconds):
+                return await _run_cancellable(request, answer(), on_cancelled=get_cancelled_counter(task))
+
+        @app.post("/retrieve")
+        async def retrieve(payload: FromConfigRetrievePayload):
+            if payload.task not in reloader.registry:
+                raise HTTPException(status_code=400, detail="Invalid task name")
+
+            try:
+                query_engine: BaseQueryEngine = await reloader.registry.aget(payload.task)
+            except Exception as e:
+                raise HTTPException(
+                    status_code=503, detail=f"Query engine of task '{payload.task}' is unavailable: {e}")
+
+            return await _run_retrieval(
+                query_engine,
+                payload.query,
+                top_k=payload.top_k,
+                filters=payload.filters,
+                fields=payload.fields)
+
+        if ingestion_manager is not None:
+
+            @app.post("/ingest", status_code=202)
+            async def ingest(payload: IngestPayload):
+                task = payload.task
+                if task not in reloader.registry:
+                    raise HTTPException(status_code=400, detail="Invalid task name")
+                if not (payload.input_files or payload.input_dir or payload.urls):
+                    raise HTTPException(
+                        status_code=400, detail="At least one of input_files, input_dir or urls is required")
+
+                def get_index():
+                    # The index of the task in the registry serving when the job starts
+                    vector_store_index = getattr(reloader.registry.get(task), "vector_store_index", None)
+                    if vector_store_index is None:
+                        raise ValueError(f"The query engine of task '{task}' has no index to ingest into")
+                    return vector_store_index
+
+                try:
+                    input_files = [ingestion_manager.resolve_path(path) for path in payload.input_files or []]
+                    input_dir = ingestion_manager.resolve_path(
+                        payload.input_dir) if payload.input_dir else None
+                    urls = [ingestion_manager.check_url(url) for url in payload.urls or []]
+                except IngestionSourceError as e:
+                    raise HTTPException(status_code=403, detail=str(e))
+
+                try:
+                    # Redirects are not followed, they could lead outside of the allowed URLs
+                    job = ingestion_manager.submit(
+                        task,
+                        get_index=get_index,
+                        read_documents=lambda: read_ingestion_documents(
+                            input_files=input_files, input_dir=input_dir, urls=urls, allow_redirects=False))
+                except IngestionQueueFullError as e:
+                    raise HTTPException(status_code=429, detail=str(e))
+                return job.get_status()
+
+            @app.get("/ingest")
+            async def list_ingestion_jobs():
+                return [job.get_status() for job in ingestion_manager.list_jobs()]
+
+            @app.get("/ingest/{job_id}")
+            async def get_ingestion_job(job_id: str):
+                job = ingestion_manager.get(job_id)
+                if job is None:
+                    raise HTTPException(status_code=404, detail="Unknown ingestion job")
+                return job.get_status()
+
+        if enable_reload:
+
+            @app.post("/admin/reload")
+            async def reload():
+                try:
+                    changes = await reloader.reload()
+                except ReloadInProgressError as e:
+                    raise HTTPException(status_code=409, detail=str(e))
+                except Exception as e:
+                    raise HTTPException(
+                        status_code=500, detail=f"Reload failed, the current tasks keep serving: {e}")
+                return {"generation": reloader.generation, "tasks": changes}
 
         return app
 
@@ -118,9 +877,20 @@ class AutoFastAPI:
             api_title: str = None,
             api_description: str = None,
             api_version: str = None,
-            api_term_of_service: str = None) -> FastAPI:
+            api_term_of_service: str = None,
+            enable_metrics: bool = True,
+            enable_coalescing: bool = True,
+            admission: Optional[dict] = None,
+            tracing: Union[None, bool, dict] = None) -> FastAPI:
         """
-        Create an FastAPI instance from a llama-index query engine.
+        Create an FastAPI instance from a llama-index query engine. Metrics of the query engine are exposed
+        under the "default" task at /metrics. The /query/batch endpoint answers a list of queries, streaming a
+        line of newline-delimited JSON per query, and the /retrieve endpoint returns the nodes relevant to a
+        query without calling the LLM.
+
+        The /query and /query/batch requests are cancelled when their client disconnects or their deadline,
+        set with "timeout_seconds" or the X-Request-Timeout header, passes. With tracing, the stages of each
+        request are recorded as spans and exported, see the "serving" section of the README.
 
         ```python
         from autollm.auto.fastapi_app import QueryPayload, AutoFastAPI
@@ -146,6 +916,13 @@ class AutoFastAPI:
             api_description (str): Description of the API.
             api_version (str): Version of the API.
             api_term_of_service (str): Term of service of the API.
+            enable_metrics (bool): Flag to enable the /metrics endpoint.
+            enable_coalescing (bool): Flag to answer concurrent identical queries with a single query engine
+                call.
+            admission (dict): Admission control configuration ("max_concurrency", "max_queue_size" and
+                "max_queue_seconds") of the /query and /query/batch requests. None does not limit them.
+            tracing (Union[None, bool, dict]): True or a dict with the "exporter" ("memory", "jsonl" or
+                "otlp"), its parameters and "server_timing" enables tracing.
 
         Returns:
             FastAPI: The initialized FastAPI instance.
@@ -163,16 +940,95 @@ class AutoFastAPI:
             openapi_tags=tags_metadata,
         )
 
+        add_usage_handler(query_engine)
+        coalescer = QueryCoalescer()
+        metrics_registry = MetricsRegistry() if enable_metrics else None
+        tracer = create_tracer(tracing)
+        if tracer is not None:
+            add_tracing_handler(query_engine)
+        admission_controller = _create_admission_controller(admission, metrics_registry)
+
+        def count_coalesced() -> None:
+            if metrics_registry is not None:
+                metrics_registry.inc("autollm_coalesced_requests_total", {"task": DEFAULT_TASK_NAME})
+
+        if enable_metrics:
+            add_metrics_handler(query_engine, DEFAULT_TASK_NAME, metrics_registry)
+
+            @app.get("/metrics", response_class=PlainTextResponse)
+            async def metrics():
+                return PlainTextResponse(
+                    metrics_registry.render_prometheus(), media_type=PROMETHEUS_CONTENT_TYPE)
+
+        _add_traces_endpoint(app, tracer)
+
+        def count_cancelled(reason: str) -> None:
+            if metrics_registry is not None:
+                metrics_registry.inc(
+                    "autollm_cancelled_requests_total", {
+                        "task": DEFAULT_TASK_NAME,
+                        "reason": reason
+                    })
+
         @app.post("/query")
-        async def query(payload: FromEngineQueryPayload):
+        async def query(request: Request, response: Response, payload: FromEngineQueryPayload):
             user_query = payload.user_query
+            timeout_seconds = _get_timeout(payload.timeout_seconds, request.headers.get("X-Request-Timeout"))
+
+            async def answer():
+                trace = _start_trace(tracer, "query", DEFAULT_TASK_NAME)
+                admission_start = time.time()
+                ticket = await _acquire_slot(admission_controller, DEFAULT_TASK_NAME, metrics_registry)
+                if trace is not None:
+                    trace.add_stage("admission", admission_start)
+                key = normalize_query(user_query) if enable_coalescing else object()
+                result = await _run_query(
+                    query_engine,
+                    user_query,
+                    streaming=payload.streaming,
+                    coalescer=coalescer,
+                    key=key,
+                    on_finish=_end_trace_on_finish(tracer, trace, lambda usage: ticket.release()),
+                    on_coalesced=count_coalesced,
+                    on_cancelled=count_cancelled,
+                    trace=trace)
+                _set_trace_headers(result, response, tracer, trace)
+                return result
+
+            with deadline_scope(timeout_seconds):
+                return await _run_cancellable(request, answer(), on_cancelled=count_cancelled)
+
+        @app.post("/query/batch")
+        async def batch_query(request: Request, payload: FromEngineBatchQueryPayload):
+            _check_batch_size(payload.queries)
+            timeout_seconds = _get_timeout(payload.timeout_seconds, request.headers.get("X-Request-Timeout"))
 
-            response = query_engine.query(user_query)
+            async def answer():
+                trace = _start_trace(tracer, "query_batch", DEFAULT_TASK_NAME)
+                admission_start = time.time()
+                ticket = await _acquire_slot(admission_controller, DEFAULT_TASK_NAME, metrics_registry)
+                if trace is not None:
+                    trace.add_stage("admission", admission_start)
+                result = _run_batch_query(
+                    query_engine,
+                    payload.queries,
+                    payload.max_concurrency,
+                    on_finish=_end_trace_on_finish(tracer, trace, lambda usage: ticket.release()),
+                    on_cancelled=count_cancelled,
+                    trace=trace)
+                _set_trace_headers(result, None, tracer, trace)
+                return result
 
-            # Check if the response should be streamed
-            if payload.streaming:
-                return StreamingResponse(stream_text_data(response.response))
+            with deadline_scope(timeout_seconds):
+                return await _run_cancellable(request, answer(), on_cancelled=count_cancelled)
 
-            return response.response
+        @app.post("/retrieve")
+        async def retrieve(payload: FromEngineRetrievePayload):
+            return await _run_retrieval(
+                query_engine,
+                payload.query,
+                top_k=payload.top_k,
+                filters=payload.filters,
+                fields=payload.fields)
 
         return app
@@ -1,8 +1,12 @@
-from typing import Optional
+from typing import Optional, Sequence, Union
 
-from llama_index.llms import LiteLLM
 from llama_index.llms.base import BaseLLM
 
+from autollm.utils.deadlines import DeadlineLiteLLM
+from autollm.utils.llm_cache import BaseLLMCache, CachedLiteLLM, create_llm_cache
+from autollm.utils.llm_router import DEFAULT_COOLDOWN_SECONDS, RouterLLM
+from autollm.utils.stub_backends import StubLLM, is_stub_model, parse_stub_model
+
 
 class AutoLiteLLM:
     """AutoLiteLLM lets you dynamically initialize any LLM based on the llm class name and additional
@@ -15,29 +19,118 @@ class AutoLiteLLM:
             max_tokens: Optional[int] = 256,
             temperature: float = 0.1,
             system_prompt: Optional[str] = None,
-            api_base: Optional[str] = None) -> BaseLLM:
+            api_base: Optional[str] = None,
+            cache: Union[None, str, dict, BaseLLMCache] = None,
+            max_retries: int = 10) -> BaseLLM:
         """
         Create any LLM by model name. Check https://docs.litellm.ai/docs/providers for a list of
         supported models.
 
+        Model names starting with "stub/" create an offline StubLLM for tests and benchmarks, with its
+        settings as query parameters, e.g. "stub/llm?latency_ms=300&tokens_per_second=50&streaming=false". The
+        stub is not cached.
+
         If an argument is specified, then use the argument value provided for that
         parameter. If an argument is not specified, then use the default value.
 
         Parameters:
             model: Name of the LLM model to be initialized. Check
-        https://docs.litellm.ai/docs/providers for a list of supported models.
+            https://docs.litellm.ai/docs/providers for a list of supported models.
             max_tokens: The maximum number of tokens to generate by the LLM.
             temperature: The temperature to use when sampling from the distribution.
             system_prompt: The system prompt to use for the LLM.
             api_base: The API base URL to use for the LLM.
+            cache: Exact-match response cache: "memory", "sqlite", a dict with a "type" key and the cache
+            parameters (path, max_size, ttl_seconds) or a BaseLLMCache instance. None disables caching.
+            max_retries: The maximum number of retries of a failed LLM call.
 
         Returns:
             LLM: The initialized LiteLLM instance for given model name and parameter set.
         """
+        if is_stub_model(model):
+            stub_params = parse_stub_model(model)
+            if max_tokens is not None:
+                stub_params.setdefault("max_tokens", max_tokens)
+            return StubLLM(system_prompt=system_prompt, **stub_params)
+
+        if cache is not None:
+            return CachedLiteLLM(
+                cache=create_llm_cache(cache),
+                model=model,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                system_prompt=system_prompt,
+                api_base=api_base,
+                max_retries=max_retries)
 
-        return LiteLLM(
+        return DeadlineLiteLLM(
             model=model,
             max_tokens=max_tokens,
             temperature=temperature,
             system_prompt=system_prompt,
-            api_base=api_base)
+            api_base=api_base,
+            max_retries=max_retries)
+
+    @staticmethod
+    def from_router(
+            models: Sequence[Union[str, dict]],
+            max_tokens: Optional[int] = 256,
+            temperature: float = 0.1,
+            system_prompt: Optional[str] = None,
+            routing: str = "latency",
+            timeout: Optional[float] = None,
+            hedge_percentile: Optional[float] = None,
+            cooldown_seconds: float = DEFAULT_COOLDOWN_SECONDS,
+            max_retries: int = 0,
+            cache: Union[None, str, dict, BaseLLMCache] = None) -> BaseLLM:
+        """
+        Create an LLM routing each call to the fastest healthy of several models or API bases, failing over to
+        the next one on timeouts, rate limits and server errors.
+
+        ```python
+        llm = AutoLiteLLM.from_router(
+            models=[
+                "gpt-3.5-turbo",
+                {"model": "azure/gpt-35-turbo", "api_base": "https://my-azure.openai.azure.com"},
+            ],
+            timeout=20,
+            hedge_percentile=95)
+        ```
+
+        Parameters:
+            models: The models to route to, in order of preference. Each is a model name or a dict with the
+                "model" key and optionally "api_base", "max_tokens", "temperature" and "weight".
+            max_tokens: The maximum number of tokens to generate by the LLM.
+            temperature: The temperature to use when sampling from the distribution.
+            system_prompt: The system prompt to use for the LLM.
+            routing: "latency" to prefer the fastest healthy model, "ordered" to keep the order of the models,
+                or "weighted" to pick models at random by weight.
+            timeout: The maximum time in seconds of a call to a model, before failing over to the next one.
+            hedge_percentile: The latency percentile of a model after which a slow call is also sent to the
+                next model, e.g. 95. None disables hedging.
+            cooldown_seconds: The time a model is skipped after a timeout, rate limit or server error.
+            max_retries: The maximum number of retries of a failed call on the same model, before failing
+                over.
+            cache: Exact-match response cache shared by the models. None disables caching.
+
+        Returns:
+            LLM: The initialized RouterLLM instance.
+        """
+        llm_cache = create_llm_cache(cache)
+        backends, weights = [], []
+        for model in models:
+            backend_params = {"model": model} if isinstance(model, str) else dict(model)
+            weights.append(backend_params.pop("weight", 1.0))
+            backend_params.setdefault("max_tokens", max_tokens)
+            backend_params.setdefault("temperature", temperature)
+            backends.append(
+                AutoLiteLLM.from_defaults(
+                    system_prompt=system_prompt, cache=llm_cache, max_retries=max_retries, **backend_params))
+
+        return RouterLLM(
+            backends=backends,
+            weights=weights,
+            routing=routing,
+            timeout=timeout,
+            hedge_percentile=hedge_percentile,
+            cooldown_seconds=cooldown_seconds)
@@ -7,12 +7,18 @@ from llama_index.prompts.base import BasePromptTemplate, PromptTemplate
 from llama_index.prompts.prompt_type import PromptType
 from llama_index.response_synthesizers import get_response_synthesizer
 from llama_index.schema import BaseNode
+from llama_index.vector_stores.types import VectorStoreQueryMode
 
 from autollm.auto.embedding import AutoEmbedding
 from autollm.auto.llm import AutoLiteLLM
 from autollm.auto.service_context import AutoServiceContext
 from autollm.auto.vector_store_index import AutoVectorStoreIndex
 from autollm.utils.env_utils import load_config_and_dotenv
+from autollm.utils.lancedb_vectorstore import LanceDBVectorStore
+from autollm.utils.map_reduce_synthesizer import PARALLEL_MAP_REDUCE_MODE, MapReduceSynthesizer
+from autollm.utils.node_postprocessors import create_mmr_postprocessor, create_token_budget_postprocessor
+from autollm.utils.retriever_query_engine import RetrieverQueryEngine
+from autollm.utils.semantic_cache import create_semantic_cache
 
 
 def create_query_engine(
@@ -23,6 +29,8 @@ def create_query_engine(
         llm_max_tokens: Optional[int] = 256,
         llm_temperature: float = 0.1,
         llm_api_base: Optional[str] = None,
+        llm_cache: Union[None, str, dict] = None,
+        llm_router: Optional[dict] = None,
         # service_context_params
         system_prompt: str = None,
         query_wrapper_prompt: Union[str, BasePromptTemplate] = None,
@@ -41,6 +49,12 @@ def create_query_engine(
         response_mode: str = "compact",
         refine_prompt: str = None,
         structured_answer_filtering: bool = False,
+        semantic_cache: Union[None, bool, dict] = None,
+        hybrid_search: bool = False,
+        mmr: Union[None, bool, dict] = None,
+        pack_context: bool = False,
+        context_token_budget: Optional[int] = None,
+        map_reduce: Optional[dict] = None,
         # vector_store_params
         vector_store_type: str = "LanceDBVectorStore",
         lancedb_uri: str = "./.lancedb",
@@ -48,6 +62,7 @@ def create_query_engine(
         use_async: bool = True,
         exist_ok: bool = False,
         overwrite_existing: bool = False,
+        vector_store_index: Optional[VectorStoreIndex] = None,
         **vector_store_kwargs) -> BaseQueryEngine:
     """
     Create a query engine from parameters.
@@ -59,6 +74,11 @@ def create_query_engine(
         llm_max_tokens (int): The maximum number of tokens to be generated as LLM output.
         llm_temperature (float): The temperature to use for the LLM.
         llm_api_base (str): The API base to use for the LLM.
+        llm_cache (Union[str, dict]): The exact-match LLM response cache: "memory", "sqlite" or a dict with a
+            "type" key and the cache parameters (path, max_size, ttl_seconds). None disables caching.
+        llm_router (dict): The parameters of AutoLiteLLM.from_router (models, routing, timeout,
+            hedge_percentile, cooldown_seconds) to route the LLM calls over several models. llm_model and
+            llm_api_base are then ignored.
         system_prompt (str): The system prompt to use for the query engine.
         query_wrapper_prompt (Union[str, BasePromptTemplate]): The query wrapper prompt to use for the query engine.
         enable_cost_calculator (bool): Flag to enable cost calculator logging.
@@ -73,17 +93,46 @@ def create_query_engine(
         enable_keyword_extractor (bool): Flag to enable keyword extractor.
         enable_entity_extractor (bool): Flag to enable entity extractor.
         similarity_top_k (int): The number of similar documents to return.
-        response_mode (str): The response mode to use for the query engine.
+        response_mode (str): The response mode to use for the query engine. "parallel_map_reduce" answers over
+            groups of nodes concurrently and combines the answers, for questions over large contexts.
         refine_prompt (str): The refine prompt to use for the query engine.
+        semantic_cache (Union[bool, dict]): Flag or parameters (similarity_threshold, max_size, ttl_seconds)
+            of the cache answering paraphrased repeats of earlier queries. None disables it.
+        hybrid_search (bool): Flag to merge a full-text BM25 search with the vector search by reciprocal rank
+            fusion, to find exact identifiers like error codes. Only supported for LanceDBVectorStore.
+        mmr (Union[bool, dict]): Flag or parameters (mmr_lambda, candidates_factor, strip_overlap) of the
+            maximal marginal relevance selection of similarity_top_k diverse nodes from a larger candidate
+            set, with the text overlapping between chunks stripped. None disables it.
+        pack_context (bool): Flag to pack the retrieved nodes greedily by relevance into the context left in a
+            single LLM call, to avoid refine calls. The token count of each node is then stored at ingest
+            time.
+        context_token_budget (int): The maximum number of context tokens packed with pack_context. None fills
+            the context window.
+        map_reduce (dict): The parameters of the "parallel_map_reduce" response mode (max_concurrency,
+            max_fan_out, max_context_tokens, max_reduce_levels).
         vector_store_type (str): The vector store type to use for the query engine.
         lancedb_uri (str): The URI to use for the LanceDB vector store.
         lancedb_table_name (str): The table name to use for the LanceDB vector store.
+        vector_store_index (VectorStoreIndex): An already built index to query instead of building one, e.g.
+            one shared between tasks with the same ingestion settings. The vector store params are then
+            ignored.
 
     Returns:
         A llama_index.BaseQueryEngine instance.
     """
-    llm = AutoLiteLLM.from_defaults(
-        model=llm_model, api_base=llm_api_base, max_tokens=llm_max_tokens, temperature=llm_temperature)
+    if vector_store_index is not None and (documents is not None or nodes is not None):
+        raise ValueError("documents or nodes cannot be provided together with vector_store_index")
+
+    if llm_router is not None:
+        llm = AutoLiteLLM.from_router(
+            max_tokens=llm_max_tokens, temperature=llm_temperature, cache=llm_cache, **llm_router)
+    else:
+        llm = AutoLiteLLM.from_defaults(
+            model=llm_model,
+            api_base=llm_api_base,
+            max_tokens=llm_max_tokens,
+            temperature=llm_temperature,
+            cache=llm_cache)
 
     embedding = AutoEmbedding(model=embed_model)
 
@@ -101,18 +150,32 @@ def create_query_engine(
         enable_qa_extractor=enable_qa_extractor,
         enable_keyword_extractor=enable_keyword_extractor,
         enable_entity_extractor=enable_entity_extractor,
+        enable_token_count_extractor=pack_context,
     )
-    vector_store_index = AutoVectorStoreIndex.from_defaults(
-        vector_store_type=vector_store_type,
-        lancedb_uri=lancedb_uri,
-        lancedb_table_name=lancedb_table_name,
-        use_async=use_async,
-        documents=documents,
-        nodes=nodes,
-        service_context=service_context,
-        exist_ok=exist_ok,
-        overwrite_existing=overwrite_existing,
-        **vector_store_kwargs)
+    if vector_store_index is None:
+        vector_store_index = AutoVectorStoreIndex.from_defaults(
+            vector_store_type=vector_store_type,
+            lancedb_uri=lancedb_uri,
+            lancedb_table_name=lancedb_table_name,
+            use_async=use_async,
+            documents=documents,
+            nodes=nodes,
+            service_context=service_context,
+            exist_ok=exist_ok,
+            overwrite_existing=overwrite_existing,
+            **vector_store_kwargs)
+    else:
+        # Bind the shared index to the service context of this query engine, its data is not copied
+        vector_store_index = VectorStoreIndex(
+            index_struct=vector_store_index.index_struct,
+            storage_context=vector_store_index.storage_context,
+            service_context=service_context)
+    if hybrid_search:
+        if not isinstance(vector_store_index.vector_store, LanceDBVectorStore):
+            raise ValueError("hybrid_search is only supported for LanceDBVectorStore")
+        # The full-text index is rebuilt by the writes, e.g. the ingestion batches, never by the queries
+        vector_store_index.vector_store.enable_fts_index()
+
     if refine_prompt is not None:
         refine_prompt_template = PromptTemplate(refine_prompt, prompt_type=PromptType.REFINE)
     else:
@@ -121,15 +184,57 @@ def create_query_engine(
     # Convert query_wrapper_prompt to PromptTemplate if it is a string
     if isinstance(query_wrapper_prompt, str):
         query_wrapper_prompt = PromptTemplate(template=query_wrapper_prompt)
-    response_synthesizer = get_response_synthesizer(
-        service_context=service_context,
-        text_qa_template=query_wrapper_prompt,
-        refine_template=refine_prompt_template,
-        response_mode=response_mode,
-        structured_answer_filtering=structured_answer_filtering)
+    if response_mode == PARALLEL_MAP_REDUCE_MODE:
+        map_reduce_kwargs = map_reduce or {}
+        response_synthesizer = MapReduceSynthesizer(
+            text_qa_template=query_wrapper_prompt, service_context=service_context, **map_reduce_kwargs)
+        streaming_response_synthesizer = MapReduceSynthesizer(
+            text_qa_template=query_wrapper_prompt,
+            service_context=service_context,
+            streaming=True,
+            **map_reduce_kwargs)
+    else:
+        response_synthesizer = get_response_synthesizer(
+            service_context=service_context,
+            text_qa_template=query_wrapper_prompt,
+            refine_template=refine_prompt_template,
+            response_mode=response_mode,
+            structured_answer_filtering=structured_answer_filtering)
+        # Structured answer filtering parses the whole LLM output, so its answers cannot be streamed
+        streaming_response_synthesizer = None
+        if not structured_answer_filtering:
+            streaming_response_synthesizer = get_response_synthesizer(
+                service_context=service_context,
+                text_qa_template=query_wrapper_prompt,
+                refine_template=refine_prompt_template,
+                response_mode=response_mode,
+                streaming=True)
+
+    node_postprocessors = []
+    retriever_top_k = similarity_top_k
+    mmr_postprocessor = create_mmr_postprocessor(mmr, top_n=similarity_top_k)
+    if mmr_postprocessor is not None:
+        # Retrieve more candidates to select the diverse ones from
+        retriever_top_k = similarity_top_k * mmr_postprocessor.candidates_factor
+        node_postprocessors.append(mmr_postprocessor)
+    if pack_context:
+        node_postprocessors.append(
+            create_token_budget_postprocessor(service_context, response_synthesizer, context_token_budget))
+
+    vector_store_query_mode = VectorStoreQueryMode.HYBRID if hybrid_search else VectorStoreQueryMode.DEFAULT
+    retriever = vector_store_index.as_retriever(
+        similarity_top_k=retriever_top_k, vector_store_query_mode=vector_store_query_mode)
 
-    return vector_store_index.as_query_engine(
-        similarity_top_k=similarity_top_k, response_synthesizer=response_synthesizer)
+    return RetrieverQueryEngine(
+        retriever=retriever,
+        response_synthesizer=response_synthesizer,
+        node_postprocessors=node_postprocessors,
+        callback_manager=service_context.callback_manager,
+        streaming_response_synthesizer=streaming_response_synthesizer,
+        vector_store_index=vector_store_index,
+        semantic_cache=create_semantic_cache(semantic_cache),
+        # The retriever may fetch more candidates than the task returns, e.g. for MMR
+        search_top_k=similarity_top_k)
 
 
 class AutoQueryEngine:
@@ -169,6 +274,13 @@ class AutoQueryEngine:
         lancedb_table_name="vectors",
         **vector_store_kwargs)
     )
+
+    # Retrieve the relevant nodes with their scores and metadata, without calling the LLM
+    nodes = query_engine.search("why so serious?", top_k=3, filters={"file_name": "faq.md"}, fields=["text"])
+
+    # Answer many queries with batched embeddings and at most 8 concurrent LLM calls, as they complete
+    async for position, response in query_engine.abatch_query(queries, max_concurrency=8):
+        print(position, response)
     ```
     """
 
@@ -199,6 +311,8 @@ class AutoQueryEngine:
             llm_api_base: Optional[str] = None,
             llm_max_tokens: Optional[int] = None,
             llm_temperature: Optional[float] = 0.1,
+            llm_cache: Union[None, str, dict] = None,
+            llm_router: Optional[dict] = None,
             # service_context_params
             system_prompt: str = None,
             query_wrapper_prompt: Union[str, BasePromptTemplate] = None,
@@ -212,6 +326,12 @@ class AutoQueryEngine:
             response_mode: str = "compact",
             refine_prompt: str = None,
             structured_answer_filtering: bool = False,
+            semantic_cache: Union[None, bool, dict] = None,
+            hybrid_search: bool = False,
+            mmr: Union[None, bool, dict] = None,
+            pack_context: bool = False,
+            context_token_budget: Optional[int] = None,
+            map_reduce: Optional[dict] = None,
             # vector_store_params
             vector_store_type: str = "LanceDBVectorStore",
             lancedb_uri: str = "./.lancedb",
@@ -219,6 +339,7 @@ class AutoQueryEngine:
             use_async: bool = True,
             exist_ok: bool = False,
             overwrite_existing: bool = False,
+            vector_store_index: Optional[VectorStoreIndex] = None,
             **vector_store_kwargs) -> BaseQueryEngine:
         """
         Create an AutoQueryEngine from default parameters.
@@ -230,6 +351,9 @@ class AutoQueryEngine:
             llm_max_tokens (int): The maximum number of tokens to be generated as LLM output.
             llm_temperature (float): The temperature to use for the LLM.
             llm_api_base (str): The API base to use for the LLM.
+            llm_cache (Union[str, dict]): The exact-match LLM response cache. None disables caching.
+            llm_router (dict): The parameters of AutoLiteLLM.from_router to route the LLM calls over several
+                models.
             system_prompt (str): The system prompt to use for the query engine.
             query_wrapper_prompt (Union[str, BasePromptTemplate]): The query wrapper prompt to use for the query engine.
             enable_cost_calculator (bool): Flag to enable cost calculator logging.
@@ -245,11 +369,19 @@ class AutoQueryEngine:
             similarity_top_k (int): The number of similar documents to return.
             response_mode (str): The response mode to use for the query engine.
             refine_prompt (str): The refine prompt to use for the query engine.
+            semantic_cache (Union[bool, dict]): Flag or parameters of the semantic answer cache.
+            hybrid_search (bool): Flag to merge a full-text search with the vector search
+                (LanceDBVectorStore).
+            mmr (Union[bool, dict]): Flag or parameters of the diverse, overlap-free selection of the nodes.
+            pack_context (bool): Flag to pack the retrieved nodes into the context of a single LLM call.
+            context_token_budget (int): The maximum number of context tokens packed with pack_context.
+            map_reduce (dict): The parameters of the "parallel_map_reduce" response mode.
             vector_store_type (str): The vector store type to use for the query engine.
             lancedb_uri (str): The URI to use for the LanceDB vector store.
             lancedb_table_name (str): The table name to use for the LanceDB vector store.
             exist_ok (bool): Flag to allow overwriting an existing vector store.
             overwrite_existing (bool): Flag to allow overwriting an existing vector store.
+            vector_store_index (VectorStoreIndex): An already built index to query instead of building one.
 
             Returns:
                 A llama_index.BaseQueryEngine instance.
@@ -263,6 +395,8 @@ class AutoQueryEngine:
             llm_api_base=llm_api_base,
             llm_max_tokens=llm_max_tokens,
             llm_temperature=llm_temperature,
+            llm_cache=llm_cache,
+            llm_router=llm_router,
             # service_context_params
             system_prompt=system_prompt,
             query_wrapper_prompt=query_wrapper_prompt,
@@ -276,6 +410,12 @@ class AutoQueryEngine:
             response_mode=response_mode,
             refine_prompt=refine_prompt,
             structured_answer_filtering=structured_answer_filtering,
+            semantic_cache=semantic_cache,
+            hybrid_search=hybrid_search,
+            mmr=mmr,
+            pack_context=pack_context,
+            context_token_budget=context_token_budget,
+            map_reduce=map_reduce,
             # vector_store_params
             vector_store_type=vector_store_type,
             lancedb_uri=lancedb_uri,
@@ -283,6 +423,7 @@ class AutoQueryEngine:
             use_async=use_async,
             exist_ok=exist_ok,
             overwrite_existing=overwrite_existing,
+            vector_store_index=vector_store_index,
             **vector_store_kwargs)
 
     @staticmethod
@@ -17,6 +17,7 @@ from llama_index.text_splitter import SentenceSplitter
 
 from autollm.callbacks.cost_calculating import CostCalculatingHandler
 from autollm.utils.llm_utils import set_default_prompt_template
+from autollm.utils.token_counting import TokenCountExtractor
 
 
 class AutoServiceContext:
@@ -39,6 +40,7 @@ class AutoServiceContext:
             enable_qa_extractor: bool = False,
             enable_keyword_extractor: bool = False,
             enable_entity_extractor: bool = False,
+            enable_token_count_extractor: bool = False,
             **kwargs) -> ServiceContext:
         """
         Create a ServiceContext with default parameters with extended enable_token_counting functionality. If
@@ -58,6 +60,7 @@ class AutoServiceContext:
             enable_qa_extractor (bool): Flag to enable question answering extractor.
             enable_keyword_extractor (bool): Flag to enable keyword extractor.
             enable_entity_extractor (bool): Flag to enable entity extractor.
+            enable_token_count_extractor (bool): Flag to store the token count of each node at ingest time.
             **kwargs: Arbitrary keyword arguments.
 
         Returns:
@@ -89,6 +92,9 @@ class AutoServiceContext:
             transformations.append(TitleExtractor(llm=llm, nodes=5))
         if enable_qa_extractor:
             transformations.append(QuestionsAnsweredExtractor(llm=llm, questions=5))
+        # Counted last, after the other extractors added their metadata
+        if enable_token_count_extractor:
+            transformations.append(TokenCountExtractor())
 
         service_context = ServiceContext.from_defaults(
             llm=llm,
@@ -0,0 +1,250 @@
+"""Rolling-window token and cost budgets with pre-admission checks per task and per API key."""
+import math
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, List, Optional, Tuple
+
+from litellm.utils import cost_per_token, token_counter
+
+# Rough token count of the system prompt and the query wrapper template around the retrieved context
+PROMPT_TEMPLATE_OVERHEAD_TOKENS = 150
+DEFAULT_BUDGET_WINDOW_SECONDS = 3600.0
+DEFAULT_API_KEY = "default"
+# Idle windows are dropped once there are more than this many, so that unknown keys cannot grow memory forever
+MAX_IDLE_WINDOWS = 10000
+
+
+class BudgetExceededError(Exception):
+    """Raised when a request would exceed a token or cost budget."""
+
+    def __init__(self, message: str, retry_after: float) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+@dataclass
+class BudgetLimit:
+    """Token and USD limits over a rolling time window. A None limit is not enforced."""
+    max_tokens: Optional[int] = None
+    max_cost_usd: Optional[float] = None
+    window_seconds: float = DEFAULT_BUDGET_WINDOW_SECONDS
+
+
+class _WindowEntry:
+    __slots__ = ("timestamp", "tokens", "cost_usd", "expired")
+
+    def __init__(self, timestamp: float, tokens: int, cost_usd: float) -> None:
+        self.timestamp = timestamp
+        self.tokens = tokens
+        self.cost_usd = cost_usd
+        self.expired = False
+
+
+class RollingWindow:
+    """Running token and cost totals of the entries added within the last window_seconds."""
+
+    def __init__(self, limit: BudgetLimit) -> None:
+        self.limit = limit
+        self.tokens = 0
+        self.cost_usd = 0.0
+        self._entries: Deque[_WindowEntry] = deque()
+
+    def expire(self, now: float) -> None:
+        cutoff = now - self.limit.window_seconds
+        while self._entries and self._entries[0].timestamp <= cutoff:
+            entry = self._entries.popleft()
+            entry.expired = True
+            self.tokens -= entry.tokens
+            self.cost_usd -= entry.cost_usd
+
+    def retry_after(self, now: float, tokens: int, cost_usd: float) -> Optional[float]:
+        """Get the seconds to wait until the given usage fits the limit, None if it already fits."""
+        excess_tokens = (
+            self.tokens + tokens - self.limit.max_tokens if self.limit.max_tokens is not None else 0)
+        excess_cost = (
+            self.cost_usd + cost_usd - self.limit.max_cost_usd if self.limit.max_cost_usd is not None else 0)
+        if excess_tokens <= 0 and excess_cost <= 0:
+            return None
+
+        for entry in self._entries:
+            excess_tokens -= entry.tokens
+            excess_cost -= entry.cost_usd
+            if excess_tokens <= 0 and excess_cost <= 0:
+                return max(entry.timestamp + self.limit.window_seconds - now, 0.0)
+        # The request alone is larger than the budget
+        return self.limit.window_seconds
+
+    def add(self, now: float, tokens: int, cost_usd: float) -> _WindowEntry:
+        entry = _WindowEntry(now, tokens, cost_usd)
+        self._entries.append(entry)
+        self.tokens += tokens
+        self.cost_usd += cost_usd
+        return entry
+
+    def update(self, entry: _WindowEntry, tokens: int, cost_usd: float) -> None:
+        if entry.expired:
+            return
+        self.tokens += tokens - entry.tokens
+        self.cost_usd += cost_usd - entry.cost_usd
+        entry.tokens = tokens
+        entry.cost_usd = cost_usd
+
+
+@dataclass
+class BudgetReservation:
+    """Usage reserved for an admitted request, to be settled with the actual usage."""
+    entries: List[Tuple[RollingWindow, _WindowEntry]]
+    tokens: int
+    cost_usd: float
+
+
+def estimate_query_usage(
+        query: str,
+        model: str = "gpt-3.5-turbo",
+        similarity_top_k: int = 6,
+        chunk_size: int = 512,
+        max_tokens: Optional[int] = 256) -> Tuple[int, float]:
+    """
+    Estimate the worst-case token usage and USD cost of a query before running it.
+
+    Parameters:
+        query (str): The user query.
+        model (str): The LLM model used for tokenizing and pricing.
+        similarity_top_k (int): The number of retrieved chunks sent to the LLM.
+        chunk_size (int): The token chunk size of each retrieved chunk.
+        max_tokens (int): The maximum number of tokens generated by the LLM.
+
+    Returns:
+        (tokens, cost_usd) tuple.
+    """
+    prompt_tokens = (
+        token_counter(model=model, text=query) + similarity_top_k * chunk_size +
+        PROMPT_TEMPLATE_OVERHEAD_TOKENS)
+    completion_tokens = max_tokens or 256
+    try:
+        prompt_cost, completion_cost = cost_per_token(
+            model=model, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+    except Exception:
+        prompt_cost, completion_cost = 0.0, 0.0
+
+    return prompt_tokens + completion_tokens, prompt_cost + completion_cost
+
+
+class BudgetManager:
+    """
+    Enforces rolling-window token and USD budgets per task and per API key.
+
+    Requests are admitted with an estimate of their usage that is reserved against every matching budget, and
+    the reservation is settled with the actual usage once the request finishes. A request whose estimate does
+    not fit is rejected right away with the time to wait until it would fit.
+
+    ```python
+    budget_manager = BudgetManager.from_config({
+        "window_seconds": 3600,
+        "tasks": {"qa": {"max_tokens": 200000, "max_cost_usd": 2.0}},
+        "api_keys": {"default": {"max_tokens": 20000}, "team-a": {"max_cost_usd": 10.0}},
+    })
+    reservation = budget_manager.reserve("qa", "team-a", tokens=3500, cost_usd=0.006)
+    ...
+    budget_manager.settle(reservation, tokens=2100, cost_usd=0.004)
+    ```
+
+    Parameters:
+        task_budgets: Budget limits by task name.
+        api_key_budgets: Budget limits by API key. The "default" entry applies to every key without its own
+            entry.
+    """
+
+    def __init__(
+            self,
+            task_budgets: Optional[Dict[str, BudgetLimit]] = None,
+            api_key_budgets: Optional[Dict[str, BudgetLimit]] = None) -> None:
+        self.task_budgets = task_budgets or {}
+        self.api_key_budgets = api_key_budgets or {}
+        self._windows: Dict[Tuple[str, str], RollingWindow] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, budget_config: dict) -> "BudgetManager":
+        """
+        Create a BudgetManager from the "budgets" section of config.yaml.
+
+        Parameters:
+            budget_config (dict): Mapping with optional "window_seconds", "tasks" and "api_keys" keys. Each
+                task and API key maps to "max_tokens", "max_cost_usd" and optionally its own "window_seconds".
+
+        Returns:
+            BudgetManager: The initialized budget manager.
+        """
+        window_seconds = budget_config.get("window_seconds", DEFAULT_BUDGET_WINDOW_SECONDS)
+
+        def to_limits(limits: Optional[dict]) -> Dict[str, BudgetLimit]:
+            return {
+                name:
+                BudgetLimit(
+                    max_tokens=params.get("max_tokens"),
+                    max_cost_usd=params.get("max_cost_usd"),
+                    window_seconds=params.get("window_seconds", window_seconds))
+                for name, params in (limits or {}).items()
+            }
+
+        return cls(
+            task_budgets=to_limits(budget_config.get("tasks")),
+            api_key_budgets=to_limits(budget_config.get("api_keys")))
+
+    def _get_windows(self, task: str, api_key: Optional[str]) -> List[RollingWindow]:
+        windows = []
+        if task in self.task_budgets:
+            windows.append(self._get_window(("task", task), self.task_budgets[task]))
+
+        api_key = api_key or DEFAULT_API_KEY
+        if api_key in self.api_key_budgets:
+            windows.append(self._get_window(("api_key", api_key), self.api_key_budgets[api_key]))
+        elif DEFAULT_API_KEY in self.api_key_budgets:
+            # every key gets its own window with the default limits
+            windows.append(self._get_window(("api_key", api_key), self.api_key_budgets[DEFAULT_API_KEY]))
+        return windows
+
+    def _get_window(self, key: Tuple[str, str], limit: BudgetLimit) -> RollingWindow:
+        window = self._windows.get(key)
+        if window is None:
+            window = self._windows[key] = RollingWindow(limit)
+        return window
+
+    def reserve(self, task: str, api_key: Optional[str], tokens: int, cost_usd: float) -> BudgetReservation:
+        """
+        Admit a request by reserving its estimated usage against the task and API key budgets.
+
+        Raises:
+            BudgetExceededError: If the estimated usage does not fit one of the budgets.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if len(self._windows) > MAX_IDLE_WINDOWS:
+                self._drop_idle_windows(now)
+            windows = self._get_windows(task, api_key)
+            for window in windows:
+                window.expire(now)
+                retry_after = window.retry_after(now, tokens, cost_usd)
+                if retry_after is not None:
+                    raise BudgetExceededError(
+                        f"Budget exhausted for task '{task}'. Retry after {math.ceil(retry_after)} seconds.",
+                        retry_after=retry_after)
+
+            entries = [(window, window.add(now, tokens, cost_usd)) for window in windows]
+
+        return BudgetReservation(entries=entries, tokens=tokens, cost_usd=cost_usd)
+
+    def _drop_idle_windows(self, now: float) -> None:
+        for key, window in list(self._windows.items()):
+            window.expire(now)
+            if window.tokens <= 0 and window.cost_usd <= 0:
+                del self._windows[key]
+
+    def settle(self, reservation: BudgetReservation, tokens: int, cost_usd: float) -> None:
+        """Replace the reserved usage of a finished request with its actual usage."""
+        with self._lock:
+            for window, entry in reservation.entries:
+                window.update(entry, tokens, cost_usd)
@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import Any, Dict, List, Optional, cast
+from typing import Any, Dict, List, Optional, Tuple, cast
 
 from litellm.utils import cost_per_token, token_counter
 from llama_index.callbacks.schema import CBEventType, EventPayload
@@ -53,6 +53,64 @@ def get_llm_token_counts(
         raise ValueError("Invalid payload! Need prompt and completion or messages and response.")
 
 
+def get_reported_token_counts(payload: Dict[str, Any]) -> Optional[Tuple[int, int]]:
+    """
+    Get the prompt and completion token counts reported by the LLM provider, if any.
+
+    Reading the provider usage avoids re-tokenizing the prompt and the completion on every LLM call.
+
+    Args:
+        payload: The LLM event end payload.
+
+    Returns:
+        (prompt_tokens, completion_tokens) tuple or None if the response carries no usage.
+    """
+    response = payload.get(EventPayload.RESPONSE) or payload.get(EventPayload.COMPLETION)
+    raw = getattr(response, "raw", None)
+    if raw is None:
+        return None
+
+    usage = raw.get("usage") if isinstance(raw, dict) else getattr(raw, "usage", None)
+    if not usage:
+        return None
+
+    if isinstance(usage, dict):
+        prompt_tokens, completion_tokens = usage.get("prompt_tokens"), usage.get("completion_tokens")
+    else:
+        prompt_tokens = getattr(usage, "prompt_tokens", None)
+        completion_tokens = getattr(usage, "completion_tokens", None)
+    if prompt_tokens is None or completion_tokens is None:
+        return None
+
+    return int(prompt_tokens), int(completion_tokens)
+
+
+def get_llm_usage(payload: Dict[str, Any], model: str = "gpt-3.5-turbo") -> Tuple[int, int, float]:
+    """
+    Get the token usage and the USD cost of a finished LLM event.
+
+    Args:
+        payload: The LLM event end payload.
+        model: The model to use for tokenizing and pricing.
+
+    Returns:
+        (prompt_tokens, completion_tokens, cost_usd) tuple. The cost is 0 for models unknown to LiteLLM.
+    """
+    token_counts = get_reported_token_counts(payload)
+    if token_counts is None:
+        token_count_event = get_llm_token_counts(payload=payload, model=model)
+        token_counts = (token_count_event.prompt_token_count, token_count_event.completion_token_count)
+    prompt_tokens, completion_tokens = token_counts
+
+    try:
+        prompt_cost, completion_cost = cost_per_token(
+            model=model, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+    except Exception:
+        prompt_cost, completion_cost = 0.0, 0.0
+
+    return prompt_tokens, completion_tokens, prompt_cost + completion_cost
+
+
 def get_llm_token_costs(
     latest_llm_token_count: TokenCountingEvent,
     event_id: str = "",
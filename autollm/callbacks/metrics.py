@@ -0,0 +1,254 @@
+"""Per-task request, latency, token and cost metrics exposed in Prometheus text format."""
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from llama_index.callbacks.base_handler import BaseCallbackHandler
+from llama_index.callbacks.schema import CBEventType, EventPayload
+
+from autollm.callbacks.cost_calculating import get_llm_usage
+
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+METRIC_DESCRIPTIONS = {
+    "autollm_requests_total": ("counter", "Number of finished queries per task and status."),
+    "autollm_request_latency_seconds": ("histogram", "End-to-end query latency per task."),
+    "autollm_stage_latency_seconds":
+    ("histogram", "Latency of embedding, retrieval and llm stages per task."),
+    "autollm_llm_tokens_total": ("counter", "Number of LLM prompt and completion tokens per task."),
+    "autollm_llm_cost_usd_total": ("counter", "LLM cost in USD per task."),
+    "autollm_coalesced_requests_total":
+    ("counter", "Number of requests answered by an identical query already in flight per task."),
+    "autollm_admission_running_requests": ("gauge", "Number of admitted requests running per task."),
+    "autollm_admission_queue_depth": ("gauge", "Number of requests waiting for admission per task."),
+    "autollm_admission_rejected_total":
+    ("counter", "Number of requests rejected by admission control per task and status code."),
+    "autollm_cancelled_requests_total":
+    ("counter", "Number of requests cancelled on client disconnect or deadline per task and reason."),
+    "autollm_ingested_documents_total":
+    ("counter", "Number of documents ingested by ingestion jobs per task."),
+}
+
+LabelsType = Tuple[Tuple[str, str], ...]
+
+
+def _to_labels(labels: Optional[Dict[str, str]]) -> LabelsType:
+    return tuple(sorted((labels or {}).items()))
+
+
+def _format_labels(labels: LabelsType, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    escaped = [(key, str(value).replace("\\", "\\\\").replace('"', '\\"')) for key, value in items]
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+class Histogram:
+    """Cumulative histogram with fixed upper bounds, as used by Prometheus."""
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """
+    Thread-safe store of counters, gauges and histograms keyed by metric name and labels.
+
+    ```python
+    registry = MetricsRegistry()
+    registry.inc("autollm_requests_total", {"task": "qa", "status": "success"})
+    registry.observe("autollm_request_latency_seconds", {"task": "qa"}, 0.42)
+    print(registry.render_prometheus())
+    ```
+    """
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS) -> None:
+        self._buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[LabelsType, float]] = defaultdict(dict)
+        self._gauges: Dict[str, Dict[LabelsType, float]] = defaultdict(dict)
+        self._histograms: Dict[str, Dict[LabelsType, Histogram]] = defaultdict(dict)
+
+    def inc(self, name: str, labels: Optional[Dict[str, str]] = None, value: float = 1.0) -> None:
+        """Increment a counter."""
+        key = _to_labels(labels)
+        with self._lock:
+            self._counters[name][key] = self._counters[name].get(key, 0.0) + value
+
+    def set_gauge(self, name: str, labels: Optional[Dict[str, str]] = None, value: float = 0.0) -> None:
+        """Set a gauge to the given value."""
+        with self._lock:
+            self._gauges[name][_to_labels(labels)] = value
+
+    def observe(self, name: str, labels: Optional[Dict[str, str]] = None, value: float = 0.0) -> None:
+        """Record an observation in a histogram."""
+        key = _to_labels(labels)
+        with self._lock:
+            histogram = self._histograms[name].get(key)
+            if histogram is None:
+                histogram = self._histograms[name][key] = Histogram(self._buckets)
+            histogram.observe(value)
+
+    def get_counter(self, name: str, labels: Optional[Dict[str, str]] = None) -> float:
+        """Get the current value of a counter."""
+        with self._lock:
+            return self._counters[name].get(_to_labels(labels), 0.0)
+
+    def get_gauge(self, name: str, labels: Optional[Dict[str, str]] = None) -> float:
+        """Get the current value of a gauge."""
+        with self._lock:
+            return self._gauges[name].get(_to_labels(labels), 0.0)
+
+    def get_histogram(self, name: str, labels: Optional[Dict[str, str]] = None) -> Optional[Histogram]:
+        """Get a histogram, None if nothing has been observed yet."""
+        with self._lock:
+            return self._histograms[name].get(_to_labels(labels))
+
+    def render_prometheus(self) -> str:
+        """Render all metrics in the Prometheus text exposition format."""
+        lines: List[str] = []
+        with self._lock:
+            for metric_type, metrics in (("counter", self._counters), ("gauge", self._gauges)):
+                for name in sorted(metrics):
+                    self._append_header(lines, name, metric_type)
+                    for labels, value in sorted(metrics[name].items()):
+                        lines.append(f"{name}{_format_labels(labels)} {value:g}")
+
+            for name in sorted(self._histograms):
+                self._append_header(lines, name, "histogram")
+                for labels, histogram in sorted(self._histograms[name].items()):
+                    cumulative = 0
+                    for upper_bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(
+                            f"{name}_bucket{_format_labels(labels, ('le', f'{upper_bound:g}'))} {cumulative}")
+                    lines.append(f"{name}_bucket{_format_labels(labels, ('le', '+Inf'))} {histogram.count}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum:g}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _append_header(lines: List[str], name: str, default_type: str) -> None:
+        metric_type, description = METRIC_DESCRIPTIONS.get(name, (default_type, name))
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {metric_type}")
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """
+    Callback handler feeding a MetricsRegistry with the requests, stage latencies, tokens and cost of a task.
+
+    Retrieval latency excludes the query embedding time, which is reported as its own stage. Embeddings
+    outside of a query (e.g. ingestion) are not recorded as a stage.
+
+    Parameters:
+        task_name: The task label of the recorded metrics.
+        registry: The registry to record the metrics in.
+        model_name: The model used for pricing when the LLM event does not carry the model name.
+    """
+
+    _timed_events = (CBEventType.QUERY, CBEventType.RETRIEVE, CBEventType.EMBEDDING, CBEventType.LLM)
+
+    def __init__(self, task_name: str, registry: MetricsRegistry, model_name: str = "gpt-3.5-turbo") -> None:
+        self.task_name = task_name
+        self.registry = registry
+        self.model_name = model_name
+        # event_id -> (start time, event type, parent_id, model name)
+        self._event_starts: Dict[str, Tuple[float, CBEventType, str, Optional[str]]] = {}
+        # retrieve event_id -> total query embedding time spent inside it
+        self._nested_embedding_time: Dict[str, float] = defaultdict(float)
+
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+
+    def on_event_start(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        parent_id: str = "",
+        **kwargs: Any,
+    ) -> str:
+        if event_type in self._timed_events:
+            model_name = None
+            if event_type == CBEventType.LLM and payload is not None:
+                model_name = (payload.get(EventPayload.SERIALIZED) or {}).get("model")
+            self._event_starts[event_id] = (time.perf_counter(), event_type, parent_id, model_name)
+        return event_id
+
+    def on_event_end(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        **kwargs: Any,
+    ) -> None:
+        start = self._event_starts.pop(event_id, None)
+        if start is None:
+            return
+        start_time, _, parent_id, model_name = start
+        duration = time.perf_counter() - start_time
+        payload = payload or {}
+
+        if event_type == CBEventType.QUERY:
+            status = "error" if EventPayload.EXCEPTION in payload else "success"
+            self.registry.inc("autollm_requests_total", {"task": self.task_name, "status": status})
+            self.registry.observe("autollm_request_latency_seconds", {"task": self.task_name}, duration)
+
+        elif event_type == CBEventType.EMBEDDING:
+            parent_start = self._event_starts.get(parent_id)
+            if parent_start is not None:
+                # Only a retrieval subtracts its embeddings, e.g. a query embeds for its semantic cache too
+                if parent_start[1] == CBEventType.RETRIEVE:
+                    self._nested_embedding_time[parent_id] += duration
+                self._observe_stage("embedding", duration)
+
+        elif event_type == CBEventType.RETRIEVE:
+            embedding_time = self._nested_embedding_time.pop(event_id, 0.0)
+            self._observe_stage("retrieval", max(duration - embedding_time, 0.0))
+
+        elif event_type == CBEventType.LLM:
+            self._observe_stage("llm", duration)
+            if EventPayload.EXCEPTION in payload:
+                return
+            prompt_tokens, completion_tokens, cost = get_llm_usage(
+                payload, model=model_name or self.model_name)
+            self.registry.inc(
+                "autollm_llm_tokens_total", {
+                    "task": self.task_name,
+                    "type": "prompt"
+                }, prompt_tokens)
+            self.registry.inc(
+                "autollm_llm_tokens_total", {
+                    "task": self.task_name,
+                    "type": "completion"
+                }, completion_tokens)
+            self.registry.inc("autollm_llm_cost_usd_total", {"task": self.task_name}, cost)
+
+    def _observe_stage(self, stage: str, duration: float) -> None:
+        self.registry.observe(
+            "autollm_stage_latency_seconds", {
+                "task": self.task_name,
+                "stage": stage
+            }, duration)
+
+    def start_trace(self, trace_id: Optional[str] = None) -> None:
+        """Run when an overall trace is launched."""
+
+    def end_trace(
+        self,
+        trace_id: Optional[str] = None,
+        trace_map: Optional[Dict[str, List[str]]] = None,
+    ) -> None:
+        """Run when an overall trace is exited."""
@@ -0,0 +1,479 @@
+"""Per-request tracing of the query pipeline stages as nested spans, exported to a pluggable exporter."""
+import json
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Dict, Generator, List, Optional, Sequence, Tuple, Union
+
+import httpx
+from llama_index.callbacks.base_handler import BaseCallbackHandler
+from llama_index.callbacks.schema import CBEventType, EventPayload
+
+from autollm.callbacks.cost_calculating import get_llm_usage
+from autollm.utils.logging import logger
+
+DEFAULT_MAX_TRACES = 1000
+DEFAULT_OTLP_ENDPOINT = "http://localhost:4318/v1/traces"
+DEFAULT_MAX_PENDING_EXPORTS = 1000
+# OTLP span kind and status codes
+OTLP_SPAN_KIND_INTERNAL = 1
+OTLP_STATUS_OK = 1
+OTLP_STATUS_ERROR = 2
+
+
+@dataclass
+class Span:
+    """A timed stage of a request, e.g. an embedding, retrieval or LLM call, with its token and node count."""
+    name: str
+    span_id: str
+    parent_span_id: str
+    start_time: float
+    duration_seconds: float = 0.0
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    error: Optional[str] = None
+
+    @property
+    def end_time(self) -> float:
+        return self.start_time + self.duration_seconds
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_span_id,
+            "start_time": self.start_time,
+            "duration_ms": self.duration_seconds * 1000,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+def _new_span_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+@dataclass
+class RequestTrace:
+    """The spans recorded during a request. The top-level spans are children of the span of the request."""
+    name: str
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    trace_id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    span_id: str = field(default_factory=_new_span_id)
+    start_time: float = field(default_factory=time.time)
+    end_time: Optional[float] = None
+    spans: List[Span] = field(default_factory=list)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    @property
+    def duration_seconds(self) -> float:
+        return (self.end_time or time.time()) - self.start_time
+
+    def add_span(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def add_stage(self, name: str, start_time: float, attributes: Optional[Dict[str, Any]] = None) -> None:
+        """Add a top-level span ending now for a stage outside the query engine, e.g. the admission wait."""
+        self.add_span(
+            Span(
+                name=name,
+                span_id=_new_span_id(),
+                parent_span_id=self.span_id,
+                start_time=start_time,
+                duration_seconds=time.time() - start_time,
+                attributes=dict(attributes or {})))
+
+    def get_spans(self) -> List[Span]:
+        with self._lock:
+            return list(self.spans)
+
+    def get_stage_durations(self) -> Dict[str, float]:
+        """
+        Get the seconds spent in each stage, excluding the time of its nested stages, so that the retrieval
+        time does not include the query embedding and the synthesis time does not include the LLM calls.
+        """
+        spans = self.get_spans()
+        nested_seconds: Dict[str, float] = defaultdict(float)
+        for span in spans:
+            nested_seconds[span.parent_span_id] += span.duration_seconds
+
+        stage_durations: Dict[str, float] = {}
+        for span in spans:
+            own_seconds = max(span.duration_seconds - nested_seconds.get(span.span_id, 0.0), 0.0)
+            stage_durations[span.name] = stage_durations.get(span.name, 0.0) + own_seconds
+        return stage_durations
+
+    def format_server_timing(self) -> str:
+        """Format the stage durations as a Server-Timing header, e.g. "retrieve;dur=4.2, total;dur=210.5"."""
+        timings = {**self.get_stage_durations(), "total": self.duration_seconds}
+        return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items())
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "name": self.name,
+            "start_time": self.start_time,
+            "duration_ms": self.duration_seconds * 1000,
+            "attributes": self.attributes,
+            "spans": [span.to_dict() for span in self.get_spans()],
+        }
+
+
+current_request_trace: ContextVar[Optional[RequestTrace]] = ContextVar("current_request_trace", default=None)
+
+
+@contextmanager
+def trace_request(trace: Optional[RequestTrace]) -> Generator[Optional[RequestTrace], None, None]:
+    """
+    Record the spans of the query engine calls made in the current context (and the threads/tasks spawned from
+    it) in a trace. A None trace records nothing.
+
+    ```python
+    trace = RequestTrace(name="query")
+    with trace_request(trace):
+        query_engine.query("why so serious?")
+    print(trace.format_server_timing())
+    ```
+    """
+    token = current_request_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        current_request_trace.reset(token)
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """
+    Callback handler recording each callback event of a query engine as a span of the trace of the current
+    request, nested like the events. LLM spans carry their model and token counts, and retrieval and embedding
+    spans the number of nodes and chunks.
+
+    Events outside of trace_request are ignored.
+
+    Parameters:
+        model_name: The model used for token counting when the LLM event does not carry the model name.
+    """
+
+    def __init__(self, model_name: str = "gpt-3.5-turbo") -> None:
+        self.model_name = model_name
+        # event_id -> (trace, span, start perf counter)
+        self._open_spans: Dict[str, Tuple[RequestTrace, Span, float]] = {}
+
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+
+    def on_event_start(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        parent_id: str = "",
+        **kwargs: Any,
+    ) -> str:
+        trace = current_request_trace.get()
+        if trace is None:
+            return event_id
+
+        parent = self._open_spans.get(parent_id)
+        parent_span_id = parent[1].span_id if parent is not None and parent[0] is trace else trace.span_id
+        span = Span(
+            name=event_type.value,
+            span_id=_new_span_id(),
+            parent_span_id=parent_span_id,
+            start_time=time.time())
+        if event_type == CBEventType.LLM and payload is not None:
+            model_name = (payload.get(EventPayload.SERIALIZED) or {}).get("model")
+            if model_name:
+                span.attributes["model"] = model_name
+        self._open_spans[event_id] = (trace, span, time.perf_counter())
+        return event_id
+
+    def on_event_end(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        **kwargs: Any,
+    ) -> None:
+        open_span = self._open_spans.pop(event_id, None)
+        if open_span is None:
+            return
+        trace, span, start = open_span
+        span.duration_seconds = time.perf_counter() - start
+        payload = payload or {}
+
+        if EventPayload.EXCEPTION in payload:
+            span.error = str(payload[EventPayload.EXCEPTION])
+        elif event_type == CBEventType.LLM:
+            prompt_tokens, completion_tokens, cost_usd = get_llm_usage(
+                payload, model=span.attributes.get("model", self.model_name))
+            span.attributes.update(
+                prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, cost_usd=cost_usd)
+        if EventPayload.NODES in payload:
+            span.attributes["num_nodes"] = len(payload[EventPayload.NODES] or [])
+        if EventPayload.CHUNKS in payload:
+            span.attributes["num_chunks"] = len(payload[EventPayload.CHUNKS] or [])
+        trace.add_span(span)
+
+    def start_trace(self, trace_id: Optional[str] = None) -> None:
+        """Run when an overall trace is launched."""
+
+    def end_trace(
+        self,
+        trace_id: Optional[str] = None,
+        trace_map: Optional[Dict[str, List[str]]] = None,
+    ) -> None:
+        """Run when an overall trace is exited."""
+
+
+class SpanExporter(ABC):
+    """Exports the finished request traces."""
+
+    @abstractmethod
+    def export(self, trace: RequestTrace) -> None:
+        """Export a finished trace. Called on the request path, so it must not block for long."""
+
+    def shutdown(self) -> None:
+        """Flush the pending exports and release the resources of the exporter."""
+
+
+class InMemorySpanExporter(SpanExporter):
+    """
+    Keeps the last max_traces traces in a ring buffer, e.g. to inspect the slow requests of a running server.
+
+    Parameters:
+        max_traces: The number of traces kept, the oldest ones are dropped first.
+    """
+
+    def __init__(self, max_traces: int = DEFAULT_MAX_TRACES) -> None:
+        self._traces = deque(maxlen=max_traces)
+        self._lock = threading.Lock()
+
+    def export(self, trace: RequestTrace) -> None:
+        with self._lock:
+            self._traces.append(trace)
+
+    def get_traces(self, limit: Optional[int] = None) -> List[RequestTrace]:
+        """Get the last traces, the most recent first."""
+        with self._lock:
+            traces = list(reversed(self._traces))
+        return traces if limit is None else traces[:limit]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._traces.clear()
+
+
+class JSONLSpanExporter(SpanExporter):
+    """
+    Appends each trace with its spans as a line of JSON to a local file.
+
+    Parameters:
+        path: The path of the file.
+    """
+
+    def __init__(self, path: str = "./traces.jsonl") -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8")
+
+    def export(self, trace: RequestTrace) -> None:
+        line = json.dumps(trace.to_dict(), default=str) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def shutdown(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+def _to_otlp_attributes(attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+    otlp_attributes = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            otlp_value = {"boolValue": value}
+        elif isinstance(value, int):
+            otlp_value = {"intValue": str(value)}
+        elif isinstance(value, float):
+            otlp_value = {"doubleValue": value}
+        else:
+            otlp_value = {"stringValue": str(value)}
+        otlp_attributes.append({"key": key, "value": otlp_value})
+    return otlp_attributes
+
+
+def _to_otlp_span(
+        trace: RequestTrace, name: str, span_id: str, parent_span_id: Optional[str], start_time: float,
+        end_time: float, attributes: Dict[str, Any], error: Optional[str]) -> Dict[str, Any]:
+    otlp_span = {
+        "traceId": trace.trace_id,
+        "spanId": span_id,
+        "name": name,
+        "kind": OTLP_SPAN_KIND_INTERNAL,
+        "startTimeUnixNano": str(int(start_time * 1e9)),
+        "endTimeUnixNano": str(int(end_time * 1e9)),
+        "attributes": _to_otlp_attributes(attributes),
+        "status": {
+            "code": OTLP_STATUS_ERROR,
+            "message": error
+        } if error else {
+            "code": OTLP_STATUS_OK
+        },
+    }
+    if parent_span_id is not None:
+        otlp_span["parentSpanId"] = parent_span_id
+    return otlp_span
+
+
+def to_otlp_payload(traces: Sequence[RequestTrace], service_name: str = "autollm") -> Dict[str, Any]:
+    """
+    Convert traces to an OTLP/HTTP JSON export request, with a root span per request.
+
+    Parameters:
+        traces (Sequence[RequestTrace]): The finished traces.
+        service_name (str): The service.name resource attribute.
+
+    Returns:
+        Dict[str, Any]: The ExportTraceServiceRequest as JSON.
+    """
+    otlp_spans = []
+    for trace in traces:
+        otlp_spans.append(
+            _to_otlp_span(
+                trace, trace.name, trace.span_id, None, trace.start_time,
+                trace.start_time + trace.duration_seconds, trace.attributes, None))
+        otlp_spans.extend(
+            _to_otlp_span(
+                trace, span.name, span.span_id, span.parent_span_id, span.start_time, span.end_time,
+                span.attributes, span.error) for span in trace.get_spans())
+
+    return {
+        "resourceSpans": [{
+            "resource": {
+                "attributes": _to_otlp_attributes({"service.name": service_name})
+            },
+            "scopeSpans": [{
+                "scope": {
+                    "name": "autollm"
+                },
+                "spans": otlp_spans
+            }],
+        }]
+    }
+
+
+class OTLPSpanExporter(SpanExporter):
+    """
+    Sends each trace to an OpenTelemetry collector (or any service accepting OTLP/HTTP JSON, e.g. Jaeger or
+    Tempo) from a dedicated thread, so that the requests never wait for the collector. Traces are dropped with
+    a warning when max_pending_exports are already waiting to be sent.
+
+    Parameters:
+        endpoint: The OTLP/HTTP traces endpoint of the collector.
+        headers: The HTTP headers of the export requests, e.g. for authentication.
+        service_name: The service.name resource attribute of the spans.
+        timeout_seconds: The timeout of an export request.
+        max_pending_exports: The maximum number of traces waiting to be sent.
+    """
+
+    def __init__(
+            self,
+            endpoint: str = DEFAULT_OTLP_ENDPOINT,
+            headers: Optional[Dict[str, str]] = None,
+            service_name: str = "autollm",
+            timeout_seconds: float = 10.0,
+            max_pending_exports: int = DEFAULT_MAX_PENDING_EXPORTS) -> None:
+        self.endpoint = endpoint
+        self.headers = headers or {}
+        self.service_name = service_name
+        self.timeout_seconds = timeout_seconds
+        self.max_pending_exports = max_pending_exports
+        self._pending_exports = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="autollm-tracing")
+
+    def export(self, trace: RequestTrace) -> None:
+        with self._lock:
+            if self._pending_exports >= self.max_pending_exports:
+                logger.warning(
+                    f"Dropping trace {trace.trace_id}, {self._pending_exports} traces wait to be sent.")
+                return
+            self._pending_exports += 1
+        self._executor.submit(self._send, trace)
+
+    def _send(self, trace: RequestTrace) -> None:
+        try:
+            response = httpx.post(
+                self.endpoint,
+                json=to_otlp_payload([trace], service_name=self.service_name),
+                headers=self.headers,
+                timeout=self.timeout_seconds)
+            response.raise_for_status()
+        except Exception as e:
+            logger.warning(f"Could not export trace {trace.trace_id} to {self.endpoint}: {e}")
+        finally:
+            with self._lock:
+                self._pending_exports -= 1
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
+
+
+SPAN_EXPORTERS = {"memory": InMemorySpanExporter, "jsonl": JSONLSpanExporter, "otlp": OTLPSpanExporter}
+
+
+class Tracer:
+    """
+    Starts a trace per request and exports it when the request finished.
+
+    Parameters:
+        exporter: The exporter of the finished traces.
+        server_timing: Flag to send the stage durations of the requests in a Server-Timing response header.
+    """
+
+    def __init__(self, exporter: SpanExporter, server_timing: bool = False) -> None:
+        self.exporter = exporter
+        self.server_timing = server_timing
+
+    def start_trace(self, name: str, attributes: Optional[Dict[str, Any]] = None) -> RequestTrace:
+        return RequestTrace(name=name, attributes=dict(attributes or {}))
+
+    def end_trace(self, trace: RequestTrace) -> None:
+        if trace.end_time is not None:
+            return
+        trace.end_time = time.time()
+        try:
+            self.exporter.export(trace)
+        except Exception:
+            logger.exception(f"Could not export trace {trace.trace_id}.")
+
+
+def create_tracer(tracing: Union[None, bool, dict]) -> Optional[Tracer]:
+    """
+    Create a tracer from its config.
+
+    Parameters:
+        tracing: True to keep the traces in memory, or a dict with the "exporter" ("memory", "jsonl" or
+            "otlp"), "server_timing" and the keyword arguments of the exporter (e.g.
+            {"exporter": "jsonl", "path": "./traces.jsonl", "server_timing": true}). None or False disables
+            tracing.
+
+    Returns:
+        Tracer: The tracer, or None.
+    """
+    if not tracing:
+        return None
+
+    tracing_kwargs = {} if tracing is True else dict(tracing)
+    server_timing = tracing_kwargs.pop("server_timing", False)
+    exporter_type = tracing_kwargs.pop("exporter", "memory")
+    if exporter_type not in SPAN_EXPORTERS:
+        raise ValueError(f"Unknown span exporter: {exporter_type}. Use one of {list(SPAN_EXPORTERS)}.")
+    return Tracer(SPAN_EXPORTERS[exporter_type](**tracing_kwargs), server_timing=server_timing)
@@ -0,0 +1,122 @@
+"""Per-request LLM usage tracking based on context variables."""
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Dict, Generator, List, Optional
+
+from llama_index.callbacks.base_handler import BaseCallbackHandler
+from llama_index.callbacks.schema import CBEventType, EventPayload
+
+from autollm.callbacks.cost_calculating import get_llm_usage
+
+
+@dataclass
+class RequestUsage:
+    """LLM usage accumulated during a single request."""
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cost_usd: float = 0.0
+    llm_calls: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def add(self, prompt_tokens: int, completion_tokens: int, cost_usd: float) -> None:
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.cost_usd += cost_usd
+            self.llm_calls += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.total_tokens,
+            "cost_usd": self.cost_usd,
+            "llm_calls": self.llm_calls,
+        }
+
+
+current_request_usage: ContextVar[Optional[RequestUsage]] = ContextVar("current_request_usage", default=None)
+
+
+@contextmanager
+def track_request_usage(usage: Optional[RequestUsage] = None) -> Generator[RequestUsage, None, None]:
+    """
+    Collect the usage of all LLM calls made in the current context (and the threads/tasks spawned from it).
+
+    ```python
+    with track_request_usage() as usage:
+        query_engine.query("why so serious?")
+    print(usage.total_tokens, usage.cost_usd)
+    ```
+
+    Parameters:
+        usage (RequestUsage): An existing usage to keep adding to, e.g. while consuming a streamed response in
+            another context than the one the request started in.
+    """
+    usage = usage if usage is not None else RequestUsage()
+    token = current_request_usage.set(usage)
+    try:
+        yield usage
+    finally:
+        current_request_usage.reset(token)
+
+
+class UsageTrackingHandler(BaseCallbackHandler):
+    """
+    Callback handler adding the token usage and cost of each LLM call to the usage of the current request.
+
+    LLM calls made outside of track_request_usage are ignored.
+
+    Parameters:
+        model_name: The model used for pricing when the LLM event does not carry the model name.
+    """
+
+    def __init__(self, model_name: str = "gpt-3.5-turbo") -> None:
+        self.model_name = model_name
+        self._llm_models: Dict[str, Optional[str]] = {}
+
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+
+    def on_event_start(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        parent_id: str = "",
+        **kwargs: Any,
+    ) -> str:
+        if event_type == CBEventType.LLM and current_request_usage.get() is not None:
+            self._llm_models[event_id] = ((payload or {}).get(EventPayload.SERIALIZED) or {}).get("model")
+        return event_id
+
+    def on_event_end(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]] = None,
+        event_id: str = "",
+        **kwargs: Any,
+    ) -> None:
+        if event_type != CBEventType.LLM or event_id not in self._llm_models:
+            return
+        model_name = self._llm_models.pop(event_id) or self.model_name
+        usage = current_request_usage.get()
+        if usage is None or payload is None or EventPayload.EXCEPTION in payload:
+            return
+
+        usage.add(*get_llm_usage(payload, model=model_name))
+
+    def start_trace(self, trace_id: Optional[str] = None) -> None:
+        """Run when an overall trace is launched."""
+
+    def end_trace(
+        self,
+        trace_id: Optional[str] = None,
+        trace_map: Optional[Dict[str, List[str]]] = None,
+    ) -> None:
+        """Run when an overall trace is exited."""
@@ -0,0 +1,209 @@
+"""Per-task admission control: bounded concurrency with a bounded, deadline-limited wait queue."""
+import asyncio
+import math
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, Deque, Dict, Optional
+
+DEFAULT_MAX_CONCURRENCY = 8
+DEFAULT_MAX_QUEUE_SIZE = 32
+DEFAULT_MAX_QUEUE_SECONDS = 10.0
+# The smoothing factor of the moving average of the time a request holds its slot
+SERVICE_TIME_EWMA_ALPHA = 0.2
+# The initial service time estimate, before a request of the task finished
+DEFAULT_SERVICE_SECONDS = 1.0
+
+
+class AdmissionRejectedError(Exception):
+    """Raised when a request is not admitted: 429 when the wait queue is full, 503 when it waited too long."""
+
+    def __init__(self, message: str, status_code: int, retry_after: float) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+@dataclass
+class AdmissionLimit:
+    """The concurrent requests of a task, the requests waiting for a slot and the time they may wait."""
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY
+    max_queue_size: int = DEFAULT_MAX_QUEUE_SIZE
+    max_queue_seconds: float = DEFAULT_MAX_QUEUE_SECONDS
+
+
+class AdmissionTicket:
+    """The slot of an admitted request. Release it once the request finished, releasing again does nothing."""
+
+    def __init__(self, release: Callable[[], None]) -> None:
+        self._release = release
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._release()
+
+
+class _TaskQueue:
+    """The slots of a task and its requests waiting for a slot, in arrival order."""
+
+    def __init__(self, limit: AdmissionLimit) -> None:
+        self.limit = limit
+        self.running = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+        self.service_seconds = DEFAULT_SERVICE_SECONDS
+
+    def estimate_wait(self) -> float:
+        """Estimate the seconds until a new request would get a slot."""
+        return self.service_seconds * (len(self.waiters) + 1) / self.limit.max_concurrency
+
+    def release(self, service_seconds: float) -> None:
+        self.service_seconds += SERVICE_TIME_EWMA_ALPHA * (service_seconds - self.service_seconds)
+        # Hand the slot over to the first waiter still waiting
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.running -= 1
+
+
+class AdmissionController:
+    """
+    Limits the concurrent requests of each task. The requests over the limit wait in a bounded queue, in
+    arrival order, for at most max_queue_seconds.
+
+    A request arriving to a full queue is rejected right away with 429, and a request that waited too long is
+    rejected with 503, both with an estimate of the seconds to wait before retrying. Under overload, requests
+    are rejected quickly instead of piling up, so the admitted ones keep their latency.
+
+    ```python
+    admission_controller = AdmissionController.from_config({
+        "max_concurrency": 8, "max_queue_size": 32, "max_queue_seconds": 10,
+        "tasks": {"qa": {"max_concurrency": 2}},
+    })
+    ticket = await admission_controller.acquire("qa")
+    try:
+        ...
+    finally:
+        ticket.release()
+    ```
+
+    Parameters:
+        default_limit: The limits of the tasks without their own entry. None does not limit them.
+        task_limits: The limits by task name.
+        on_change: Called with the task name, the number of running requests and the queue depth when they
+            change, e.g. to update metrics.
+    """
+
+    def __init__(
+            self,
+            default_limit: Optional[AdmissionLimit] = None,
+            task_limits: Optional[Dict[str, AdmissionLimit]] = None,
+            on_change: Optional[Callable[[str, int, int], None]] = None) -> None:
+        self.default_limit = default_limit
+        self.task_limits = task_limits or {}
+        self.on_change = on_change
+        self._queues: Dict[str, _TaskQueue] = {}
+
+    @classmethod
+    def from_config(
+            cls,
+            admission_config: dict,
+            on_change: Optional[Callable[[str, int, int], None]] = None) -> "AdmissionController":
+        """
+        Create an AdmissionController from the "admission" section of config.yaml.
+
+        Parameters:
+            admission_config (dict): Mapping with the default "max_concurrency", "max_queue_size" and
+                "max_queue_seconds", and a "tasks" mapping of task names to their own limits.
+            on_change (Callable): Called with the task name, the running requests and the queue depth.
+
+        Returns:
+            AdmissionController: The initialized admission controller.
+        """
+        default_limit = AdmissionLimit(
+            max_concurrency=admission_config.get("max_concurrency", DEFAULT_MAX_CONCURRENCY),
+            max_queue_size=admission_config.get("max_queue_size", DEFAULT_MAX_QUEUE_SIZE),
+            max_queue_seconds=admission_config.get("max_queue_seconds", DEFAULT_MAX_QUEUE_SECONDS))
+        task_limits = {
+            name:
+            AdmissionLimit(
+                max_concurrency=params.get("max_concurrency", default_limit.max_concurrency),
+                max_queue_size=params.get("max_queue_size", default_limit.max_queue_size),
+                max_queue_seconds=params.get("max_queue_seconds", default_limit.max_queue_seconds))
+            for name, params in (admission_config.get("tasks") or {}).items()
+        }
+        return cls(default_limit=default_limit, task_limits=task_limits, on_change=on_change)
+
+    def _get_queue(self, task: str) -> Optional[_TaskQueue]:
+        queue = self._queues.get(task)
+        if queue is None:
+            limit = self.task_limits.get(task, self.default_limit)
+            if limit is None:
+                return None
+            queue = self._queues[task] = _TaskQueue(limit)
+        return queue
+
+    def _notify(self, task: str, queue: _TaskQueue) -> None:
+        if self.on_change is not None:
+            self.on_change(task, queue.running, sum(not waiter.done() for waiter in queue.waiters))
+
+    async def acquire(self, task: str) -> AdmissionTicket:
+        """
+        Wait for a slot of the task.
+
+        Raises:
+            AdmissionRejectedError: If the wait queue of the task is full, or the request waited too long.
+        """
+        queue = self._get_queue(task)
+        if queue is None:
+            return AdmissionTicket(lambda: None)
+
+        if queue.running < queue.limit.max_concurrency:
+            queue.running += 1
+        else:
+            if len(queue.waiters) >= queue.limit.max_queue_size:
+                retry_after = queue.estimate_wait()
+                raise AdmissionRejectedError(
+                    f"Too many requests for task '{task}'. Retry after {math.ceil(retry_after)} seconds.",
+                    status_code=429,
+                    retry_after=retry_after)
+
+            waiter = asyncio.get_running_loop().create_future()
+            queue.waiters.append(waiter)
+            self._notify(task, queue)
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter), timeout=queue.limit.max_queue_seconds)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if waiter.done() and not waiter.cancelled():
+                    # The slot was handed over just as the wait ended, pass it on
+                    queue.release(queue.service_seconds)
+                else:
+                    waiter.cancel()
+                    queue.waiters.remove(waiter)
+                self._notify(task, queue)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                retry_after = queue.estimate_wait()
+                raise AdmissionRejectedError(
+                    f"Task '{task}' is overloaded. Retry after {math.ceil(retry_after)} seconds.",
+                    status_code=503,
+                    retry_after=retry_after)
+
+        self._notify(task, queue)
+        start_time = time.monotonic()
+
+        def release() -> None:
+            queue.release(time.monotonic() - start_time)
+            self._notify(task, queue)
+
+        return AdmissionTicket(release)
+
+    def get_status(self, task: str) -> Dict[str, int]:
+        """Get the number of running and waiting requests of a task."""
+        queue = self._queues.get(task)
+        if queue is None:
+            return {"running": 0, "queued": 0}
+        return {"running": queue.running, "queued": sum(not waiter.done() for waiter in queue.waiters)}
@@ -0,0 +1,121 @@
+"""
+Build the LanceDB indexes of the tasks of config.yaml once, for the read-only serving workers of AutoFastAPI.
+
+```bash
+python -m autollm.serve.build config.yaml --input-dir docs/
+# app.py: app = AutoFastAPI.from_config("config.yaml", read_only=True)
+gunicorn app:app -k uvicorn.workers.UvicornWorker -w 4 --preload
+```
+"""
+import argparse
+from typing import Dict, List, Optional, Sequence
+
+from llama_index import Document
+
+from autollm.auto.query_engine import AutoQueryEngine
+from autollm.serve.utils import get_index_sharing_key, get_task_name_to_params
+from autollm.utils.document_reading import read_files_as_documents
+from autollm.utils.env_utils import load_config_and_dotenv
+from autollm.utils.lancedb_vectorstore import LanceDBVectorStore
+from autollm.utils.logging import logger
+
+
+def build_indexes(
+        config_file_path: str,
+        documents: Sequence[Document],
+        env_file_path: Optional[str] = None,
+        overwrite_existing: bool = False) -> Dict[str, List[str]]:
+    """
+    Ingest the documents into the LanceDB table of each task, once per index shared by tasks with the same
+    ingestion settings. The documents are added to the existing tables at the configured lancedb_uri, never to
+    a new incremented database, so that the serving workers find them. Documents already in a table with the
+    same doc_id (the file path of the documents read from files) are replaced, so rebuilding does not
+    duplicate them. The full-text index of the hybrid search tasks is built too, since read-only workers do
+    not build it.
+
+    Parameters:
+        config_file_path (str): Path to the YAML configuration file.
+        documents (Sequence[Document]): The documents to ingest.
+        env_file_path (str): Path to the .env file.
+        overwrite_existing (bool): Flag to delete the existing databases before ingesting.
+
+    Returns:
+        Dict[str, List[str]]: The task names of each built database uri.
+    """
+    config = load_config_and_dotenv(config_file_path, env_file_path)
+    task_name_to_params = get_task_name_to_params(config)
+
+    built_indexes: Dict[str, List[str]] = {}
+    built_index_keys = set()
+    for task_name, task_params in task_name_to_params.items():
+        if task_params.get("vector_store_type", "LanceDBVectorStore") != "LanceDBVectorStore":
+            logger.warning(f"Skipping task '{task_name}', only LanceDB indexes can be shared by the workers.")
+            continue
+        index_key = get_index_sharing_key(task_params)
+        lancedb_uri = task_params.get("lancedb_uri", "./.lancedb")
+        if index_key in built_index_keys:
+            built_indexes[lancedb_uri].append(task_name)
+            continue
+
+        logger.info(f"Building the index of task '{task_name}' at {lancedb_uri}.")
+        task_params = dict(
+            task_params,
+            exist_ok=True,
+            # Delete a database once, tasks with different tables in it are built after
+            overwrite_existing=overwrite_existing and lancedb_uri not in built_indexes)
+        if not task_params["overwrite_existing"]:
+            delete_existing_documents(task_params, documents)
+        # The full-text index of a hybrid search task is built with its index
+        AutoQueryEngine.from_defaults(documents=documents, **task_params)
+        built_index_keys.add(index_key)
+        built_indexes.setdefault(lancedb_uri, []).append(task_name)
+
+    return built_indexes
+
+
+def delete_existing_documents(task_params: dict, documents: Sequence[Document]) -> None:
+    """
+    Delete the documents with the doc_ids of the given documents from the LanceDB table of a task, if any.
+
+    Parameters:
+        task_params (dict): The parameters of the task.
+        documents (Sequence[Document]): The documents about to be ingested.
+    """
+    vector_store = LanceDBVectorStore(
+        uri=task_params.get("lancedb_uri", "./.lancedb"),
+        table_name=task_params.get("lancedb_table_name", "vectors"),
+        api_key=task_params.get("lancedb_api_key"),
+        region=task_params.get("lancedb_region"))
+    if vector_store.table_name not in vector_store.connection.table_names():
+        return
+    logger.info(
+        f"Replacing the documents already in table '{vector_store.table_name}' at {vector_store.uri}.")
+    vector_store.delete_documents([document.doc_id for document in documents])
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Build the LanceDB indexes of the tasks of config.yaml for read-only serving workers.")
+    parser.add_argument("config_file_path", help="Path to the YAML configuration file.")
+    parser.add_argument("--env-file-path", default=None, help="Path to the .env file.")
+    parser.add_argument("--input-dir", default=None, help="Directory of the documents to ingest.")
+    parser.add_argument("--input-files", nargs="+", default=None, help="Files to ingest.")
+    parser.add_argument(
+        "--overwrite-existing", action="store_true", help="Delete the existing databases before ingesting.")
+    args = parser.parse_args(argv)
+
+    if args.input_dir is None and args.input_files is None:
+        parser.error("one of --input-dir or --input-files is required")
+
+    documents = read_files_as_documents(input_dir=args.input_dir, input_files=args.input_files)
+    built_indexes = build_indexes(
+        args.config_file_path,
+        documents,
+        env_file_path=args.env_file_path,
+        overwrite_existing=args.overwrite_existing)
+    for lancedb_uri, task_names in built_indexes.items():
+        logger.info(f"Built {lancedb_uri} for tasks {task_names}.")
+
+
+if __name__ == "__main__":
+    main()
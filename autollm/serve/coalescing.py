@@ -0,0 +1,171 @@
+"""Single-flight coalescing of identical in-flight queries."""
+import asyncio
+import contextvars
+from typing import AsyncGenerator, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional, TypeVar
+
+from autollm.utils.deadlines import SharedDeadline, get_deadline, shared_deadline_scope
+
+T = TypeVar("T")
+
+
+def normalize_query(query: str) -> str:
+    """Normalize a query for coalescing: case and whitespace differences do not change the answer."""
+    return " ".join(query.split()).lower()
+
+
+class _Execution:
+    """
+    A shared execution counting its waiters, cancelled when the last waiter leaves before it finishes.
+
+    The execution starts in an empty context, so that it does not run with the context variables of the
+    request that started it (e.g. its deadline), and its deadline is the latest deadline of its waiters.
+    """
+
+    def __init__(self, start: Callable[[], Awaitable]) -> None:
+        self.waiters = 0
+        self.deadline = SharedDeadline()
+        self.task = contextvars.Context().run(self._start, start)
+
+    def _start(self, start: Callable[[], Awaitable]) -> asyncio.Future:
+        with shared_deadline_scope(self.deadline):
+            return asyncio.ensure_future(start())
+
+    def join(self) -> None:
+        self.waiters += 1
+        self.deadline.extend(get_deadline())
+
+    def release(self) -> None:
+        self.waiters -= 1
+        if self.waiters == 0 and not self.task.done():
+            self.task.cancel()
+
+
+class _StreamBroadcast(_Execution):
+    """Consumes a stream once and replays its items to every subscriber, from the first item on."""
+
+    def __init__(self, func: Callable[[], AsyncIterator[str]]) -> None:
+        self.items: List[str] = []
+        self.error: Optional[BaseException] = None
+        self.finished = False
+        self._changed = asyncio.Condition()
+        super().__init__(lambda: self._consume(func))
+
+    async def _consume(self, func: Callable[[], AsyncIterator[str]]) -> None:
+        try:
+            async for item in func():
+                async with self._changed:
+                    self.items.append(item)
+                    self._changed.notify_all()
+        except BaseException as e:
+            self.error = e
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        finally:
+            self.finished = True
+            async with self._changed:
+                self._changed.notify_all()
+
+    async def wait_started(self) -> None:
+        """Wait for the first item, raise the error of the stream if it failed before its first item."""
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.items or self.finished)
+        if not self.items and self.error is not None:
+            raise self.error
+
+    async def subscribe(self) -> AsyncGenerator[str, None]:
+        position = 0
+        try:
+            while True:
+                async with self._changed:
+                    await self._changed.wait_for(lambda: position < len(self.items) or self.finished)
+                    new_items = self.items[position:]
+                position += len(new_items)
+                for item in new_items:
+                    yield item
+                if self.finished and position >= len(self.items):
+                    if self.error is not None and not isinstance(self.error, asyncio.CancelledError):
+                        raise self.error
+                    return
+        finally:
+            self.release()
+
+
+class QueryCoalescer:
+    """
+    Runs concurrent identical queries once and shares the result with all of their requests.
+
+    Requests with the same key attach to the in-flight execution instead of starting their own. Streaming
+    subscribers get every item of the shared stream, including the ones produced before they attached. An
+    execution keeps running while any of its requests waits for it, and is cancelled when all of them are
+    gone. It runs with the latest deadline of its requests and without their other context variables, func
+    sets the ones it needs.
+
+    ```python
+    coalescer = QueryCoalescer()
+    key = ("qa", normalize_query(user_query))
+    response = await coalescer.run(key, lambda: query_engine.aquery(user_query))
+    ```
+    """
+
+    def __init__(self) -> None:
+        self._executions: Dict[Hashable, _Execution] = {}
+        self._streams: Dict[Hashable, _StreamBroadcast] = {}
+
+    def is_inflight(self, key: Hashable, streaming: bool = False) -> bool:
+        return key in (self._streams if streaming else self._executions)
+
+    async def run(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        """
+        Get the result of the in-flight execution with the given key, or start one with func.
+
+        Parameters:
+            key (Hashable): The coalescing key of the execution.
+            func (Callable): Starts the execution, called only when no execution with the key is in flight.
+
+        Returns:
+            The result of the shared execution.
+        """
+        execution = self._executions.get(key)
+        if execution is None:
+            execution = self._executions[key] = _Execution(func)
+            execution.task.add_done_callback(lambda task: self._remove(self._executions, key, execution))
+
+        execution.join()
+        try:
+            return await asyncio.shield(execution.task)
+        finally:
+            execution.release()
+
+    async def stream(self, key: Hashable, func: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """
+        Subscribe to the in-flight stream with the given key, or start one with func.
+
+        Waits for the first item of the stream, so that a failure before the stream started is raised here.
+
+        Parameters:
+            key (Hashable): The coalescing key of the stream.
+            func (Callable): Creates the stream, called only when no stream with the key is in flight.
+
+        Returns:
+            AsyncIterator[str]: The items of the shared stream.
+        """
+        broadcast = self._streams.get(key)
+        if broadcast is None:
+            broadcast = self._streams[key] = _StreamBroadcast(func)
+            broadcast.task.add_done_callback(lambda task: self._remove(self._streams, key, broadcast))
+
+        broadcast.join()
+        try:
+            await broadcast.wait_started()
+        except BaseException:
+            broadcast.release()
+            raise
+        return broadcast.subscribe()
+
+    @staticmethod
+    def _remove(executions: Dict[Hashable, _Execution], key: Hashable, execution: _Execution) -> None:
+        if executions.get(key) is execution:
+            del executions[key]
+        # the waiters got the exception, do not log it as never retrieved
+        if not execution.task.cancelled():
+            execution.task.exception()
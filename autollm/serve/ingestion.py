@@ -0,0 +1,334 @@
+"""Background ingestion jobs writing documents into the live index of a task in committed batches."""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, List, Optional, Sequence, Union
+from urllib.parse import urlsplit
+
+from llama_index import Document, VectorStoreIndex
+from llama_index.ingestion import run_transformations
+
+from autollm.utils.document_reading import read_files_as_documents, read_webpage_as_documents
+from autollm.utils.lancedb_vectorstore import LanceDBVectorStore
+from autollm.utils.logging import logger
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+
+# The documents chunked, embedded and written to the vector store at a time, as one commit of the table
+DEFAULT_INGESTION_BATCH_SIZE = 16
+DEFAULT_MAX_PENDING_JOBS = 16
+# The finished jobs kept for their status, the oldest ones are dropped first
+MAX_FINISHED_JOBS = 100
+
+
+class IngestionQueueFullError(Exception):
+    """Raised when an ingestion job is submitted while too many jobs are waiting or running."""
+
+
+class IngestionSourceError(ValueError):
+    """Raised when an ingestion job reads a path outside the allowed root or a URL that is not allowed."""
+
+
+@dataclass
+class IngestionJob:
+    """The progress of an ingestion job. The counters are updated by the ingestion thread after each batch."""
+    job_id: str
+    task: str
+    status: str = JOB_QUEUED
+    total_documents: Optional[int] = None
+    ingested_documents: int = 0
+    ingested_nodes: int = 0
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    error: Optional[str] = None
+
+    def get_status(self) -> dict:
+        """Get the status of the job with its throughput and the estimated seconds until it finishes."""
+        documents_per_second = None
+        eta_seconds = None
+        if self.started_at is not None:
+            elapsed_seconds = (self.finished_at or time.time()) - self.started_at
+            if elapsed_seconds > 0 and self.ingested_documents:
+                documents_per_second = self.ingested_documents / elapsed_seconds
+        if self.status == JOB_RUNNING and self.total_documents is not None and documents_per_second:
+            eta_seconds = (self.total_documents - self.ingested_documents) / documents_per_second
+
+        return {
+            "job_id": self.job_id,
+            "task": self.task,
+            "status": self.status,
+            "total_documents": self.total_documents,
+            "ingested_documents": self.ingested_documents,
+            "ingested_nodes": self.ingested_nodes,
+            "documents_per_second": documents_per_second,
+            "eta_seconds": eta_seconds,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+        }
+
+
+def read_ingestion_documents(
+        input_files: Optional[List[str]] = None,
+        input_dir: Optional[str] = None,
+        urls: Optional[List[str]] = None,
+        allow_redirects: bool = True) -> List[Document]:
+    """
+    Read the documents of an ingestion job from files, a directory and web pages.
+
+    Parameters:
+        input_files (List[str]): Paths of the files to read.
+        input_dir (str): Path of the directory to read recursively.
+        urls (List[str]): URLs of the web pages to read.
+        allow_redirects (bool): Whether the web pages are read after a redirect, which may lead to any URL.
+
+    Returns:
+        List[Document]: The documents.
+    """
+    documents = []
+    if input_files or input_dir:
+        documents.extend(
+            read_files_as_documents(
+                input_dir=input_dir, input_files=input_files or None, show_progress=False))
+    for url in urls or []:
+        documents.extend(read_webpage_as_documents(url, allow_redirects=allow_redirects))
+    return documents
+
+
+def ingest_documents(
+        index: VectorStoreIndex,
+        documents: Sequence[Document],
+        batch_size: int = DEFAULT_INGESTION_BATCH_SIZE,
+        on_batch: Optional[Callable[[int, int], None]] = None) -> None:
+    """
+    Chunk, embed and insert documents into an index in batches, with the transformations of its service
+    context (the node parser and the metadata extractors of the task).
+
+    Each batch is written to the vector store at once, so that it is visible to the queries as soon as it is
+    inserted, and the memory used is bounded by the batch size. LanceDB tables are read live by the queries,
+    the retrievers of a SimpleVectorStore index only search the nodes the index had when they were created.
+    The nodes of the documents already in the index with the same doc_id (the file path of the documents read
+    from files) are deleted before their batch is inserted, so ingesting a document again replaces it.
+
+    Parameters:
+        index (VectorStoreIndex): The index to insert the documents into.
+        documents (Sequence[Document]): The documents to ingest.
+        batch_size (int): The number of documents inserted at a time.
+        on_batch (Callable): Called with the number of documents and nodes after each inserted batch.
+    """
+    for start in range(0, len(documents), batch_size):
+        batch = list(documents[start:start + batch_size])
+        nodes = run_transformations(batch, index.service_context.transformations)
+        delete_documents(index, [document.doc_id for document in batch])
+        index.insert_nodes(nodes)
+        if on_batch is not None:
+            on_batch(len(batch), len(nodes))
+
+
+def delete_documents(index: VectorStoreIndex, doc_ids: Sequence[str]) -> None:
+    """
+    Delete the nodes of documents from an index, in a single write of the table for LanceDB.
+
+    Parameters:
+        index (VectorStoreIndex): The index to delete the documents from.
+        doc_ids (Sequence[str]): The ids of the documents, the ones not in the index are ignored.
+    """
+    if isinstance(index.vector_store, LanceDBVectorStore):
+        index.vector_store.delete_documents(doc_ids)
+        return
+    for doc_id in doc_ids:
+        index.delete_ref_doc(doc_id, delete_from_docstore=True)
+
+
+class IngestionManager:
+    """
+    Runs ingestion jobs in the background, in a dedicated thread so that the thread pool serving the queries
+    is never taken by ingestion. Jobs run one at a time in submission order, and at most max_pending_jobs wait
+    or run at once.
+
+    ```python
+    ingestion_manager = IngestionManager()
+    job = ingestion_manager.submit(
+        "qa", get_index=lambda: query_engine.vector_store_index,
+        read_documents=lambda: read_ingestion_documents(input_dir="docs/"))
+    print(ingestion_manager.get(job.job_id).get_status())
+    ```
+
+    Parameters:
+        batch_size: The number of documents inserted into the index at a time.
+        max_pending_jobs: The maximum number of queued and running jobs.
+        on_batch: Called with the task name and the number of documents after each inserted batch, e.g. to
+            update metrics.
+        allowed_root: The directory the ingested files must be in, relative paths are read from it. Files are
+            not ingested without it.
+        allowed_urls: The URL prefixes the ingested web pages must start with (e.g.
+            "https://docs.example.com/"). Web pages are not ingested without them.
+    """
+
+    def __init__(
+            self,
+            batch_size: int = DEFAULT_INGESTION_BATCH_SIZE,
+            max_pending_jobs: int = DEFAULT_MAX_PENDING_JOBS,
+            on_batch: Optional[Callable[[str, int], None]] = None,
+            allowed_root: Optional[str] = None,
+            allowed_urls: Optional[Sequence[str]] = None) -> None:
+        if batch_size < 1 or max_pending_jobs < 1:
+            raise ValueError("batch_size and max_pending_jobs must be at least 1")
+
+        self.batch_size = batch_size
+        self.max_pending_jobs = max_pending_jobs
+        self.on_batch = on_batch
+        self.allowed_root = Path(allowed_root).resolve() if allowed_root else None
+        self.allowed_urls = [urlsplit(url) for url in allowed_urls or []]
+        for allowed_url in self.allowed_urls:
+            if allowed_url.scheme not in ("http", "https") or not allowed_url.netloc:
+                raise ValueError(f"allowed_urls must be http or https URLs, got '{allowed_url.geturl()}'")
+        self._jobs: "OrderedDict[str, IngestionJob]" = OrderedDict()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="autollm-ingestion")
+        self._lock = threading.Lock()
+
+    def submit(
+            self, task: str, get_index: Callable[[], VectorStoreIndex],
+            read_documents: Callable[[], Sequence[Document]]) -> IngestionJob:
+        """
+        Queue an ingestion job.
+
+        Parameters:
+            task (str): The name of the task whose index gets the documents.
+            get_index (Callable): Gets the index to insert the documents into, called when the job starts.
+            read_documents (Callable): Reads the documents, called when the job starts.
+
+        Returns:
+            IngestionJob: The queued job.
+
+        Raises:
+            IngestionQueueFullError: If max_pending_jobs jobs are already waiting or running.
+        """
+        with self._lock:
+            pending_jobs = sum(job.status in (JOB_QUEUED, JOB_RUNNING) for job in self._jobs.values())
+            if pending_jobs >= self.max_pending_jobs:
+                raise IngestionQueueFullError(
+                    f"Too many ingestion jobs, {pending_jobs} are already waiting or running")
+            job = IngestionJob(job_id=uuid.uuid4().hex, task=task)
+            self._jobs[job.job_id] = job
+            self._drop_finished_jobs()
+
+        self._executor.submit(self._run, job, get_index, read_documents)
+        return job
+
+    def resolve_path(self, path: str) -> str:
+        """
+        Resolve a path to ingest, relative to the allowed root.
+
+        Parameters:
+            path (str): The path of a file or a directory.
+
+        Returns:
+            str: The resolved path, with its symbolic links followed.
+
+        Raises:
+            IngestionSourceError: If no allowed root is configured or the path resolves outside of it.
+        """
+        if self.allowed_root is None:
+            raise IngestionSourceError("Ingesting files is disabled, no allowed_root is configured")
+        resolved_path = (self.allowed_root / path).resolve()
+        if resolved_path != self.allowed_root and self.allowed_root not in resolved_path.parents:
+            raise IngestionSourceError(f"'{path}' is outside of the allowed ingestion root")
+        return str(resolved_path)
+
+    def check_url(self, url: str) -> str:
+        """
+        Check that a web page to ingest starts with one of the allowed URL prefixes.
+
+        Parameters:
+            url (str): The URL of the web page.
+
+        Returns:
+            str: The URL.
+
+        Raises:
+            IngestionSourceError: If the URL is not allowed.
+        """
+        if not self.allowed_urls:
+            raise IngestionSourceError("Ingesting web pages is disabled, no allowed_urls are configured")
+        parsed_url = urlsplit(url)
+        for allowed_url in self.allowed_urls:
+            if (parsed_url.scheme.lower() == allowed_url.scheme.lower() and
+                    parsed_url.netloc.lower() == allowed_url.netloc.lower() and
+                    parsed_url.path.startswith(allowed_url.path)):
+                return url
+        raise IngestionSourceError(f"'{url}' is not an allowed ingestion URL")
+
+    def get(self, job_id: str) -> Optional[IngestionJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list_jobs(self) -> List[IngestionJob]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def _run(
+            self, job: IngestionJob, get_index: Callable[[], VectorStoreIndex],
+            read_documents: Callable[[], Sequence[Document]]) -> None:
+        job.status = JOB_RUNNING
+        job.started_at = time.time()
+        logger.info(f"Running ingestion job {job.job_id} of task '{job.task}'.")
+
+        def on_batch(num_documents: int, num_nodes: int) -> None:
+            job.ingested_documents += num_documents
+            job.ingested_nodes += num_nodes
+            if self.on_batch is not None:
+                self.on_batch(job.task, num_documents)
+
+        try:
+            index = get_index()
+            documents = read_documents()
+            job.total_documents = len(documents)
+            ingest_documents(index, documents, batch_size=self.batch_size, on_batch=on_batch)
+        except Exception as e:
+            logger.exception(f"Ingestion job {job.job_id} of task '{job.task}' failed.")
+            job.error = str(e)
+            job.status = JOB_FAILED
+        else:
+            logger.info(
+                f"Ingestion job {job.job_id} of task '{job.task}' ingested {job.ingested_documents} "
+                "documents.")
+            job.status = JOB_SUCCEEDED
+        finally:
+            job.finished_at = time.time()
+
+    def _drop_finished_jobs(self) -> None:
+        finished_job_ids = [
+            job_id for job_id, job in self._jobs.items() if job.status in (JOB_SUCCEEDED, JOB_FAILED)
+        ]
+        for job_id in finished_job_ids[:max(len(finished_job_ids) - MAX_FINISHED_JOBS, 0)]:
+            del self._jobs[job_id]
+
+
+def create_ingestion_manager(
+        ingestion: Union[None, bool, dict],
+        on_batch: Optional[Callable[[str, int], None]] = None) -> Optional[IngestionManager]:
+    """
+    Create an ingestion manager from its config.
+
+    Parameters:
+        ingestion: True for the default settings, or a dict with the IngestionManager parameters (e.g.
+            {"batch_size": 32, "allowed_root": "./docs"}). None or False disables ingestion.
+        on_batch (Callable): Called with the task name and the number of documents after each inserted batch.
+
+    Returns:
+        IngestionManager: The ingestion manager, or None.
+    """
+    if not ingestion:
+        return None
+    ingestion_kwargs = {} if ingestion is True else ingestion
+    return IngestionManager(on_batch=on_batch, **ingestion_kwargs)
@@ -0,0 +1,358 @@
+"""Lazy, single-flight initialization and zero-downtime reloading of the query engines of config tasks."""
+import asyncio
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from llama_index import Document, VectorStoreIndex
+from llama_index.indices.query.base import BaseQueryEngine
+
+from autollm.auto.query_engine import AutoQueryEngine
+from autollm.serve.utils import get_index_sharing_key
+from autollm.utils.logging import logger
+
+TASK_NOT_LOADED = "not_loaded"
+TASK_LOADING = "loading"
+TASK_LOADED = "loaded"
+TASK_FAILED = "failed"
+
+TASK_ADDED = "added"
+TASK_CHANGED = "changed"
+TASK_UNCHANGED = "unchanged"
+TASK_REMOVED = "removed"
+
+# Builds read, chunk and embed documents for a long time, they get their own threads to keep the shared pool
+# for the queries
+DEFAULT_BUILD_POOL_SIZE = int(os.getenv("AUTOLLM_BUILD_POOL_SIZE", 2))
+
+_build_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_build_executor() -> ThreadPoolExecutor:
+    """Get the thread pool building the query engines and loading the config on reload."""
+    global _build_executor
+    if _build_executor is None:
+        _build_executor = ThreadPoolExecutor(
+            max_workers=DEFAULT_BUILD_POOL_SIZE, thread_name_prefix="autollm-build")
+    return _build_executor
+
+
+class TaskRegistry:
+    """
+    Builds the query engine of a task on its first use instead of at startup.
+
+    Concurrent first requests of a task wait for a single build. Builds run in a small dedicated thread pool,
+    so the event loop and the shared thread pool keep serving the tasks that are already loaded. Tasks can be
+    prewarmed in the background, and with max_loaded_engines the least recently used engines are dropped and
+    rebuilt on their next use. Tasks with the same ingestion settings share one index, as in
+    initialize_engines.
+
+    ```python
+    registry = TaskRegistry(task_name_to_params, documents=documents, max_loaded_engines=2)
+    registry.prewarm(["qa"])
+    query_engine = await registry.aget("qa")
+    ```
+
+    Parameters:
+        task_name_to_params: Task parameters from config.yaml by task name, without the task name.
+        documents: Documents to build the indexes from.
+        query_engines: Already built query engines by task name. They are never evicted.
+        max_loaded_engines: The maximum number of built engines kept in memory. None keeps all of them.
+        on_engine_built: Called with the task name and the query engine after each build, e.g. to attach
+            callback handlers.
+    """
+
+    def __init__(
+            self,
+            task_name_to_params: Optional[Dict[str, dict]] = None,
+            documents: Optional[Sequence[Document]] = None,
+            query_engines: Optional[Dict[str, BaseQueryEngine]] = None,
+            max_loaded_engines: Optional[int] = None,
+            on_engine_built: Optional[Callable[[str, BaseQueryEngine], None]] = None) -> None:
+        if max_loaded_engines is not None and max_loaded_engines < 1:
+            raise ValueError("max_loaded_engines must be at least 1")
+
+        self.task_name_to_params = task_name_to_params or {}
+        self.documents = documents
+        self.max_loaded_engines = max_loaded_engines
+        self.on_engine_built = on_engine_built
+        self._pinned_engines: Dict[str, BaseQueryEngine] = dict(query_engines or {})
+        self._engines: "OrderedDict[str, BaseQueryEngine]" = OrderedDict()
+        self._builds: Dict[str, Future] = {}
+        self._errors: Dict[str, str] = {}
+        self._shared_indexes: Dict[str, VectorStoreIndex] = {}
+        self._index_locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def task_names(self) -> List[str]:
+        return list(self._pinned_engines) + [
+            task_name for task_name in self.task_name_to_params if task_name not in self._pinned_engines
+        ]
+
+    def __contains__(self, task_name: str) -> bool:
+        return task_name in self._pinned_engines or task_name in self.task_name_to_params
+
+    def _get_or_start_build(self, task_name: str):
+        """Get the loaded engine of the task, or the future of its (possibly just started) build."""
+        if task_name not in self:
+            raise KeyError(f"Unknown task: {task_name}")
+
+        with self._lock:
+            if task_name in self._pinned_engines:
+                return self._pinned_engines[task_name]
+            if task_name in self._engines:
+                self._engines.move_to_end(task_name)
+                return self._engines[task_name]
+
+            future = self._builds.get(task_name)
+            if future is None:
+                future = self._builds[task_name] = get_build_executor().submit(self._build, task_name)
+            return future
+
+    def get(self, task_name: str) -> BaseQueryEngine:
+        """Get the query engine of a task, building it if needed. Blocks until the engine is built."""
+        engine_or_future = self._get_or_start_build(task_name)
+        if isinstance(engine_or_future, Future):
+            return engine_or_future.result()
+        return engine_or_future
+
+    async def aget(self, task_name: str) -> BaseQueryEngine:
+        """Get the query engine of a task, building it in the build thread pool if needed."""
+        engine_or_future = self._get_or_start_build(task_name)
+        if isinstance(engine_or_future, Future):
+            # shield, so that a cancelled request does not cancel the build shared with other requests
+            return await asyncio.shield(asyncio.wrap_future(engine_or_future))
+        return engine_or_future
+
+    def prewarm(self, task_names: Optional[Sequence[str]] = None) -> None:
+        """Start building the engines of the given tasks (all tasks by default) in the background."""
+        for task_name in task_names if task_names is not None else self.task_names:
+            self._get_or_start_build(task_name)
+
+    def get_status(self) -> Dict[str, dict]:
+        """Get the load status of each task, with the error of its last failed build."""
+        status = {}
+        with self._lock:
+            for task_name in self.task_names:
+                if task_name in self._pinned_engines or task_name in self._engines:
+                    status[task_name] = {"status": TASK_LOADED}
+                elif task_name in self._builds:
+                    status[task_name] = {"status": TASK_LOADING}
+                elif task_name in self._errors:
+                    status[task_name] = {"status": TASK_FAILED, "error": self._errors[task_name]}
+                else:
+                    status[task_name] = {"status": TASK_NOT_LOADED}
+        return status
+
+    def reloaded(self, task_name_to_params: Dict[str, dict]) -> "TaskRegistry":
+        """
+        Create a registry of the given task parameters, with the settings of this one, that reuses its built
+        engines of the tasks whose parameters did not change and its indexes whose ingestion settings are
+        still used. The other tasks are built over the reused indexes without ingesting the documents again.
+        """
+        registry = TaskRegistry(
+            task_name_to_params=task_name_to_params,
+            documents=self.documents,
+            query_engines=self._pinned_engines,
+            max_loaded_engines=self.max_loaded_engines,
+            on_engine_built=self.on_engine_built)
+        index_keys = {get_index_sharing_key(task_params) for task_params in task_name_to_params.values()}
+        with self._lock:
+            for task_name, query_engine in self._engines.items():
+                if self.task_name_to_params[task_name] == task_name_to_params.get(task_name):
+                    registry._engines[task_name] = query_engine
+            registry._shared_indexes = {
+                index_key: index
+                for index_key, index in self._shared_indexes.items() if index_key in index_keys
+            }
+        return registry
+
+    def get_loaded_task_names(self) -> List[str]:
+        with self._lock:
+            return list(self._pinned_engines) + list(self._engines)
+
+    def close(self) -> None:
+        """Drop the built engines and indexes, once a reloaded registry replaced this one and was drained."""
+        with self._lock:
+            self._engines.clear()
+            self._shared_indexes.clear()
+
+    def _build(self, task_name: str) -> BaseQueryEngine:
+        task_params = self.task_name_to_params[task_name]
+        index_key = get_index_sharing_key(task_params)
+        try:
+            logger.info(f"Building the query engine of task '{task_name}'.")
+            with self._lock:
+                index_lock = self._index_locks.setdefault(index_key, threading.Lock())
+            # Tasks sharing an index wait for each other, so that the index is built once
+            with index_lock:
+                shared_index = self._shared_indexes.get(index_key)
+                if shared_index is not None:
+                    query_engine = AutoQueryEngine.from_defaults(
+                        vector_store_index=shared_index, **task_params)
+                else:
+                    query_engine = AutoQueryEngine.from_defaults(documents=self.documents, **task_params)
+                    if getattr(query_engine, "vector_store_index", None) is not None:
+                        self._shared_indexes[index_key] = query_engine.vector_store_index
+
+            if self.on_engine_built is not None:
+                self.on_engine_built(task_name, query_engine)
+        except Exception as e:
+            logger.exception(f"Building the query engine of task '{task_name}' failed.")
+            with self._lock:
+                self._errors[task_name] = str(e)
+                del self._builds[task_name]
+            raise
+
+        with self._lock:
+            self._engines[task_name] = query_engine
+            self._errors.pop(task_name, None)
+            del self._builds[task_name]
+            self._evict()
+        logger.info(f"The query engine of task '{task_name}' is ready.")
+
+        return query_engine
+
+    def _evict(self) -> None:
+        if self.max_loaded_engines is None:
+            return
+        while len(self._engines) > self.max_loaded_engines:
+            task_name, _ = self._engines.popitem(last=False)
+            logger.info(f"Evicting the least recently used query engine of task '{task_name}'.")
+            index_key = get_index_sharing_key(self.task_name_to_params[task_name])
+            # Drop the shared index once no loaded task uses it
+            if all(get_index_sharing_key(self.task_name_to_params[loaded_task]) != index_key
+                   for loaded_task in self._engines):
+                self._shared_indexes.pop(index_key, None)
+
+
+class ReloadInProgressError(RuntimeError):
+    """Raised when a reload is requested while another one is running."""
+
+
+class TaskRegistryReloader:
+    """
+    Replaces the task registry of a running server with one built from the current config, without downtime.
+
+    The new engines are built in the background while the current registry keeps serving. Tasks whose
+    parameters did not change keep their engines, and tasks whose ingestion settings did not change keep their
+    indexes. Once the tasks loaded in the current registry and the new tasks are built, the registry is
+    swapped at once: new requests use the new engines, and the old registry is closed when its last in-flight
+    request finished. If a build fails, the reload fails and the current registry keeps serving.
+
+    The LanceDB tables are opened on every query, so writes to a table are seen by the next query without a
+    reload, and the semantic caches are dropped when the table version changes.
+
+    ```python
+    reloader = TaskRegistryReloader(registry, load_task_params=lambda: read_tasks("config.yaml"))
+    registry, release = reloader.lease()
+    try:
+        query_engine = await registry.aget("qa")
+        ...
+    finally:
+        release()
+    changes = await reloader.reload()  # e.g. {"qa": "changed", "summarize": "unchanged"}
+    ```
+
+    Parameters:
+        registry: The task registry serving the requests.
+        load_task_params: Loads the task parameters by task name from the current config, called in the
+            thread pool on every reload.
+    """
+
+    def __init__(self, registry: TaskRegistry, load_task_params: Callable[[], Dict[str, dict]]) -> None:
+        self.registry = registry
+        self.load_task_params = load_task_params
+        self.generation = 0
+        self._inflight: Dict[TaskRegistry, int] = {}
+        self._reloading = False
+
+    def lease(self) -> Tuple[TaskRegistry, Callable[[], None]]:
+        """
+        Get the current registry for a request, and the function to call once the request finished. The
+        registry is not closed while it is leased. Calling the function again does nothing.
+        """
+        registry = self.registry
+        self._inflight[registry] = self._inflight.get(registry, 0) + 1
+        released = False
+
+        def release() -> None:
+            nonlocal released
+            if released:
+                return
+            released = True
+            self._inflight[registry] -= 1
+            if self._inflight[registry] == 0:
+                del self._inflight[registry]
+                if registry is not self.registry:
+                    self._close(registry)
+
+        return registry, release
+
+    async def reload(self) -> Dict[str, str]:
+        """
+        Load the current config, build its engines in the background and swap the registry once built.
+
+        Returns:
+            Dict[str, str]: The change of each task: "added", "changed", "unchanged" or "removed".
+
+        Raises:
+            ReloadInProgressError: If another reload is running.
+        """
+        if self._reloading:
+            raise ReloadInProgressError("A reload is already running")
+        self._reloading = True
+        try:
+            task_name_to_params = await asyncio.get_running_loop().run_in_executor(
+                get_build_executor(), self.load_task_params)
+            current_registry = self.registry
+            registry = current_registry.reloaded(task_name_to_params)
+
+            # Warm the new registry as far as the current one, so no request waits for a build after the swap
+            loaded_task_names = set(current_registry.get_loaded_task_names())
+            warm_task_names = [
+                task_name for task_name in registry.task_names
+                if task_name in loaded_task_names or task_name not in current_registry
+            ]
+            results = await asyncio.gather(
+                *(registry.aget(task_name) for task_name in warm_task_names), return_exceptions=True)
+            errors = {
+                task_name: str(result)
+                for task_name, result in zip(warm_task_names, results) if isinstance(result, Exception)
+            }
+            if errors:
+                raise RuntimeError(f"Building the query engines of the reloaded tasks failed: {errors}")
+
+            self.registry = registry
+            self.generation += 1
+        finally:
+            self._reloading = False
+
+        changes = _get_task_changes(current_registry.task_name_to_params, registry.task_name_to_params)
+        logger.info(f"Reloaded the tasks (generation {self.generation}): {changes}")
+        if current_registry not in self._inflight:
+            self._close(current_registry)
+        return changes
+
+    def _close(self, registry: TaskRegistry) -> None:
+        registry.close()
+        logger.info("Closed the drained task registry of the previous generation.")
+
+
+def _get_task_changes(old_task_name_to_params: Dict[str, dict],
+                      new_task_name_to_params: Dict[str, dict]) -> Dict[str, str]:
+    changes = {}
+    for task_name, task_params in new_task_name_to_params.items():
+        if task_name not in old_task_name_to_params:
+            changes[task_name] = TASK_ADDED
+        elif old_task_name_to_params[task_name] != task_params:
+            changes[task_name] = TASK_CHANGED
+        else:
+            changes[task_name] = TASK_UNCHANGED
+    for task_name in old_task_name_to_params:
+        if task_name not in new_task_name_to_params:
+            changes[task_name] = TASK_REMOVED
+    return changes
@@ -1,15 +1,37 @@
+import inspect
+import json
 import logging
-from typing import Dict, Optional, Sequence
+from typing import Any, AsyncGenerator, Callable, Dict, Optional, Sequence, Tuple, Union
 
-from llama_index import Document
+from llama_index import Document, VectorStoreIndex
+from llama_index.core.response.schema import RESPONSE_TYPE, StreamingResponse
 from llama_index.indices.query.base import BaseQueryEngine
 
-from autollm.auto.query_engine import AutoQueryEngine
+from autollm.auto.query_engine import AutoQueryEngine, create_query_engine
+from autollm.callbacks.budget import estimate_query_usage
+from autollm.callbacks.metrics import MetricsCallbackHandler, MetricsRegistry
+from autollm.callbacks.tracing import TracingCallbackHandler
+from autollm.callbacks.usage import RequestUsage, UsageTrackingHandler, track_request_usage
+from autollm.utils.async_utils import iterate_in_thread
 from autollm.utils.env_utils import load_config_and_dotenv
+from autollm.utils.logging import logger
+from autollm.utils.retriever_query_engine import serialize_nodes
 
 logging.basicConfig(level=logging.INFO)
 
-STREAMING_CHUNK_SIZE = 16
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+# Task parameters that do not change how the documents are chunked, embedded and stored. hybrid_search is not
+# one of them, its tasks maintain a full-text index in their vector store
+LLM_PARAMS = ("llm_model", "llm_max_tokens", "llm_temperature", "llm_api_base", "llm_cache", "llm_router")
+QUERY_TIME_PARAMS = (
+    "system_prompt", "query_wrapper_prompt", "enable_cost_calculator", "context_window", "similarity_top_k",
+    "response_mode", "refine_prompt", "structured_answer_filtering", "semantic_cache", "mmr",
+    "context_token_budget", "map_reduce", "use_async", "documents", "nodes", "vector_store_index")
+EXTRACTOR_PARAMS = (
+    "enable_title_extractor", "enable_summary_extractor", "enable_qa_extractor", "enable_keyword_extractor",
+    "enable_entity_extractor")
 
 
 def load_config_and_initialize_engines(
@@ -31,19 +53,215 @@ def load_config_and_initialize_engines(
 
     config = load_config_and_dotenv(config_file_path, env_file_path)
 
-    # Initialize query engines based on the config
+    return initialize_engines(config, documents)
+
+
+def initialize_engines(config: dict,
+                       documents: Optional[Sequence[Document]] = None) -> Dict[str, BaseQueryEngine]:
+    """
+    Initialize query engines based on a loaded config.
+
+    Parameters:
+        config (dict): The configuration dictionary with a list of task parameters under 'tasks'.
+        documents (Sequence[Document]): Sequence of llama_index.Document instances.
+
+    Returns:
+        dict: The configuration mapping (task name -> query engine))
+    """
     query_engines = {}
+    # Tasks with the same ingestion settings query one index, so the documents are embedded once per index
+    shared_indexes: Dict[str, VectorStoreIndex] = {}
     for task_params in config['tasks']:
+        task_params = dict(task_params)
         task_name = task_params.pop('name')
-        query_engines[task_name] = AutoQueryEngine.from_defaults(documents=documents, **task_params)
+        index_key = get_index_sharing_key(task_params)
+        shared_index = shared_indexes.get(index_key)
+        if shared_index is not None:
+            logger.info(f"Task '{task_name}' reuses the index of a task with the same ingestion settings.")
+            query_engine = AutoQueryEngine.from_defaults(vector_store_index=shared_index, **task_params)
+        else:
+            query_engine = AutoQueryEngine.from_defaults(documents=documents, **task_params)
+            if getattr(query_engine, "vector_store_index", None) is not None:
+                shared_indexes[index_key] = query_engine.vector_store_index
+        query_engines[task_name] = query_engine
 
     return query_engines
 
 
-def stream_text_data(text_data: str, chunk_size: int = STREAMING_CHUNK_SIZE):
-    start = 0
-    end = chunk_size
-    while start < len(text_data):
-        yield text_data[start:end]
-        start = end
-        end += chunk_size
+def get_task_name_to_params(config: dict, read_only: bool = False) -> Dict[str, dict]:
+    """
+    Get the parameters of the tasks of a loaded config by task name.
+
+    Parameters:
+        config (dict): The configuration dictionary with a list of task parameters under 'tasks'.
+        read_only (bool): Flag to open the LanceDB tables of the tasks read-only, for the serving workers of
+            indexes built by a single builder process.
+
+    Returns:
+        dict: The task parameters without the task name (task name -> task parameters).
+    """
+    task_name_to_params = {}
+    for task_params in config['tasks']:
+        task_params = dict(task_params)
+        task_name = task_params.pop('name')
+        if read_only:
+            if task_params.get("vector_store_type", "LanceDBVectorStore") != "LanceDBVectorStore":
+                raise ValueError(f"Task '{task_name}' must use a LanceDBVectorStore to be served read-only")
+            task_params["read_only"] = True
+        task_name_to_params[task_name] = task_params
+    return task_name_to_params
+
+
+def get_index_sharing_key(task_params: dict) -> str:
+    """
+    Get a key identifying the index a task builds. Tasks with equal keys can query the same index.
+
+    All task parameters except the ones only used at query time (LLM, prompts and retrieval parameters) take
+    part in the key, missing parameters are replaced with their defaults. The LLM takes part only when an
+    extractor uses it at ingestion time.
+
+    Parameters:
+        task_params (dict): The task parameters from config.yaml, without the task name.
+
+    Returns:
+        str: The index sharing key.
+    """
+    ingestion_params = {
+        name: parameter.default
+        for name, parameter in inspect.signature(create_query_engine).parameters.items()
+        if parameter.default is not inspect.Parameter.empty
+    }
+    ingestion_params.update(task_params)
+
+    if not any(ingestion_params.get(extractor_param) for extractor_param in EXTRACTOR_PARAMS):
+        ingestion_params = {name: value for name, value in ingestion_params.items() if name not in LLM_PARAMS}
+    ingestion_params = {
+        name: value
+        for name, value in ingestion_params.items() if name not in QUERY_TIME_PARAMS
+    }
+
+    return json.dumps(ingestion_params, sort_keys=True, default=str)
+
+
+def estimate_task_query_usage(user_query: str, task_params: Optional[dict] = None) -> Tuple[int, float]:
+    """
+    Estimate the worst-case token usage and USD cost of a query from the parameters of its task.
+
+    Parameters:
+        user_query (str): The user query.
+        task_params (dict): The task parameters from config.yaml. Missing ones fall back to the defaults.
+
+    Returns:
+        (tokens, cost_usd) tuple.
+    """
+    task_params = task_params or {}
+    return estimate_query_usage(
+        user_query,
+        model=task_params.get('llm_model', "gpt-3.5-turbo"),
+        similarity_top_k=task_params.get('similarity_top_k', 6),
+        chunk_size=task_params.get('chunk_size', 512),
+        max_tokens=task_params.get('llm_max_tokens'))
+
+
+def add_metrics_handler(query_engine: BaseQueryEngine, task_name: str, registry: MetricsRegistry) -> None:
+    """
+    Attach a MetricsCallbackHandler for the given task to the callback manager of a query engine.
+
+    Parameters:
+        query_engine (BaseQueryEngine): The query engine to collect metrics from.
+        task_name (str): The task label of the collected metrics.
+        registry (MetricsRegistry): The registry to record the metrics in.
+    """
+    query_engine.callback_manager.add_handler(MetricsCallbackHandler(task_name=task_name, registry=registry))
+
+
+def add_tracing_handler(query_engine: BaseQueryEngine) -> None:
+    """
+    Attach a TracingCallbackHandler to the callback manager of a query engine, so that the stages of each
+    request can be traced with trace_request.
+
+    Parameters:
+        query_engine (BaseQueryEngine): The query engine to trace.
+    """
+    query_engine.callback_manager.add_handler(TracingCallbackHandler())
+
+
+def add_usage_handler(query_engine: BaseQueryEngine) -> None:
+    """
+    Attach a UsageTrackingHandler to the callback manager of a query engine, so that the LLM usage of each
+    request can be collected with track_request_usage.
+
+    Parameters:
+        query_engine (BaseQueryEngine): The query engine to track the usage of.
+    """
+    query_engine.callback_manager.add_handler(UsageTrackingHandler())
+
+
+async def astream_query(query_engine: BaseQueryEngine, user_query: str) -> RESPONSE_TYPE:
+    """
+    Query with LLM token streaming when the query engine supports it, otherwise with a regular async query.
+
+    Parameters:
+        query_engine (BaseQueryEngine): The query engine.
+        user_query (str): The user query.
+
+    Returns:
+        A llama_index StreamingResponse, or a Response for query engines without streaming support.
+    """
+    if getattr(query_engine, "supports_streaming", False):
+        return await query_engine.astream_query(user_query)
+    return await query_engine.aquery(user_query)
+
+
+def format_sse_event(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+def format_batch_result(position: int, response: Union[RESPONSE_TYPE, Exception]) -> str:
+    """Format the response of a batch query, or its failure, as a line of newline-delimited JSON."""
+    if isinstance(response, Exception):
+        result = {"index": position, "error": str(response) or type(response).__name__}
+    else:
+        result = {
+            "index": position,
+            "response": response.response,
+            "source_nodes": serialize_nodes(response.source_nodes, fields=("id", "score")),
+        }
+    return json.dumps(result, default=str) + "\n"
+
+
+async def stream_sse_events(
+        response: RESPONSE_TYPE,
+        usage: RequestUsage,
+        on_finish: Optional[Callable[[], None]] = None) -> AsyncGenerator[str, None]:
+    """
+    Stream a query response as server-sent events: a "token" event per LLM token, then an "end" event with the
+    source nodes and the LLM usage of the request. A failure while generating is sent as an "error" event.
+
+    Parameters:
+        response (RESPONSE_TYPE): The (streaming) response of the query.
+        usage (RequestUsage): The usage of the request, completed while the tokens are consumed.
+        on_finish (Callable): Called once the stream is finished, failed or cancelled.
+
+    Yields:
+        str: SSE formatted events.
+    """
+    try:
+        with track_request_usage(usage):
+            if isinstance(response, StreamingResponse):
+                async for token in iterate_in_thread(response.response_gen):
+                    yield format_sse_event("token", {"token": token})
+            else:
+                yield format_sse_event("token", {"token": response.response})
+
+        yield format_sse_event(
+            "end", {
+                "source_nodes": serialize_nodes(response.source_nodes),
+                "usage": usage.to_dict()
+            })
+    except Exception as e:
+        logger.exception("Streaming the response failed.")
+        yield format_sse_event("error", {"detail": str(e)})
+    finally:
+        if on_finish is not None:
+            on_finish()
@@ -0,0 +1,79 @@
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any, AsyncGenerator, Callable, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+
+DEFAULT_THREAD_POOL_SIZE = int(os.getenv("AUTOLLM_THREAD_POOL_SIZE", min(32, (os.cpu_count() or 1) + 4)))
+# Each streamed answer holds a thread while its client reads it, so the streams get their own, larger pool
+DEFAULT_STREAM_POOL_SIZE = int(os.getenv("AUTOLLM_STREAM_POOL_SIZE", 64))
+
+_executor: Optional[ThreadPoolExecutor] = None
+_stream_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Get the shared thread pool used to run blocking calls off the event loop."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=DEFAULT_THREAD_POOL_SIZE, thread_name_prefix="autollm")
+    return _executor
+
+
+def get_stream_executor() -> ThreadPoolExecutor:
+    """
+    Get the thread pool consuming the blocking LLM token streams, separate from the shared thread pool so that
+    slow streaming clients do not starve the queries of threads.
+    """
+    global _stream_executor
+    if _stream_executor is None:
+        _stream_executor = ThreadPoolExecutor(
+            max_workers=DEFAULT_STREAM_POOL_SIZE, thread_name_prefix="autollm-stream")
+    return _stream_executor
+
+
+async def run_in_thread(
+        func: Callable[..., T], *args: Any, executor: Optional[Executor] = None, **kwargs: Any) -> T:
+    """
+    Run a blocking function in the shared thread pool without blocking the event loop.
+
+    The current context is copied into the worker thread, so that context variables (e.g. the usage of the
+    current request) are visible to the function.
+
+    Parameters:
+        func (Callable): The blocking function to run.
+        *args: Positional arguments of the function.
+        executor (Executor): The executor to run the function in, the shared thread pool by default.
+        **kwargs: Keyword arguments of the function.
+
+    Returns:
+        The return value of the function.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        executor or get_executor(), functools.partial(context.run, func, *args, **kwargs))
+
+
+async def iterate_in_thread(iterator: Iterator[T]) -> AsyncGenerator[T, None]:
+    """
+    Consume a blocking iterator (e.g. a sync LLM token stream) from async code, one item at a time in the
+    stream thread pool.
+
+    Parameters:
+        iterator (Iterator): The blocking iterator.
+
+    Yields:
+        The items of the iterator.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    exhausted = object()
+    while True:
+        item = await loop.run_in_executor(get_stream_executor(), context.run, next, iterator, exhausted)
+        if item is exhausted:
+            return
+        yield item
@@ -0,0 +1,131 @@
+"""Per-request deadlines, propagated by a context variable into the embedding, vector search and LLM calls."""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, Optional, Union
+
+from llama_index.llms import LiteLLM
+
+
+class DeadlineExceededError(TimeoutError):
+    """Raised when the deadline of the current request passed before a call was made."""
+
+
+class SharedDeadline:
+    """
+    The deadline of work shared by several requests (e.g. a coalesced query): the latest deadline of the
+    requests, or no deadline once a request without one joins. Each request still stops waiting at its own
+    deadline.
+    """
+
+    def __init__(self) -> None:
+        self._deadline: Optional[float] = None
+        self._unbounded = False
+
+    @property
+    def deadline(self) -> Optional[float]:
+        return None if self._unbounded else self._deadline
+
+    def extend(self, deadline: Optional[float]) -> None:
+        """Extend the deadline to the deadline of a request joining the work, None if it has none."""
+        if deadline is None:
+            self._unbounded = True
+        elif self._deadline is None or deadline > self._deadline:
+            self._deadline = deadline
+
+
+_deadline: ContextVar[Union[None, float, SharedDeadline]] = ContextVar("autollm_deadline", default=None)
+
+
+@contextmanager
+def deadline_scope(timeout_seconds: Optional[float] = None,
+                   deadline: Optional[float] = None) -> Iterator[None]:
+    """
+    Set the deadline of the code run in the scope, including the tasks and the threads it starts with the
+    current context. A deadline already set earlier is kept.
+
+    ```python
+    with deadline_scope(timeout_seconds=5):
+        response = await query_engine.aquery("why so serious?")
+    ```
+
+    Parameters:
+        timeout_seconds (float): The seconds from now until the deadline.
+        deadline (float): The deadline as a time.monotonic() value.
+    """
+    if timeout_seconds is not None:
+        timeout_deadline = time.monotonic() + timeout_seconds
+        deadline = timeout_deadline if deadline is None else min(deadline, timeout_deadline)
+    current_deadline = get_deadline()
+    if deadline is None or (current_deadline is not None and current_deadline <= deadline):
+        yield
+        return
+
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+@contextmanager
+def shared_deadline_scope(shared_deadline: SharedDeadline) -> Iterator[None]:
+    """
+    Set a deadline that may be extended by the requests joining the work run in the scope, replacing the
+    deadline already set. Extensions are seen by the calls made after them.
+
+    Parameters:
+        shared_deadline (SharedDeadline): The deadline shared by the requests.
+    """
+    token = _deadline.set(shared_deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def get_deadline() -> Optional[float]:
+    """Get the deadline of the current request as a time.monotonic() value, None if it has none."""
+    deadline = _deadline.get()
+    if isinstance(deadline, SharedDeadline):
+        return deadline.deadline
+    return deadline
+
+
+def get_remaining_seconds() -> Optional[float]:
+    """Get the seconds left until the deadline of the current request, None if it has none."""
+    deadline = get_deadline()
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0.0)
+
+
+def check_deadline() -> None:
+    """
+    Check that the deadline of the current request has not passed, before making a call.
+
+    Raises:
+        DeadlineExceededError: If the deadline passed.
+    """
+    if get_remaining_seconds() == 0.0:
+        raise DeadlineExceededError("The deadline of the request passed.")
+
+
+def get_timeout_kwargs() -> Dict[str, float]:
+    """
+    Get the "timeout" keyword argument of a LiteLLM call ending at the deadline of the current request, empty
+    if the request has no deadline.
+
+    Raises:
+        DeadlineExceededError: If the deadline passed.
+    """
+    check_deadline()
+    remaining_seconds = get_remaining_seconds()
+    return {} if remaining_seconds is None else {"timeout": remaining_seconds}
+
+
+class DeadlineLiteLLM(LiteLLM):
+    """LiteLLM whose calls time out at the deadline of the current request, and are not made after it."""
+
+    def _get_all_kwargs(self, **kwargs: Any) -> Dict[str, Any]:
+        return {**super()._get_all_kwargs(**kwargs), **get_timeout_kwargs()}
@@ -142,16 +142,17 @@ def read_website_as_documents(
     return documents
 
 
-def read_webpage_as_documents(url: str) -> List[Document]:
+def read_webpage_as_documents(url: str, allow_redirects: bool = True) -> List[Document]:
     """
     Read documents from a single webpage URL using the WebPageReader.
 
     Parameters:
         url (str): The URL of the web page to read.
+        allow_redirects (bool): Whether to follow redirects, a redirected page is not read otherwise.
 
     Returns:
         List[Document]: A list of Document objects containing content and metadata from the web page.
     """
     reader = WebPageReader()
-    documents = reader.load_data(url)
+    documents = reader.load_data(url, allow_redirects=allow_redirects)
     return documents
@@ -0,0 +1,126 @@
+"""Micro-batching of concurrent embedding requests into batched embedding calls."""
+import asyncio
+import contextvars
+from typing import Awaitable, Callable, List, Optional, Sequence, Set, Tuple
+
+from llama_index.embeddings.base import BaseEmbedding, Embedding
+
+from autollm.utils.deadlines import deadline_scope, get_deadline
+
+DEFAULT_MAX_BATCH_SIZE = 16
+DEFAULT_MAX_WAIT_SECONDS = 0.005
+# Embedding models embedding queries like texts, so that queries can be sent in batched text embedding calls
+SYMMETRIC_EMBEDDING_MODELS = ("AutoEmbedding", "OpenAIEmbedding", "AzureOpenAIEmbedding", "MockEmbedding")
+
+
+async def aembed_queries(embed_model: BaseEmbedding, queries: Sequence[str]) -> List[Embedding]:
+    """
+    Embed many queries at once, in concurrent batched calls of embed_model.embed_batch_size queries.
+
+    Models that embed queries differently from texts (e.g. with a query instruction, like the local e5 models)
+    have no batched query embedding call, their queries are embedded concurrently one by one.
+
+    Parameters:
+        embed_model (BaseEmbedding): The embedding model.
+        queries (Sequence[str]): The queries to embed.
+
+    Returns:
+        List[Embedding]: The query embeddings, in the order of the queries.
+    """
+    if any(model_class.__name__ in SYMMETRIC_EMBEDDING_MODELS for model_class in type(embed_model).__mro__):
+        return await embed_model.aget_text_embedding_batch(list(queries))
+    return list(await asyncio.gather(*(embed_model.aget_query_embedding(query) for query in queries)))
+
+
+class EmbeddingMicroBatcher:
+    """
+    Collects embedding requests arriving within a short window and sends them as one batched call.
+
+    A batch is sent as soon as max_batch_size texts are waiting, or max_wait_seconds after its first text
+    arrived. The embeddings are fanned back to the waiting callers, identical texts in a batch are embedded
+    once. A batch runs without the context variables of its callers, with the latest of their deadlines.
+
+    ```python
+    batcher = EmbeddingMicroBatcher(
+        embed_batch=embedding._aembed_batch, max_batch_size=16, max_wait_seconds=0.005)
+    embeddings = await asyncio.gather(*(batcher.embed(query) for query in queries))
+    ```
+
+    Parameters:
+        embed_batch: Async function embedding a list of texts, returning the embeddings in the same order.
+        max_batch_size: The maximum number of texts in a batch.
+        max_wait_seconds: The maximum time a text waits for other texts to join its batch.
+    """
+
+    def __init__(
+            self,
+            embed_batch: Callable[[List[str]], Awaitable[List[Embedding]]],
+            max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+            max_wait_seconds: float = DEFAULT_MAX_WAIT_SECONDS) -> None:
+        self.embed_batch = embed_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_seconds
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._pending: List[Tuple[str, asyncio.Future, Optional[float]]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._batch_tasks: Set[asyncio.Task] = set()
+
+    async def embed(self, text: str) -> Embedding:
+        """Embed a text as part of the next batch."""
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # Futures and timers are bound to the loop they were created in
+            self._loop = loop
+            self._pending = []
+            self._flush_handle = None
+
+        future = loop.create_future()
+        self._pending.append((text, future, get_deadline()))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.max_wait_seconds, self._flush)
+
+        return await future
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        deadlines = [deadline for _, _, deadline in batch]
+        deadline = None if None in deadlines else max(deadlines)
+        task = contextvars.Context().run(self._start_batch, batch, deadline)
+        self._batch_tasks.add(task)
+        task.add_done_callback(self._batch_tasks.discard)
+
+    def _start_batch(
+            self, batch: List[Tuple[str, asyncio.Future, Optional[float]]],
+            deadline: Optional[float]) -> asyncio.Task:
+        with deadline_scope(deadline=deadline):
+            return self._loop.create_task(self._run_batch(batch))
+
+    async def _run_batch(self, batch: List[Tuple[str, asyncio.Future, Optional[float]]]) -> None:
+        texts = list(dict.fromkeys(text for text, _, _ in batch))
+        try:
+            embeddings = await self.embed_batch(texts)
+            if len(embeddings) != len(texts):
+                raise ValueError(f"Expected {len(texts)} embeddings from the batch, got {len(embeddings)}.")
+        except asyncio.CancelledError:
+            for _, future, _ in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        text_to_embedding = dict(zip(texts, embeddings))
+        for text, future, _ in batch:
+            # the caller may have been cancelled in the meantime
+            if not future.done():
+                future.set_result(text_to_embedding[text])
@@ -1,19 +1,110 @@
 """LanceDB vector store with cloud storage support."""
+import asyncio
+import json
 import os
-from typing import Any, Optional
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 
 from dotenv import load_dotenv
-from llama_index.schema import NodeRelationship, RelatedNodeInfo, TextNode
+from llama_index.schema import BaseNode, NodeRelationship, RelatedNodeInfo, TextNode
 from llama_index.vector_stores import LanceDBVectorStore as LanceDBVectorStoreBase
-from llama_index.vector_stores.lancedb import _to_lance_filter, _to_llama_similarities
-from llama_index.vector_stores.types import VectorStoreQuery, VectorStoreQueryResult
-from pandas import DataFrame
+from llama_index.vector_stores.lancedb import _to_llama_similarities
+from llama_index.vector_stores.types import (
+    MetadataFilters,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult,
+)
+from pandas import DataFrame, concat, notna
+
+from autollm.utils.async_utils import run_in_thread
+from autollm.utils.deadlines import check_deadline
+from autollm.utils.token_counting import TOKEN_COUNT_METADATA_KEY
 
 load_dotenv()
 
+# The rank constant of reciprocal rank fusion, dampening the weight of the top ranks
+DEFAULT_RRF_K = 60
+# Each search of a hybrid query fetches this many times the requested number of nodes to fuse
+HYBRID_CANDIDATES_FACTOR = 2
+# The columns of the table that are not node metadata, and cannot be filtered on
+NON_METADATA_COLUMNS = ("id", "vector", "text", "_node_content", "_node_type")
+
+
+def quote_sql_string(value: str) -> str:
+    """Quote a string as a LanceDB SQL literal, escaping its quotes."""
+    return "'" + value.replace("'", "''") + "'"
+
+
+def to_lance_filter(filters: MetadataFilters, columns: Sequence[str]) -> str:
+    """
+    Translate exact-match metadata filters to a LanceDB filter. The keys must be metadata columns of the table
+    and the values are escaped, so that the filters of a request cannot change the query.
+
+    Parameters:
+        filters (MetadataFilters): The metadata filters.
+        columns (Sequence[str]): The columns of the table.
+
+    Returns:
+        str: The LanceDB filter.
+
+    Raises:
+        ValueError: If a key is not a metadata column, or a value is not a string, a number or a boolean.
+    """
+    conditions = []
+    for metadata_filter in filters.legacy_filters():
+        key, value = metadata_filter.key, metadata_filter.value
+        if key not in columns or key in NON_METADATA_COLUMNS:
+            raise ValueError(f"Unknown metadata filter key: '{key}'")
+        if isinstance(value, bool):
+            literal = "TRUE" if value else "FALSE"
+        elif isinstance(value, (int, float)):
+            literal = repr(value)
+        elif isinstance(value, str):
+            literal = quote_sql_string(value)
+        else:
+            raise ValueError(f"The value of metadata filter '{key}' must be a string, a number or a boolean")
+        conditions.append(f"{key} = {literal}")
+    return " AND ".join(conditions)
+
+
+def reciprocal_rank_fusion(
+        rankings: Sequence[Sequence[str]],
+        weights: Optional[Sequence[float]] = None,
+        k: int = DEFAULT_RRF_K) -> List[Tuple[str, float]]:
+    """
+    Merge rankings with reciprocal rank fusion: each id scores the sum of weight / (k + rank) over the
+    rankings.
+
+    Parameters:
+        rankings (Sequence[Sequence[str]]): The ranked ids of each search, best first.
+        weights (Sequence[float]): The weight of each ranking. Defaults to equal weights.
+        k (int): The rank constant.
+
+    Returns:
+        List[Tuple[str, float]]: The (id, score) pairs, best first.
+    """
+    weights = weights or [1.0] * len(rankings)
+    scores: Dict[str, float] = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, id_ in enumerate(ranking, start=1):
+            scores[id_] = scores.get(id_, 0.0) + weight / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
 
 class LanceDBVectorStore(LanceDBVectorStoreBase):
-    """Advanced LanceDB Vector Store supporting cloud storage and prefiltering."""
+    """
+    Advanced LanceDB Vector Store supporting cloud storage, prefiltering and hybrid search.
+
+    Hybrid queries (VectorStoreQueryMode.HYBRID) run a full-text BM25 search next to the vector search and
+    merge both with reciprocal rank fusion, so that exact identifiers like error codes and API names are found
+    even when their embeddings are not close to the query. They need the full-text index of the text column:
+    with fts_index set, it is built when the vector store is opened and rebuilt after each write, so that the
+    queries never build it.
+
+    A read-only vector store never writes to the table, e.g. in the serving workers of a table written by a
+    single builder process. Its full-text index is the one the builder built.
+    """
     from lancedb.query import LanceQueryBuilder
     from lancedb.table import Table
 
@@ -25,6 +116,9 @@ class LanceDBVectorStore(LanceDBVectorStoreBase):
         refine_factor: Optional[int] = None,
         api_key: Optional[str] = None,
         region: Optional[str] = None,
+        rrf_k: int = DEFAULT_RRF_K,
+        read_only: bool = False,
+        fts_index: bool = False,
         **kwargs: Any,
     ) -> None:
         """Init params."""
@@ -35,6 +129,13 @@ class LanceDBVectorStore(LanceDBVectorStoreBase):
         self.refine_factor = refine_factor
         self.api_key = api_key
         self.region = region
+        self.rrf_k = rrf_k
+        self.read_only = read_only
+        self.fts_index = False
+        self._fts_index_version: Optional[int] = None
+        self._fts_index_lock = threading.Lock()
+        if fts_index:
+            self.enable_fts_index()
 
     def _setup_connection(self, uri: str, api_key: Optional[str] = None, region: Optional[str] = None):
         """Establishes a robust connection to LanceDB."""
@@ -52,32 +153,145 @@ class LanceDBVectorStore(LanceDBVectorStoreBase):
         else:
             self.connection = lancedb.connect(uri)
 
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        self._check_writable()
+        ids = super().add(nodes, **add_kwargs)
+        if self.fts_index:
+            self.ensure_fts_index()
+        return ids
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        self._check_writable()
+        super().delete(ref_doc_id, **delete_kwargs)
+        if self.fts_index:
+            self.ensure_fts_index()
+
+    def delete_documents(self, ref_doc_ids: Sequence[str]) -> None:
+        """Delete the nodes of several documents in a single write of the table, if the table exists."""
+        self._check_writable()
+        if not ref_doc_ids or self.table_name not in self.connection.table_names():
+            return
+        quoted_doc_ids = ", ".join(quote_sql_string(ref_doc_id) for ref_doc_id in ref_doc_ids)
+        self.connection.open_table(self.table_name).delete(f"doc_id IN ({quoted_doc_ids})")
+        if self.fts_index:
+            self.ensure_fts_index()
+
+    def _check_writable(self) -> None:
+        if self.read_only:
+            raise PermissionError(
+                f"The LanceDB table '{self.table_name}' at {self.uri} was opened read-only.")
+
     def query(
         self,
         query: VectorStoreQuery,
         **kwargs: Any,
     ) -> VectorStoreQueryResult:
-        """Enhanced query method to support prefiltering in LanceDB queries."""
+        """Enhanced query method to support prefiltering and hybrid search in LanceDB queries."""
+        check_deadline()
+        if query.mode == VectorStoreQueryMode.HYBRID:
+            vector_results = self._vector_search(query, **kwargs)
+            text_results = self._text_search(query, **kwargs)
+            return self._fuse_results(query, vector_results, text_results)
+
         table = self.connection.open_table(self.table_name)
         lance_query = self._prepare_lance_query(query, table, **kwargs)
 
-        results = lance_query.to_df()
+        results = lance_query.to_pandas()
         return self._construct_query_result(results)
 
-    def _prepare_lance_query(self, query: VectorStoreQuery, table: Table, **kwargs) -> LanceQueryBuilder:
-        """Prepares the LanceDB query considering prefiltering and additional parameters."""
+    async def aquery(
+        self,
+        query: VectorStoreQuery,
+        **kwargs: Any,
+    ) -> VectorStoreQueryResult:
+        """Run the blocking LanceDB query in the shared thread pool to keep the event loop responsive."""
+        check_deadline()
+        if query.mode == VectorStoreQueryMode.HYBRID:
+            # The lexical and vector searches run in parallel
+            vector_results, text_results = await asyncio.gather(
+                run_in_thread(self._vector_search, query, **kwargs),
+                run_in_thread(self._text_search, query, **kwargs))
+            return self._fuse_results(query, vector_results, text_results)
+
+        return await run_in_thread(self.query, query, **kwargs)
+
+    def enable_fts_index(self) -> None:
+        """Maintain the full-text index of the hybrid queries from now on, building it if the table exists."""
+        self.fts_index = True
+        if self.table_name in self.connection.table_names():
+            self.ensure_fts_index()
+
+    def ensure_fts_index(self) -> None:
+        """
+        Build the full-text index of the text column, or rebuild it if the table changed since it was built. A
+        read-only vector store uses the index as it was built.
+        """
+        if self.read_only:
+            return
+        with self._fts_index_lock:
+            table = self.connection.open_table(self.table_name)
+            if self._fts_index_version == table.version:
+                return
+            table.create_fts_index("text", replace=True, use_tantivy=False)
+            self._fts_index_version = table.version
+
+    def _vector_search(self, query: VectorStoreQuery, **kwargs: Any) -> DataFrame:
+        table = self.connection.open_table(self.table_name)
+        lance_query = self._prepare_lance_query(query, table, **kwargs)
+        lance_query.limit(query.similarity_top_k * HYBRID_CANDIDATES_FACTOR)
+        return lance_query.to_pandas()
+
+    def _text_search(self, query: VectorStoreQuery, **kwargs: Any) -> DataFrame:
+        if not query.query_str:
+            return DataFrame()
+        table = self.connection.open_table(self.table_name)
+        # The filters are applied after the full-text search, LanceDB does not prefilter it
+        where, _ = self._get_where(query, table, dict(kwargs))
+        num_candidates = (query.sparse_top_k or query.similarity_top_k) * HYBRID_CANDIDATES_FACTOR
+        return table.search(query.query_str, query_type="fts").where(where).limit(num_candidates).to_pandas()
+
+    def _fuse_results(
+            self, query: VectorStoreQuery, vector_results: DataFrame,
+            text_results: DataFrame) -> VectorStoreQueryResult:
+        """Merge the vector and full-text search results with reciprocal rank fusion."""
+        rankings = [vector_results["id"].tolist() if len(vector_results) else []]
+        rankings.append(text_results["id"].tolist() if len(text_results) else [])
+        # alpha weights the vector search against the full-text search, as in the other hybrid vector stores
+        weights = None if query.alpha is None else [query.alpha, 1.0 - query.alpha]
+        fused = reciprocal_rank_fusion(rankings, weights=weights, k=self.rrf_k)[:query.similarity_top_k]
+        if not fused:
+            return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+
+        results = concat([vector_results, text_results], ignore_index=True).drop_duplicates("id")
+        results = results.set_index("id", drop=False).loc[[id_ for id_, _ in fused]]
+        return self._construct_query_result(results, similarities=[score for _, score in fused])
+
+    def get_table_version(self) -> Optional[int]:
+        """Get the version of the table, which changes with every write. None if the table does not exist."""
+        if self.table_name not in self.connection.table_names():
+            return None
+        return self.connection.open_table(self.table_name).version
+
+    @staticmethod
+    def _get_where(query: VectorStoreQuery, table: Table, kwargs: Dict[str,
+                                                                       Any]) -> Tuple[Optional[str], bool]:
+        """Get the LanceDB filter of a query and whether to prefilter, popping them from kwargs."""
         if query.filters is not None:
             if "where" in kwargs:
                 raise ValueError(
                     "Cannot specify filter via both query and kwargs. "
                     "Use kwargs only for lancedb specific items that are "
                     "not supported via the generic query interface.")
-            where = _to_lance_filter(query.filters)
+            where = to_lance_filter(query.filters, table.schema.names)
         else:
             where = kwargs.pop("where", None)
         prefilter = kwargs.pop("prefilter", False)
+        return where, prefilter
+
+    def _prepare_lance_query(self, query: VectorStoreQuery, table: Table, **kwargs) -> LanceQueryBuilder:
+        """Prepares the LanceDB query considering prefiltering and additional parameters."""
+        where, prefilter = self._get_where(query, table, kwargs)
 
-        table = self.connection.open_table(self.table_name)
         lance_query = (
             table.search(query.query_embedding).limit(query.similarity_top_k).where(
                 where, prefilter=prefilter).nprobes(self.nprobes))
@@ -87,14 +301,28 @@ class LanceDBVectorStore(LanceDBVectorStoreBase):
 
         return lance_query
 
-    def _construct_query_result(self, results: DataFrame) -> VectorStoreQueryResult:
+    def _construct_query_result(
+            self, results: DataFrame, similarities: Optional[List[float]] = None) -> VectorStoreQueryResult:
         """Constructs a VectorStoreQueryResult from a LanceDB query result."""
         nodes = []
 
         for _, row in results.iterrows():
+            # the metadata is stored with the node content, it is shown to the LLM and returned by retrieval
+            node_content = json.loads(row['_node_content']) if notna(row.get('_node_content')) else {}
+            metadata = dict(node_content.get('metadata') or {})
+            # the token count stored at ingest time lets the context be packed without tokenizing the node
+            if notna(row.get(TOKEN_COUNT_METADATA_KEY)):
+                metadata[TOKEN_COUNT_METADATA_KEY] = int(row[TOKEN_COUNT_METADATA_KEY])
             node = TextNode(
                 text=row.get('text', ''),  # ensure text is a string
                 id_=row['id'],
+                # the vectors let postprocessors compare the nodes without embedding them again
+                embedding=[float(value) for value in row['vector']] if 'vector' in row else None,
+                metadata=metadata,
+                excluded_embed_metadata_keys=_with_token_count_key(
+                    node_content.get('excluded_embed_metadata_keys')),
+                excluded_llm_metadata_keys=_with_token_count_key(
+                    node_content.get('excluded_llm_metadata_keys')),
                 relationships={
                     NodeRelationship.SOURCE: RelatedNodeInfo(node_id=row['doc_id']),
                 })
@@ -102,6 +330,11 @@ class LanceDBVectorStore(LanceDBVectorStoreBase):
 
         return VectorStoreQueryResult(
             nodes=nodes,
-            similarities=_to_llama_similarities(results),
+            similarities=_to_llama_similarities(results) if similarities is None else similarities,
             ids=results["id"].tolist(),
         )
+
+
+def _with_token_count_key(keys: Optional[List[str]]) -> List[str]:
+    keys = list(keys or [])
+    return keys if TOKEN_COUNT_METADATA_KEY in keys else keys + [TOKEN_COUNT_METADATA_KEY]
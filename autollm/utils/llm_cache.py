@@ -0,0 +1,320 @@
+"""Exact-match LLM response cache with in-memory LRU and SQLite backends."""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Sequence, Tuple, Union
+
+from llama_index.bridge.pydantic import PrivateAttr
+from llama_index.llms import ChatMessage, ChatResponse
+from llama_index.llms.litellm_utils import to_openai_message_dicts
+
+from autollm.utils.async_utils import run_in_thread
+from autollm.utils.deadlines import DeadlineLiteLLM
+
+DEFAULT_CACHE_MAX_SIZE = 1024
+DEFAULT_CACHE_TTL_SECONDS = 24 * 3600.0
+DEFAULT_SQLITE_CACHE_PATH = "./.cache/llm_cache.sqlite"
+# Call parameters that do not change the completion
+NON_KEY_PARAMS = ("api_key", "max_retries", "timeout", "request_timeout", "stream")
+
+
+def get_llm_cache_key(model: str, params: Dict[str, Any], messages: Sequence[Dict[str, Any]]) -> str:
+    """
+    Get the cache key of an LLM call: a hash of the normalized model name, call parameters and messages.
+
+    Parameters:
+        model (str): The model name.
+        params (dict): The call parameters, e.g. temperature and max_tokens.
+        messages (Sequence[dict]): The OpenAI style message dicts.
+
+    Returns:
+        str: The SHA-256 hex digest of the call.
+    """
+    key_params = {
+        name: value
+        for name, value in params.items()
+        if name != "model" and name not in NON_KEY_PARAMS and value is not None
+    }
+    key_messages = [dict(message, content=(message.get("content") or "").strip()) for message in messages]
+    key = {"model": model.strip().lower(), "params": key_params, "messages": key_messages}
+    payload = json.dumps(key, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class BaseLLMCache(ABC):
+    """
+    Stores LLM responses by cache key for ttl_seconds, keeping at most max_size entries.
+
+    Parameters:
+        max_size: The maximum number of cached responses. The least recently used ones are evicted first.
+        ttl_seconds: The time a response stays valid. None keeps responses until they are evicted.
+    """
+
+    # Whether the lookups do I/O, and are run off the event loop by the async methods
+    blocking: bool = False
+
+    def __init__(
+            self,
+            max_size: int = DEFAULT_CACHE_MAX_SIZE,
+            ttl_seconds: Optional[float] = DEFAULT_CACHE_TTL_SECONDS) -> None:
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+
+    def _is_expired(self, created_at: float, now: float) -> bool:
+        return self.ttl_seconds is not None and now - created_at > self.ttl_seconds
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Get the cached response of a key, None on a miss."""
+        value = self._get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def aget(self, key: str) -> Optional[Dict[str, Any]]:
+        """Get the cached response of a key without blocking the event loop, None on a miss."""
+        return await run_in_thread(self.get, key) if self.blocking else self.get(key)
+
+    async def aset(self, key: str, value: Dict[str, Any]) -> None:
+        """Cache the response of a key without blocking the event loop."""
+        if self.blocking:
+            await run_in_thread(self.set, key, value)
+        else:
+            self.set(key, value)
+
+    def set(self, key: str, value: Dict[str, Any]) -> None:
+        """Cache the JSON serializable response of a key."""
+        self._set(key, value)
+
+    @abstractmethod
+    def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        pass
+
+    @abstractmethod
+    def _set(self, key: str, value: Dict[str, Any]) -> None:
+        pass
+
+    @abstractmethod
+    def clear(self) -> None:
+        """Remove all cached responses."""
+
+
+class InMemoryLLMCache(BaseLLMCache):
+    """LRU cache of LLM responses in the memory of the process."""
+
+    def __init__(
+            self,
+            max_size: int = DEFAULT_CACHE_MAX_SIZE,
+            ttl_seconds: Optional[float] = DEFAULT_CACHE_TTL_SECONDS) -> None:
+        super().__init__(max_size=max_size, ttl_seconds=ttl_seconds)
+        self._entries: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            created_at, value = entry
+            if self._is_expired(created_at, time.time()):
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def _set(self, key: str, value: Dict[str, Any]) -> None:
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteLLMCache(BaseLLMCache):
+    """
+    LRU cache of LLM responses in a SQLite file, shared between processes and kept across restarts.
+
+    Parameters:
+        path: The path of the SQLite database file.
+        max_size: The maximum number of cached responses. The least recently used ones are evicted first.
+        ttl_seconds: The time a response stays valid. None keeps responses until they are evicted.
+    """
+
+    blocking = True
+
+    def __init__(
+            self,
+            path: str = DEFAULT_SQLITE_CACHE_PATH,
+            max_size: int = 100000,
+            ttl_seconds: Optional[float] = DEFAULT_CACHE_TTL_SECONDS) -> None:
+        super().__init__(max_size=max_size, ttl_seconds=ttl_seconds)
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS llm_cache_accessed_at ON llm_cache (accessed_at)")
+
+    def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute("SELECT value, created_at FROM llm_cache WHERE key = ?",
+                                           (key, )).fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            if self._is_expired(created_at, now):
+                self._connection.execute("DELETE FROM llm_cache WHERE key = ?", (key, ))
+                return None
+            self._connection.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(value)
+
+    def _set(self, key: str, value: Dict[str, Any]) -> None:
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, default=str), now, now))
+            (size, ) = self._connection.execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+            if size > self.max_size:
+                self._connection.execute(
+                    "DELETE FROM llm_cache WHERE key IN "
+                    "(SELECT key FROM llm_cache ORDER BY accessed_at LIMIT ?)", (size - self.max_size, ))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._connection.execute("DELETE FROM llm_cache")
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+
+
+def create_llm_cache(llm_cache: Union[None, str, dict, BaseLLMCache]) -> Optional[BaseLLMCache]:
+    """
+    Create an LLM cache from its config.
+
+    Parameters:
+        llm_cache: "memory", "sqlite", a dict with a "type" key and the keyword arguments of the cache (e.g.
+            {"type": "sqlite", "path": "./llm_cache.sqlite", "ttl_seconds": 3600, "max_size": 10000}), or an
+            LLM cache instance. None disables caching.
+
+    Returns:
+        BaseLLMCache: The LLM cache, or None.
+    """
+    if llm_cache is None or isinstance(llm_cache, BaseLLMCache):
+        return llm_cache
+
+    cache_kwargs = {"type": llm_cache} if isinstance(llm_cache, str) else dict(llm_cache)
+    cache_type = cache_kwargs.pop("type", "memory")
+    if cache_type == "memory":
+        return InMemoryLLMCache(**cache_kwargs)
+    if cache_type == "sqlite":
+        return SQLiteLLMCache(**cache_kwargs)
+    raise ValueError(f"Unknown llm cache type: {cache_type}. Use 'memory' or 'sqlite'.")
+
+
+class CachedLiteLLM(DeadlineLiteLLM):
+    """
+    LiteLLM answering repeated chat calls with the same model, parameters and messages from a cache.
+
+    Cached responses report zero token usage, so cache hits are free in the cost and budget accounting.
+    Streaming calls are not cached.
+    """
+
+    _cache: Optional[BaseLLMCache] = PrivateAttr()
+
+    def __init__(self, cache: Optional[BaseLLMCache] = None, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self._cache = cache
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "cached_litellm_llm"
+
+    @property
+    def cache(self) -> Optional[BaseLLMCache]:
+        return self._cache
+
+    def _get_cache_key(self, messages: Sequence[ChatMessage], **kwargs: Any) -> str:
+        # Only the model and sampling parameters, not _get_all_kwargs which adds the timeout of the deadline
+        params = {**self._model_kwargs, **kwargs}
+        return get_llm_cache_key(params.pop("model"), params, to_openai_message_dicts(messages))
+
+    def _chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        if self._cache is None:
+            return super()._chat(messages, **kwargs)
+
+        key = self._get_cache_key(messages, **kwargs)
+        cached_response = self._cache.get(key)
+        if cached_response is not None:
+            return self._to_chat_response(cached_response)
+
+        response = super()._chat(messages, **kwargs)
+        self._cache.set(key, self._to_cached_response(response))
+        return response
+
+    async def _achat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        if self._cache is None:
+            return await super()._achat(messages, **kwargs)
+
+        key = self._get_cache_key(messages, **kwargs)
+        cached_response = await self._cache.aget(key)
+        if cached_response is not None:
+            return self._to_chat_response(cached_response)
+
+        response = await super()._achat(messages, **kwargs)
+        await self._cache.aset(key, self._to_cached_response(response))
+        return response
+
+    @staticmethod
+    def _to_cached_response(response: ChatResponse) -> Dict[str, Any]:
+        return {
+            "role": response.message.role.value,
+            "content": response.message.content,
+            "additional_kwargs": response.message.additional_kwargs,
+        }
+
+    @staticmethod
+    def _to_chat_response(cached_response: Dict[str, Any]) -> ChatResponse:
+        return ChatResponse(
+            message=ChatMessage(
+                role=cached_response["role"],
+                content=cached_response["content"],
+                additional_kwargs=cached_response.get("additional_kwargs") or {}),
+            raw={
+                "cached": True,
+                "usage": {
+                    "prompt_tokens": 0,
+                    "completion_tokens": 0,
+                    "total_tokens": 0
+                }
+            },
+            additional_kwargs={
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "total_tokens": 0
+            })
@@ -0,0 +1,474 @@
+"""Latency-aware routing of LLM calls over several backends with failover and request hedging."""
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextvars import copy_context
+from typing import Any, AsyncGenerator, Dict, Generator, List, Optional, Sequence, Set, Tuple
+
+from llama_index.bridge.pydantic import Field, PrivateAttr
+from llama_index.llms import LLM, ChatMessage, ChatResponse, CompletionResponse, LLMMetadata
+
+from autollm.utils.logging import logger
+
+DEFAULT_COOLDOWN_SECONDS = 30.0
+DEFAULT_EWMA_ALPHA = 0.3
+DEFAULT_HEDGE_MIN_SAMPLES = 20
+# The sync calls run in threads when they can time out or be hedged, a timed out call keeps its thread until
+# it ends
+DEFAULT_MAX_WORKERS = 16
+LATENCY_WINDOW_SIZE = 200
+ROUTING_STRATEGIES = ("latency", "ordered", "weighted")
+
+
+def is_retryable_error(error: BaseException) -> bool:
+    """Timeouts, rate limits, connection and server errors are retried on the next backend."""
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError, ConnectionError)):
+        return True
+    status_code = getattr(error, "status_code", None)
+    if isinstance(status_code, int):
+        return status_code in (408, 429) or status_code >= 500
+    error_name = type(error).__name__
+    return any(name in error_name for name in ("Timeout", "RateLimit", "ServiceUnavailable", "APIConnection"))
+
+
+class BackendStats:
+    """Rolling latency and error rate of an LLM backend."""
+
+    def __init__(self, ewma_alpha: float = DEFAULT_EWMA_ALPHA) -> None:
+        self.ewma_alpha = ewma_alpha
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.cooldown_until = 0.0
+        self._latencies = deque(maxlen=LATENCY_WINDOW_SIZE)
+        self._lock = threading.Lock()
+
+    def record_success(self, latency: float) -> None:
+        with self._lock:
+            self.requests += 1
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency = self.ewma_alpha * latency + (1 - self.ewma_alpha) * self.latency
+            self.error_rate *= 1 - self.ewma_alpha
+            self._latencies.append(latency)
+
+    def record_failure(self, cooldown_seconds: float = 0.0) -> None:
+        with self._lock:
+            self.requests += 1
+            self.failures += 1
+            self.error_rate = self.ewma_alpha + (1 - self.ewma_alpha) * self.error_rate
+            self.cooldown_until = max(self.cooldown_until, time.monotonic() + cooldown_seconds)
+
+    @property
+    def is_available(self) -> bool:
+        return time.monotonic() >= self.cooldown_until
+
+    @property
+    def score(self) -> float:
+        """The expected time of a successful call, lower is better. Untried backends score 0."""
+        if self.latency is None:
+            return 0.0
+        return self.latency / max(1.0 - self.error_rate, 0.05)
+
+    @property
+    def num_samples(self) -> int:
+        return len(self._latencies)
+
+    def latency_percentile(self, percentile: float) -> Optional[float]:
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "latency_seconds": self.latency,
+            "error_rate": self.error_rate,
+            "requests": self.requests,
+            "failures": self.failures,
+            "available": self.is_available,
+        }
+
+
+def _get_backend_name(backend: LLM) -> str:
+    model = getattr(backend, "model", None) or backend.metadata.model_name
+    api_base = (getattr(backend, "additional_kwargs", None) or {}).get("api_base")
+    return f"{model}@{api_base}" if api_base else model
+
+
+class RouterLLM(LLM):
+    """
+    Routes each LLM call to the best healthy backend and fails over to the next one on timeouts, rate limits
+    and server errors.
+
+    With the "latency" routing, backends are ranked by their rolling latency, weighted by their error rate.
+    The "ordered" routing keeps the order of the backends, and "weighted" picks the first backend at random by
+    weight. A backend failing with a retryable error is skipped for cooldown_seconds. With hedge_percentile, a
+    call still running after that latency percentile of its backend is also sent to the next backend, and the
+    first answer wins. Streaming calls fail over until their first token, and are not hedged.
+
+    The LLM events of the backends are sent to the callback manager of the router, so the usage and cost of
+    every call, including the hedged ones, are tracked with the model that served it. The sync calls that can
+    time out or be hedged run in a dedicated pool of max_workers threads, apart from the shared thread pool of
+    the server.
+
+    ```python
+    llm = RouterLLM(
+        backends=[LiteLLM(model="gpt-3.5-turbo"), LiteLLM(model="azure/gpt-35-turbo")], timeout=20)
+    ```
+
+    Parameters:
+        backends: The LLMs to route the calls to.
+        weights: The weights of the backends for the "weighted" routing. Defaults to equal weights.
+        routing: "latency", "ordered" or "weighted".
+        timeout: The maximum time in seconds of a call to a backend, before failing over to the next one.
+        hedge_percentile: The latency percentile of a backend after which a call is hedged, e.g. 95. None
+            disables hedging.
+        hedge_min_samples: The number of latency samples of a backend needed before its calls are hedged.
+        cooldown_seconds: The time a backend is skipped after a retryable error.
+        ewma_alpha: The smoothing factor of the rolling latency and error rate.
+        max_workers: The maximum number of concurrent sync calls with a timeout or hedging.
+    """
+
+    routing: str = Field(default="latency", description="The routing strategy of the calls.")
+    timeout: Optional[float] = Field(default=None, description="The maximum time of a call to a backend.")
+    hedge_percentile: Optional[float] = Field(
+        default=None, description="The latency percentile of a backend after which a call is hedged.")
+    hedge_min_samples: int = Field(
+        default=DEFAULT_HEDGE_MIN_SAMPLES, description="The number of latency samples needed for hedging.")
+    cooldown_seconds: float = Field(
+        default=DEFAULT_COOLDOWN_SECONDS,
+        description="The time a backend is skipped after a retryable error.")
+
+    _backends: List[LLM] = PrivateAttr()
+    _weights: List[float] = PrivateAttr()
+    _stats: List[BackendStats] = PrivateAttr()
+    _executor: ThreadPoolExecutor = PrivateAttr()
+
+    def __init__(
+            self,
+            backends: Sequence[LLM],
+            weights: Optional[Sequence[float]] = None,
+            routing: str = "latency",
+            timeout: Optional[float] = None,
+            hedge_percentile: Optional[float] = None,
+            hedge_min_samples: int = DEFAULT_HEDGE_MIN_SAMPLES,
+            cooldown_seconds: float = DEFAULT_COOLDOWN_SECONDS,
+            ewma_alpha: float = DEFAULT_EWMA_ALPHA,
+            max_workers: int = DEFAULT_MAX_WORKERS,
+            **kwargs: Any) -> None:
+        if not backends:
+            raise ValueError("backends must not be empty")
+        if routing not in ROUTING_STRATEGIES:
+            raise ValueError(f"Unknown routing: {routing}. Use one of {ROUTING_STRATEGIES}.")
+        if weights is not None and (len(weights) != len(backends) or min(weights) <= 0):
+            raise ValueError("weights must be a positive weight for each backend")
+        if hedge_percentile is not None and not 0 < hedge_percentile < 100:
+            raise ValueError("hedge_percentile must be in (0, 100)")
+
+        super().__init__(
+            routing=routing,
+            timeout=timeout,
+            hedge_percentile=hedge_percentile,
+            hedge_min_samples=hedge_min_samples,
+            cooldown_seconds=cooldown_seconds,
+            **kwargs)
+        self._backends = list(backends)
+        self._weights = list(weights) if weights is not None else [1.0] * len(backends)
+        self._stats = [BackendStats(ewma_alpha) for _ in backends]
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="autollm-router")
+        self._set_backend_callback_manager()
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        super().__setattr__(name, value)
+        if name == "callback_manager":
+            self._set_backend_callback_manager()
+
+    def _set_backend_callback_manager(self) -> None:
+        for backend in self._backends:
+            backend.callback_manager = self.callback_manager
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "router_llm"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        # The prompts must fit the smallest backend
+        context_window = min(backend.metadata.context_window for backend in self._backends)
+        return self._backends[0].metadata.copy(update={"context_window": context_window})
+
+    @property
+    def backends(self) -> List[LLM]:
+        return self._backends
+
+    def get_backend_stats(self) -> List[Dict[str, Any]]:
+        """Get the rolling latency, error rate and availability of each backend."""
+        return [
+            dict(stats.to_dict(), backend=_get_backend_name(backend))
+            for backend, stats in zip(self._backends, self._stats)
+        ]
+
+    def _get_backend_order(self) -> List[int]:
+        """Order the backends to try: the available ones by the routing, then the cooling down ones."""
+        available = [index for index, stats in enumerate(self._stats) if stats.is_available]
+        cooling_down = sorted((index for index, stats in enumerate(self._stats) if not stats.is_available),
+                              key=lambda index: self._stats[index].cooldown_until)
+
+        if self.routing == "latency":
+            available.sort(key=lambda index: (self._stats[index].score, index))
+        elif self.routing == "weighted" and available:
+            first = random.choices(available, weights=[self._weights[index] for index in available])[0]
+            available = [first] + [index for index in available if index != first]
+        return available + cooling_down
+
+    def _get_hedge_delay(self, index: int) -> Optional[float]:
+        stats = self._stats[index]
+        if self.hedge_percentile is None or stats.num_samples < self.hedge_min_samples:
+            return None
+        return stats.latency_percentile(self.hedge_percentile)
+
+    def _record_failure(self, index: int, error: BaseException) -> None:
+        if is_retryable_error(error):
+            self._stats[index].record_failure(self.cooldown_seconds)
+            logger.warning(
+                f"LLM backend {_get_backend_name(self._backends[index])} failed, failing over: {error}")
+
+    def _invoke(self, index: int, method: str, args: Tuple, kwargs: Dict[str, Any]) -> Any:
+        start_time = time.perf_counter()
+        try:
+            result = getattr(self._backends[index], method)(*args, **kwargs)
+        except Exception as e:
+            self._record_failure(index, e)
+            raise
+        self._stats[index].record_success(time.perf_counter() - start_time)
+        return result
+
+    async def _ainvoke(self, index: int, method: str, args: Tuple, kwargs: Dict[str, Any]) -> Any:
+        start_time = time.perf_counter()
+        try:
+            result = await getattr(self._backends[index], method)(*args, **kwargs)
+        except Exception as e:
+            self._record_failure(index, e)
+            raise
+        self._stats[index].record_success(time.perf_counter() - start_time)
+        return result
+
+    def _timeout_error(self, indices: Sequence[int]) -> TimeoutError:
+        for index in indices:
+            self._stats[index].record_failure(self.cooldown_seconds)
+        names = ", ".join(_get_backend_name(self._backends[index]) for index in indices)
+        return TimeoutError(f"LLM backend {names} timed out after {self.timeout} seconds")
+
+    def _call_backend(
+            self, index: int, hedge_index: Optional[int], method: str, args: Tuple, kwargs: Dict[str, Any],
+            failed: Set[int]) -> Any:
+        """Call a backend, hedged with hedge_index if it is slow. Failed backends are added to failed."""
+        hedge_delay = self._get_hedge_delay(index) if hedge_index is not None else None
+        if hedge_delay is None and self.timeout is None:
+            try:
+                return self._invoke(index, method, args, kwargs)
+            except Exception:
+                failed.add(index)
+                raise
+
+        # Run in the executor of the router, so that the call can be timed out and hedged
+        executor = self._executor
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        futures: Dict[Future, int] = {
+            executor.submit(copy_context().run, self._invoke, index, method, args, kwargs): index
+        }
+        if hedge_delay is not None and (deadline is None or hedge_delay < self.timeout):
+            done, _ = wait(futures, timeout=hedge_delay)
+            if not done:
+                hedge_future = executor.submit(
+                    copy_context().run, self._invoke, hedge_index, method, args, kwargs)
+                futures[hedge_future] = hedge_index
+
+        error = None
+        while futures:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0.0)
+            done, _ = wait(futures, timeout=remaining, return_when=FIRST_COMPLETED)
+            if not done:
+                failed.update(futures.values())
+                raise self._timeout_error(list(futures.values()))
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                    failed.add(futures[future])
+                del futures[future]
+            successful = [future for future in done if future.exception() is None]
+            if successful:
+                return successful[0].result()
+        raise error
+
+    async def _acall_backend(
+            self, index: int, hedge_index: Optional[int], method: str, args: Tuple, kwargs: Dict[str, Any],
+            failed: Set[int]) -> Any:
+        """Call a backend, hedged with hedge_index if it is slow. Failed backends are added to failed."""
+        hedge_delay = self._get_hedge_delay(index) if hedge_index is not None else None
+        if hedge_delay is None and self.timeout is None:
+            try:
+                return await self._ainvoke(index, method, args, kwargs)
+            except Exception:
+                failed.add(index)
+                raise
+
+        loop = asyncio.get_running_loop()
+        deadline = None if self.timeout is None else loop.time() + self.timeout
+        tasks = {asyncio.ensure_future(self._ainvoke(index, method, args, kwargs)): index}
+        try:
+            if hedge_delay is not None and (deadline is None or hedge_delay < self.timeout):
+                done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+                if not done:
+                    tasks[asyncio.ensure_future(self._ainvoke(hedge_index, method, args,
+                                                              kwargs))] = hedge_index
+
+            error = None
+            while tasks:
+                remaining = None if deadline is None else max(deadline - loop.time(), 0.0)
+                done, _ = await asyncio.wait(tasks, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    failed.update(tasks.values())
+                    raise self._timeout_error(list(tasks.values()))
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        failed.add(tasks[task])
+                    del tasks[task]
+                successful = [task for task in done if task.exception() is None]
+                if successful:
+                    return successful[0].result()
+            raise error
+        finally:
+            # The losing hedged call is not needed anymore
+            for task in tasks:
+                task.cancel()
+
+    @staticmethod
+    def _get_hedge_index(order: Sequence[int], position: int, failed: Set[int]) -> Optional[int]:
+        """The next backend to try after the one at position, skipping the backends that already failed."""
+        return next((index for index in order[position + 1:] if index not in failed), None)
+
+    def _route(self, method: str, *args: Any, **kwargs: Any) -> Any:
+        order = self._get_backend_order()
+        failed: Set[int] = set()
+        error = None
+        for position, index in enumerate(order):
+            # A backend that failed as the hedge of the previous one is not called again
+            if index in failed:
+                continue
+            hedge_index = self._get_hedge_index(order, position, failed)
+            try:
+                return self._call_backend(index, hedge_index, method, args, kwargs, failed)
+            except Exception as e:
+                if not is_retryable_error(e):
+                    raise
+                error = e
+        raise error
+
+    async def _aroute(self, method: str, *args: Any, **kwargs: Any) -> Any:
+        order = self._get_backend_order()
+        failed: Set[int] = set()
+        error = None
+        for position, index in enumerate(order):
+            if index in failed:
+                continue
+            hedge_index = self._get_hedge_index(order, position, failed)
+            try:
+                return await self._acall_backend(index, hedge_index, method, args, kwargs, failed)
+            except Exception as e:
+                if not is_retryable_error(e):
+                    raise
+                error = e
+        raise error
+
+    def _route_stream(self, method: str, *args: Any, **kwargs: Any) -> Generator:
+        error = None
+        for index in self._get_backend_order():
+            start_time = time.perf_counter()
+            try:
+                stream = getattr(self._backends[index], method)(*args, **kwargs)
+                first_response = next(stream, None)
+            except Exception as e:
+                self._record_failure(index, e)
+                if not is_retryable_error(e):
+                    raise
+                error = e
+                continue
+            # The time to the first token is the latency of a streaming call
+            self._stats[index].record_success(time.perf_counter() - start_time)
+            return _chain_stream(first_response, stream)
+        raise error
+
+    async def _aroute_stream(self, method: str, *args: Any, **kwargs: Any) -> AsyncGenerator:
+        error = None
+        for index in self._get_backend_order():
+            start_time = time.perf_counter()
+            try:
+                stream = await getattr(self._backends[index], method)(*args, **kwargs)
+                first_response = await stream.__anext__()
+            except StopAsyncIteration:
+                first_response = None
+            except Exception as e:
+                self._record_failure(index, e)
+                if not is_retryable_error(e):
+                    raise
+                error = e
+                continue
+            self._stats[index].record_success(time.perf_counter() - start_time)
+            return _achain_stream(first_response, stream)
+        raise error
+
+    def chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        return self._route("chat", messages, **kwargs)
+
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        return self._route("complete", prompt, formatted=formatted, **kwargs)
+
+    def stream_chat(self, messages: Sequence[ChatMessage],
+                    **kwargs: Any) -> Generator[ChatResponse, None, None]:
+        return self._route_stream("stream_chat", messages, **kwargs)
+
+    def stream_complete(self,
+                        prompt: str,
+                        formatted: bool = False,
+                        **kwargs: Any) -> Generator[CompletionResponse, None, None]:
+        return self._route_stream("stream_complete", prompt, formatted=formatted, **kwargs)
+
+    async def achat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        return await self._aroute("achat", messages, **kwargs)
+
+    async def acomplete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        return await self._aroute("acomplete", prompt, formatted=formatted, **kwargs)
+
+    async def astream_chat(self, messages: Sequence[ChatMessage],
+                           **kwargs: Any) -> AsyncGenerator[ChatResponse, None]:
+        return await self._aroute_stream("astream_chat", messages, **kwargs)
+
+    async def astream_complete(self,
+                               prompt: str,
+                               formatted: bool = False,
+                               **kwargs: Any) -> AsyncGenerator[CompletionResponse, None]:
+        return await self._aroute_stream("astream_complete", prompt, formatted=formatted, **kwargs)
+
+
+def _chain_stream(first_response: Any, stream: Generator) -> Generator:
+    if first_response is None:
+        return
+    yield first_response
+    yield from stream
+
+
+async def _achain_stream(first_response: Any, stream: AsyncGenerator) -> AsyncGenerator:
+    if first_response is None:
+        return
+    yield first_response
+    async for response in stream:
+        yield response
@@ -0,0 +1,205 @@
+"""Response synthesis answering over groups of nodes in parallel and combining the answers."""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional, Sequence
+
+from llama_index import ServiceContext
+from llama_index.node_parser import TokenTextSplitter
+from llama_index.prompts import BasePromptTemplate, PromptTemplate
+from llama_index.prompts.default_prompt_selectors import DEFAULT_TEXT_QA_PROMPT_SEL
+from llama_index.prompts.mixin import PromptDictType
+from llama_index.prompts.prompt_type import PromptType
+from llama_index.response_synthesizers import BaseSynthesizer
+from llama_index.types import RESPONSE_TEXT_TYPE
+
+from autollm.utils.logging import logger
+from autollm.utils.templates import MAP_REDUCE_PROMPT_TEMPLATE
+from autollm.utils.token_counting import count_tokens
+
+PARALLEL_MAP_REDUCE_MODE = "parallel_map_reduce"
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_MAX_FAN_OUT = 8
+DEFAULT_MAX_REDUCE_LEVELS = 2
+
+
+class MapReduceSynthesizer(BaseSynthesizer):
+    """
+    Answers the query over groups of nodes concurrently and combines the partial answers in a reduce step.
+
+    The text chunks are repacked into groups filling the context window, and each group is answered by its own
+    LLM call, at most max_concurrency at a time. With up to max_concurrency groups the latency is about one
+    LLM call for the groups and one for the reduce step, whatever the number of nodes. The chunks past
+    max_context_tokens and the groups past max_fan_out are dropped, the least relevant first, to bound the
+    cost of a query. A single group is answered directly, without the reduce step.
+
+    Partial answers that do not fit a single reduce call are combined in levels, at most max_reduce_levels of
+    them, and only while each level shrinks the answers. The answers left are then truncated to an equal share
+    of the context window, so a query makes at most max_fan_out * (max_reduce_levels + 1) + 1 LLM calls.
+
+    Parameters:
+        text_qa_template (BasePromptTemplate): The prompt answering the query over a group of chunks.
+        reduce_template (BasePromptTemplate): The prompt combining the partial answers.
+        service_context (ServiceContext): The service context with the LLM and the prompt helper.
+        streaming (bool): Flag to stream the final answer.
+        max_concurrency (int): The maximum number of concurrent LLM calls of a query.
+        max_fan_out (int): The maximum number of groups answered for a query.
+        max_context_tokens (int): The maximum number of context tokens of a query. None keeps all the chunks.
+        max_reduce_levels (int): The maximum number of intermediate levels combining the partial answers.
+    """
+
+    def __init__(
+            self,
+            text_qa_template: Optional[BasePromptTemplate] = None,
+            reduce_template: Optional[BasePromptTemplate] = None,
+            service_context: Optional[ServiceContext] = None,
+            streaming: bool = False,
+            max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+            max_fan_out: int = DEFAULT_MAX_FAN_OUT,
+            max_context_tokens: Optional[int] = None,
+            max_reduce_levels: int = DEFAULT_MAX_REDUCE_LEVELS) -> None:
+        if max_concurrency < 1 or max_fan_out < 1:
+            raise ValueError("max_concurrency and max_fan_out must be at least 1")
+        if max_reduce_levels < 0:
+            raise ValueError("max_reduce_levels must not be negative")
+        super().__init__(service_context=service_context, streaming=streaming)
+        self._text_qa_template = text_qa_template or DEFAULT_TEXT_QA_PROMPT_SEL
+        self._reduce_template = reduce_template or PromptTemplate(
+            MAP_REDUCE_PROMPT_TEMPLATE, prompt_type=PromptType.SUMMARY)
+        self._max_concurrency = max_concurrency
+        self._max_fan_out = max_fan_out
+        self._max_context_tokens = max_context_tokens
+        self._max_reduce_levels = max_reduce_levels
+
+    def _get_prompts(self) -> PromptDictType:
+        return {"text_qa_template": self._text_qa_template, "reduce_template": self._reduce_template}
+
+    def _update_prompts(self, prompts: PromptDictType) -> None:
+        if "text_qa_template" in prompts:
+            self._text_qa_template = prompts["text_qa_template"]
+        if "reduce_template" in prompts:
+            self._reduce_template = prompts["reduce_template"]
+
+    def _limit_chunks(self, text_chunks: Sequence[str]) -> List[str]:
+        if self._max_context_tokens is None:
+            return list(text_chunks)
+
+        limited_chunks = []
+        used_tokens = 0
+        for text_chunk in text_chunks:
+            chunk_tokens = count_tokens(text_chunk)
+            if used_tokens + chunk_tokens > self._max_context_tokens:
+                if not limited_chunks:
+                    # The most relevant chunk alone is over the budget, its start is kept
+                    logger.warning(
+                        f"Truncated the first chunk to max_context_tokens ({self._max_context_tokens})")
+                    splitter = TokenTextSplitter(chunk_size=self._max_context_tokens, chunk_overlap=0)
+                    limited_chunks.append(splitter.split_text(text_chunk)[0])
+                if len(text_chunks) > len(limited_chunks):
+                    logger.warning(
+                        f"Dropped {len(text_chunks) - len(limited_chunks)} chunks over max_context_tokens "
+                        f"({self._max_context_tokens})")
+                break
+            used_tokens += chunk_tokens
+            limited_chunks.append(text_chunk)
+        return limited_chunks
+
+    def _get_groups(self, template: BasePromptTemplate, text_chunks: Sequence[str]) -> List[str]:
+        groups = self._service_context.prompt_helper.repack(template, text_chunks=text_chunks)
+        if len(groups) > self._max_fan_out:
+            logger.warning(
+                f"Dropped {len(groups) - self._max_fan_out} context groups over max_fan_out "
+                f"({self._max_fan_out})")
+            groups = groups[:self._max_fan_out]
+        return groups
+
+    @staticmethod
+    def _format_answers(answers: Sequence[str]) -> List[str]:
+        return [f"Answer {number}: {answer}" for number, answer in enumerate(answers, start=1)]
+
+    def _repack_answers(self, reduce_template: BasePromptTemplate, answers: Sequence[str]) -> List[str]:
+        return self._service_context.prompt_helper.repack(
+            reduce_template, text_chunks=self._format_answers(answers))
+
+    def _truncate_answers(self, reduce_template: BasePromptTemplate, answers: Sequence[str]) -> str:
+        """Truncate each answer to an equal share of the context window, so that they fit a single call."""
+        logger.warning(
+            f"Truncated {len(answers)} partial answers not combined within max_reduce_levels "
+            f"({self._max_reduce_levels})")
+        formatted_answers = self._format_answers(answers)
+        return "\n\n".join(
+            self._service_context.prompt_helper.truncate(reduce_template, text_chunks=formatted_answers))
+
+    def _should_reduce(self, groups: Sequence[str], previous_groups: Sequence[str], level: int) -> bool:
+        """Whether to combine the answers again: they do not fit a call, and the last level shrank them."""
+        return 1 < len(groups) < len(previous_groups) and level < self._max_reduce_levels
+
+    def _predict_final(
+            self, template: BasePromptTemplate, context_str: str,
+            **response_kwargs: Any) -> RESPONSE_TEXT_TYPE:
+        if self._streaming:
+            return self._service_context.llm.stream(template, context_str=context_str, **response_kwargs)
+        return self._service_context.llm.predict(template, context_str=context_str, **response_kwargs)
+
+    async def _apredict_final(
+            self, template: BasePromptTemplate, context_str: str,
+            **response_kwargs: Any) -> RESPONSE_TEXT_TYPE:
+        if self._streaming:
+            return self._service_context.llm.stream(template, context_str=context_str, **response_kwargs)
+        return await self._service_context.llm.apredict(template, context_str=context_str, **response_kwargs)
+
+    def _map(self, template: BasePromptTemplate, groups: Sequence[str], **response_kwargs: Any) -> List[str]:
+
+        def predict(group: str) -> str:
+            return self._service_context.llm.predict(template, context_str=group, **response_kwargs)
+
+        with ThreadPoolExecutor(max_workers=min(self._max_concurrency, len(groups))) as executor:
+            return list(executor.map(predict, groups))
+
+    async def _amap(
+            self, template: BasePromptTemplate, groups: Sequence[str], semaphore: asyncio.Semaphore,
+            **response_kwargs: Any) -> List[str]:
+
+        async def apredict(group: str) -> str:
+            async with semaphore:
+                return await self._service_context.llm.apredict(
+                    template, context_str=group, **response_kwargs)
+
+        return await asyncio.gather(*(apredict(group) for group in groups))
+
+    def get_response(
+            self, query_str: str, text_chunks: Sequence[str], **response_kwargs: Any) -> RESPONSE_TEXT_TYPE:
+        text_qa_template = self._text_qa_template.partial_format(query_str=query_str)
+        groups = self._get_groups(text_qa_template, self._limit_chunks(text_chunks))
+        if len(groups) == 1:
+            return self._predict_final(text_qa_template, groups[0], **response_kwargs)
+
+        answers = self._map(text_qa_template, groups, **response_kwargs)
+        reduce_template = self._reduce_template.partial_format(query_str=query_str)
+        groups, previous_groups = self._repack_answers(reduce_template, answers), groups
+        level = 0
+        while self._should_reduce(groups, previous_groups, level):
+            # The answers do not fit a single call, combine them in levels
+            answers = self._map(reduce_template, groups, **response_kwargs)
+            groups, previous_groups = self._repack_answers(reduce_template, answers), groups
+            level += 1
+        context_str = groups[0] if len(groups) == 1 else self._truncate_answers(reduce_template, answers)
+        return self._predict_final(reduce_template, context_str, **response_kwargs)
+
+    async def aget_response(
+            self, query_str: str, text_chunks: Sequence[str], **response_kwargs: Any) -> RESPONSE_TEXT_TYPE:
+        text_qa_template = self._text_qa_template.partial_format(query_str=query_str)
+        groups = self._get_groups(text_qa_template, self._limit_chunks(text_chunks))
+        if len(groups) == 1:
+            return await self._apredict_final(text_qa_template, groups[0], **response_kwargs)
+
+        semaphore = asyncio.Semaphore(self._max_concurrency)
+        answers = await self._amap(text_qa_template, groups, semaphore, **response_kwargs)
+        reduce_template = self._reduce_template.partial_format(query_str=query_str)
+        groups, previous_groups = self._repack_answers(reduce_template, answers), groups
+        level = 0
+        while self._should_reduce(groups, previous_groups, level):
+            answers = await self._amap(reduce_template, groups, semaphore, **response_kwargs)
+            groups, previous_groups = self._repack_answers(reduce_template, answers), groups
+            level += 1
+        context_str = groups[0] if len(groups) == 1 else self._truncate_answers(reduce_template, answers)
+        return await self._apredict_final(reduce_template, context_str, **response_kwargs)
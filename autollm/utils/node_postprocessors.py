@@ -0,0 +1,265 @@
+"""Node postprocessors selecting a smaller, non-redundant context for response synthesis."""
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Union
+
+import numpy as np
+from llama_index import ServiceContext
+from llama_index.bridge.pydantic import Field, PrivateAttr
+from llama_index.postprocessor.types import BaseNodePostprocessor
+from llama_index.response_synthesizers import BaseSynthesizer
+from llama_index.schema import BaseNode, NodeWithScore, QueryBundle, TextNode
+
+from autollm.utils.token_counting import TOKEN_COUNT_METADATA_KEY, count_tokens, get_node_token_count
+
+DEFAULT_MMR_LAMBDA = 0.5
+DEFAULT_MMR_CANDIDATES_FACTOR = 3
+DEFAULT_MIN_OVERLAP_CHARS = 20
+# The tokens of the separator between two chunks of the context
+CHUNK_SEPARATOR_TOKENS = 2
+# Kept free in the context window for the tokenization differences of the joined chunks
+CONTEXT_PADDING_TOKENS = 16
+TOKEN_COUNT_CACHE_SIZE = 10000
+
+
+def maximal_marginal_relevance(
+        query_embedding: np.ndarray,
+        embeddings: np.ndarray,
+        top_n: int,
+        mmr_lambda: float = DEFAULT_MMR_LAMBDA) -> List[int]:
+    """
+    Select embeddings relevant to the query and different from each other with maximal marginal relevance.
+
+    Each step picks the embedding maximizing mmr_lambda * similarity to the query - (1 - mmr_lambda) * maximum
+    similarity to the already selected ones. The similarities are computed once as matrix products.
+
+    Parameters:
+        query_embedding (np.ndarray): The query embedding of shape (dim, ).
+        embeddings (np.ndarray): The candidate embeddings of shape (num_candidates, dim).
+        top_n (int): The number of embeddings to select.
+        mmr_lambda (float): The weight of relevance against diversity, 1 selects by relevance only.
+
+    Returns:
+        List[int]: The positions of the selected embeddings, in order of selection.
+    """
+    embeddings = _normalize_rows(embeddings)
+    relevance = embeddings @ _normalize_rows(query_embedding[np.newaxis, :])[0]
+    similarities = embeddings @ embeddings.T
+
+    selected = [int(np.argmax(relevance))]
+    max_similarity = similarities[selected[0]].copy()
+    while len(selected) < min(top_n, len(embeddings)):
+        scores = mmr_lambda * relevance - (1 - mmr_lambda) * max_similarity
+        scores[selected] = -np.inf
+        position = int(np.argmax(scores))
+        selected.append(position)
+        np.maximum(max_similarity, similarities[position], out=max_similarity)
+    return selected
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms > 0, norms, 1.0)
+
+
+def get_text_overlap(first: str, second: str, min_overlap_chars: int = DEFAULT_MIN_OVERLAP_CHARS) -> int:
+    """Get the length of the longest suffix of first that is a prefix of second, 0 under the minimum."""
+    if len(first) < min_overlap_chars or len(second) < min_overlap_chars:
+        return 0
+    start = first.find(second[:min_overlap_chars])
+    while start != -1:
+        if second.startswith(first[start:]):
+            return len(first) - start
+        start = first.find(second[:min_overlap_chars], start + 1)
+    return 0
+
+
+class MMRNodePostprocessor(BaseNodePostprocessor):
+    """
+    Selects a diverse subset of the retrieved nodes with maximal marginal relevance, and strips the text that
+    adjacent chunks of the same source share because of the chunk overlap.
+
+    The retriever should fetch top_n * candidates_factor candidates, with the node embeddings
+    (LanceDBVectorStore returns them). Nodes are kept in relevance order when the node or query embeddings are
+    missing.
+
+    Parameters:
+        top_n: The number of nodes to select.
+        candidates_factor: The number of candidates to retrieve per selected node.
+        mmr_lambda: The weight of relevance against diversity, 1 selects by relevance only.
+        strip_overlap: Flag to strip the text overlapping between the selected chunks of a source.
+        min_overlap_chars: The minimum length of a stripped overlap.
+    """
+
+    top_n: int = Field(default=6, description="The number of nodes to select.")
+    candidates_factor: int = Field(
+        default=DEFAULT_MMR_CANDIDATES_FACTOR, description="The number of candidates per selected node.")
+    mmr_lambda: float = Field(
+        default=DEFAULT_MMR_LAMBDA, description="The weight of relevance against diversity.")
+    strip_overlap: bool = Field(
+        default=True, description="Flag to strip the text overlapping between chunks.")
+    min_overlap_chars: int = Field(
+        default=DEFAULT_MIN_OVERLAP_CHARS, description="The minimum length of a stripped overlap.")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "MMRNodePostprocessor"
+
+    def _postprocess_nodes(self,
+                           nodes: List[NodeWithScore],
+                           query_bundle: Optional[QueryBundle] = None) -> List[NodeWithScore]:
+        if not nodes:
+            return nodes
+
+        query_embedding = query_bundle.embedding if query_bundle is not None else None
+        if query_embedding is None or any(node.node.embedding is None for node in nodes):
+            selected_nodes = nodes[:self.top_n]
+        else:
+            embeddings = np.array([node.node.embedding for node in nodes], dtype=np.float32)
+            selected = maximal_marginal_relevance(
+                np.asarray(query_embedding, dtype=np.float32), embeddings, self.top_n, self.mmr_lambda)
+            selected_nodes = [nodes[position] for position in selected]
+
+        if self.strip_overlap:
+            selected_nodes = self._strip_overlaps(selected_nodes)
+        return selected_nodes
+
+    def _strip_overlaps(self, nodes: List[NodeWithScore]) -> List[NodeWithScore]:
+        texts = [node.node.get_content() for node in nodes]
+        for first in range(len(nodes)):
+            for second in range(len(nodes)):
+                if first == second or not isinstance(nodes[second].node, TextNode):
+                    continue
+                if nodes[first].node.ref_doc_id != nodes[second].node.ref_doc_id:
+                    continue
+                overlap = get_text_overlap(texts[first], texts[second], self.min_overlap_chars)
+                if overlap:
+                    texts[second] = texts[second][overlap:]
+
+        stripped_nodes = []
+        for node, text in zip(nodes, texts):
+            if not text.strip():
+                # The whole chunk is already in the context
+                continue
+            if text != node.node.get_content():
+                # Copy the node, the retrieved one may be shared with the docstore and caches
+                node = NodeWithScore(node=node.node.copy(update={"text": text}), score=node.score)
+            stripped_nodes.append(node)
+        return stripped_nodes
+
+
+def create_mmr_postprocessor(mmr: Union[None, bool, dict], top_n: int) -> Optional[MMRNodePostprocessor]:
+    """
+    Create an MMR node postprocessor from its config.
+
+    Parameters:
+        mmr: True for the default settings, or a dict with the MMRNodePostprocessor parameters (e.g.
+            {"mmr_lambda": 0.7, "candidates_factor": 4, "strip_overlap": false}). None or False disables it.
+        top_n (int): The number of nodes to select.
+
+    Returns:
+        MMRNodePostprocessor: The postprocessor, or None.
+    """
+    if not mmr:
+        return None
+    mmr_kwargs = {} if mmr is True else mmr
+    return MMRNodePostprocessor(top_n=top_n, **mmr_kwargs)
+
+
+class TokenBudgetNodePostprocessor(BaseNodePostprocessor):
+    """
+    Packs the retrieved nodes into a token budget greedily by relevance, so that the context of a query fits a
+    single LLM call instead of triggering refine calls.
+
+    Nodes are taken in their retrieved order, a node that does not fit is skipped for the next, smaller ones.
+    The budget is the context window left after the prompt, the query and the output, capped at token_budget.
+    The token counts stored in the node metadata at ingest time are used, the other nodes are counted once and
+    cached. The most relevant node is always kept, even when it alone exceeds the budget.
+
+    Parameters:
+        context_window: The context window of the LLM.
+        num_output: The tokens reserved for the LLM output.
+        prompt_tokens: The tokens of the prompt template and the system prompt without the context and query.
+        token_budget: The maximum number of context tokens. None fills the context window.
+    """
+
+    context_window: int = Field(description="The context window of the LLM.")
+    num_output: int = Field(default=256, description="The tokens reserved for the LLM output.")
+    prompt_tokens: int = Field(
+        default=0, description="The tokens of the prompt without the context and query.")
+    token_budget: Optional[int] = Field(default=None, description="The maximum number of context tokens.")
+
+    _token_counts: "OrderedDict[str, int]" = PrivateAttr(default_factory=OrderedDict)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "TokenBudgetNodePostprocessor"
+
+    def get_available_tokens(self, query_str: str = "") -> int:
+        """Get the number of context tokens that fit a single LLM call with the given query."""
+        available_tokens = (
+            self.context_window - self.num_output - self.prompt_tokens - count_tokens(query_str) -
+            CONTEXT_PADDING_TOKENS)
+        if self.token_budget is not None:
+            available_tokens = min(available_tokens, self.token_budget)
+        return max(available_tokens, 0)
+
+    def _get_token_count(self, node: BaseNode) -> int:
+        if TOKEN_COUNT_METADATA_KEY in node.metadata:
+            return get_node_token_count(node)
+
+        # The text is part of the key, the text of a node can be changed by the previous postprocessors
+        key = f"{node.node_id}:{hash(node.get_content())}"
+        with self._lock:
+            token_count = self._token_counts.get(key)
+        if token_count is None:
+            token_count = get_node_token_count(node)
+            with self._lock:
+                self._token_counts[key] = token_count
+                while len(self._token_counts) > TOKEN_COUNT_CACHE_SIZE:
+                    self._token_counts.popitem(last=False)
+        return token_count
+
+    def _postprocess_nodes(self,
+                           nodes: List[NodeWithScore],
+                           query_bundle: Optional[QueryBundle] = None) -> List[NodeWithScore]:
+        available_tokens = self.get_available_tokens(
+            query_bundle.query_str if query_bundle is not None else "")
+
+        packed_nodes = []
+        used_tokens = 0
+        for node in nodes:
+            node_tokens = self._get_token_count(node.node) + CHUNK_SEPARATOR_TOKENS
+            if used_tokens + node_tokens <= available_tokens or not packed_nodes:
+                packed_nodes.append(node)
+                used_tokens += node_tokens
+        return packed_nodes
+
+
+def create_token_budget_postprocessor(
+        service_context: ServiceContext,
+        response_synthesizer: BaseSynthesizer,
+        token_budget: Optional[int] = None) -> TokenBudgetNodePostprocessor:
+    """
+    Create a token budget node postprocessor packing the context into one call of the response synthesizer.
+
+    Parameters:
+        service_context (ServiceContext): The service context with the LLM context window and output size.
+        response_synthesizer (BaseSynthesizer): The response synthesizer whose first prompt gets the context.
+        token_budget (int): The maximum number of context tokens. None fills the context window.
+
+    Returns:
+        TokenBudgetNodePostprocessor: The postprocessor.
+    """
+    prompts = response_synthesizer.get_prompts()
+    prompt_template = prompts.get("text_qa_template") or prompts.get("summary_template")
+    prompt_tokens = count_tokens(service_context.llm_predictor.system_prompt or "")
+    if prompt_template is not None:
+        prompt_tokens += count_tokens(prompt_template.format(context_str="", query_str=""))
+
+    return TokenBudgetNodePostprocessor(
+        context_window=service_context.prompt_helper.context_window,
+        num_output=service_context.prompt_helper.num_output,
+        prompt_tokens=prompt_tokens,
+        token_budget=token_budget)
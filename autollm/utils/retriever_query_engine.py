@@ -0,0 +1,351 @@
+"""Retriever query engine with async token streaming, semantic caching, retrieval-only and batch support."""
+import asyncio
+from typing import Any, AsyncGenerator, Dict, List, Optional, Sequence, Tuple
+
+from llama_index import VectorStoreIndex
+from llama_index.callbacks.base import CallbackManager
+from llama_index.callbacks.schema import CBEventType, EventPayload
+from llama_index.core.base_retriever import BaseRetriever
+from llama_index.core.response.schema import RESPONSE_TYPE, Response
+from llama_index.postprocessor.types import BaseNodePostprocessor
+from llama_index.query_engine import RetrieverQueryEngine as RetrieverQueryEngineBase
+from llama_index.response_synthesizers import BaseSynthesizer
+from llama_index.schema import NodeWithScore, QueryBundle, QueryType
+from llama_index.vector_stores.types import ExactMatchFilter, MetadataFilters
+
+from autollm.utils.async_utils import get_stream_executor, run_in_thread
+from autollm.utils.embedding_batcher import aembed_queries
+from autollm.utils.logging import logger
+from autollm.utils.semantic_cache import SemanticCache
+
+DEFAULT_BATCH_CONCURRENCY = 4
+NODE_FIELDS = ("id", "score", "text", "metadata")
+
+
+def serialize_nodes(nodes: List[NodeWithScore],
+                    fields: Optional[Sequence[str]] = None) -> List[Dict[str, Any]]:
+    """
+    Serialize scored nodes to dicts with the given fields.
+
+    Parameters:
+        nodes (List[NodeWithScore]): The scored nodes.
+        fields (Sequence[str]): The returned fields among "id", "score", "text" and "metadata". None returns
+            all.
+
+    Returns:
+        List[Dict[str, Any]]: A dict per node.
+    """
+    fields = NODE_FIELDS if fields is None else fields
+    unknown_fields = set(fields) - set(NODE_FIELDS)
+    if unknown_fields:
+        raise ValueError(f"Unknown node fields: {sorted(unknown_fields)}, the fields are {list(NODE_FIELDS)}")
+
+    getters = {
+        "id": lambda node: node.node.node_id,
+        "score": lambda node: node.score,
+        "text": lambda node: node.node.get_content(),
+        "metadata": lambda node: node.node.metadata,
+    }
+    return [{field: getters[field](node) for field in fields} for node in nodes]
+
+
+class RetrieverQueryEngine(RetrieverQueryEngineBase):
+    """
+    Retriever query engine that can also stream the LLM tokens of its answers, and answer paraphrased repeats
+    of earlier queries from a semantic cache.
+
+    Parameters:
+        retriever (BaseRetriever): A retriever object.
+        response_synthesizer (BaseSynthesizer): The synthesizer used by query/aquery.
+        node_postprocessors (List[BaseNodePostprocessor]): Postprocessors applied to the retrieved nodes.
+        callback_manager (CallbackManager): A callback manager.
+        streaming_response_synthesizer (BaseSynthesizer): The synthesizer with streaming enabled used by
+            astream_query. If None, astream_query falls back to aquery.
+        vector_store_index (VectorStoreIndex): The index the retriever queries, shared with other query
+            engines built with the same ingestion settings.
+        semantic_cache (SemanticCache): Cache of the answers by query embedding, invalidated when the version
+            of the LanceDB table changes. Requires vector_store_index.
+        search_top_k (int): The number of nodes returned by search by default, e.g. the top_k of the task when
+            the retriever fetches more candidates for MMR. None uses the top_k of the query retriever.
+    """
+
+    def __init__(
+        self,
+        retriever: BaseRetriever,
+        response_synthesizer: Optional[BaseSynthesizer] = None,
+        node_postprocessors: Optional[List[BaseNodePostprocessor]] = None,
+        callback_manager: Optional[CallbackManager] = None,
+        streaming_response_synthesizer: Optional[BaseSynthesizer] = None,
+        vector_store_index: Optional[VectorStoreIndex] = None,
+        semantic_cache: Optional[SemanticCache] = None,
+        search_top_k: Optional[int] = None,
+    ) -> None:
+        if semantic_cache is not None and vector_store_index is None:
+            raise ValueError("semantic_cache requires vector_store_index")
+
+        self._streaming_response_synthesizer = streaming_response_synthesizer
+        self._vector_store_index = vector_store_index
+        self._semantic_cache = semantic_cache
+        self._search_top_k = search_top_k
+        super().__init__(
+            retriever=retriever,
+            response_synthesizer=response_synthesizer,
+            node_postprocessors=node_postprocessors,
+            callback_manager=callback_manager)
+
+    def with_retriever(self, retriever: BaseRetriever) -> "RetrieverQueryEngine":
+        return RetrieverQueryEngine(
+            retriever=retriever,
+            response_synthesizer=self._response_synthesizer,
+            node_postprocessors=self._node_postprocessors,
+            callback_manager=self.callback_manager,
+            streaming_response_synthesizer=self._streaming_response_synthesizer,
+            vector_store_index=self._vector_store_index,
+            semantic_cache=self._semantic_cache,
+            search_top_k=self._search_top_k,
+        )
+
+    @property
+    def vector_store_index(self) -> Optional[VectorStoreIndex]:
+        return self._vector_store_index
+
+    @property
+    def semantic_cache(self) -> Optional[SemanticCache]:
+        return self._semantic_cache
+
+    @property
+    def supports_streaming(self) -> bool:
+        return self._streaming_response_synthesizer is not None
+
+    def _get_search_retriever(self, top_k: Optional[int], filters: Optional[Dict[str, Any]]) -> BaseRetriever:
+        if top_k is None:
+            top_k = self._search_top_k
+        if top_k in (None, getattr(self._retriever, "_similarity_top_k", None)) and not filters:
+            return self._retriever
+        if self._vector_store_index is None:
+            raise ValueError("top_k and filters require vector_store_index")
+
+        # Keep the query mode (e.g. hybrid) and the other settings of the query retriever
+        retriever_kwargs = {}
+        for name in ("similarity_top_k", "vector_store_query_mode", "alpha", "sparse_top_k"):
+            if hasattr(self._retriever, f"_{name}"):
+                retriever_kwargs[name] = getattr(self._retriever, f"_{name}")
+        vector_store_kwargs = dict(getattr(self._retriever, "_kwargs", {}))
+        if top_k is not None:
+            retriever_kwargs["similarity_top_k"] = top_k
+        if filters:
+            retriever_kwargs["filters"] = MetadataFilters(
+                filters=[ExactMatchFilter(key=key, value=value) for key, value in filters.items()])
+            # Filter before the vector search, so that top_k matching nodes are returned
+            vector_store_kwargs["prefilter"] = True
+        return self._vector_store_index.as_retriever(
+            vector_store_kwargs=vector_store_kwargs, **retriever_kwargs)
+
+    def search(
+            self,
+            query: str,
+            top_k: Optional[int] = None,
+            filters: Optional[Dict[str, Any]] = None,
+            fields: Optional[Sequence[str]] = None) -> List[Dict[str, Any]]:
+        """
+        Retrieve the nodes relevant to a query without calling the LLM, e.g. for search UIs and agents that
+        generate their own answers. The node postprocessors and the semantic cache are not used.
+
+        Parameters:
+            query (str): The query.
+            top_k (int): The number of nodes to return. None uses search_top_k, or the top_k of the query
+                retriever.
+            filters (Dict[str, Any]): Metadata values the returned nodes must have, e.g.
+                {"file_name": "faq.md"}.
+            fields (Sequence[str]): The returned fields among "id", "score", "text" and "metadata". None
+                returns all.
+
+        Returns:
+            List[Dict[str, Any]]: A dict per node, by decreasing relevance.
+        """
+        retriever = self._get_search_retriever(top_k, filters)
+        return serialize_nodes(retriever.retrieve(query), fields)
+
+    async def asearch(
+            self,
+            query: str,
+            top_k: Optional[int] = None,
+            filters: Optional[Dict[str, Any]] = None,
+            fields: Optional[Sequence[str]] = None) -> List[Dict[str, Any]]:
+        """Asynchronously retrieve the nodes relevant to a query without calling the LLM, see search."""
+        retriever = self._get_search_retriever(top_k, filters)
+        return serialize_nodes(await retriever.aretrieve(query), fields)
+
+    def _get_index_version(self) -> Any:
+        get_table_version = getattr(self._vector_store_index.vector_store, "get_table_version", None)
+        return get_table_version() if get_table_version is not None else None
+
+    def _lookup_semantic_cache(self, query_bundle: QueryBundle) -> Tuple[Optional[Response], Any]:
+        """Embed the query (the embedding is reused for retrieval) and look up its cached answer."""
+        if query_bundle.embedding is None:
+            embed_model = self._vector_store_index.service_context.embed_model
+            query_bundle.embedding = embed_model.get_agg_embedding_from_queries(query_bundle.embedding_strs)
+        index_version = self._get_index_version()
+        return self._get_cached_response(query_bundle, index_version), index_version
+
+    async def _alookup_semantic_cache(self, query_bundle: QueryBundle) -> Tuple[Optional[Response], Any]:
+        if query_bundle.embedding is None:
+            embed_model = self._vector_store_index.service_context.embed_model
+            query_bundle.embedding = await embed_model.aget_agg_embedding_from_queries(
+                query_bundle.embedding_strs)
+        index_version = await run_in_thread(self._get_index_version)
+        return self._get_cached_response(query_bundle, index_version), index_version
+
+    def _get_cached_response(self, query_bundle: QueryBundle, index_version: Any) -> Optional[Response]:
+        entry = self._semantic_cache.lookup(query_bundle.embedding, index_version)
+        if entry is None:
+            return None
+        return Response(
+            response=entry.response.response,
+            source_nodes=entry.response.source_nodes,
+            metadata=dict(entry.response.metadata or {}, semantic_cache_query=entry.query))
+
+    def _add_to_semantic_cache(
+            self, query_bundle: QueryBundle, response: RESPONSE_TYPE, index_version: Any) -> None:
+        # Streamed answers are not complete yet when they are returned
+        if isinstance(response, Response) and response.response:
+            self._semantic_cache.add(query_bundle.embedding, query_bundle.query_str, response, index_version)
+
+    def _query(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        """Answer a query, from the semantic cache if a similar query was answered before."""
+        if self._semantic_cache is None:
+            return super()._query(query_bundle)
+
+        query_payload = {EventPayload.QUERY_STR: query_bundle.query_str}
+        with self.callback_manager.event(CBEventType.QUERY, payload=query_payload) as query_event:
+            response, index_version = self._lookup_semantic_cache(query_bundle)
+            if response is None:
+                nodes = self.retrieve(query_bundle)
+                response = self._response_synthesizer.synthesize(query=query_bundle, nodes=nodes)
+                self._add_to_semantic_cache(query_bundle, response, index_version)
+
+            query_event.on_end(payload={EventPayload.RESPONSE: response})
+
+        return response
+
+    async def _aquery(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        """Answer a query, from the semantic cache if a similar query was answered before."""
+        return await self._aanswer(query_bundle)
+
+    async def _aanswer(
+            self,
+            query_bundle: QueryBundle,
+            synthesis_semaphore: Optional[asyncio.Semaphore] = None) -> RESPONSE_TYPE:
+        """Answer a query, the response synthesis waits for synthesis_semaphore when given."""
+        query_payload = {EventPayload.QUERY_STR: query_bundle.query_str}
+        with self.callback_manager.event(CBEventType.QUERY, payload=query_payload) as query_event:
+            response, index_version = None, None
+            if self._semantic_cache is not None:
+                response, index_version = await self._alookup_semantic_cache(query_bundle)
+            if response is None:
+                nodes = await self.aretrieve(query_bundle)
+                if synthesis_semaphore is None:
+                    response = await self._response_synthesizer.asynthesize(query=query_bundle, nodes=nodes)
+                else:
+                    async with synthesis_semaphore:
+                        response = await self._response_synthesizer.asynthesize(
+                            query=query_bundle, nodes=nodes)
+                if self._semantic_cache is not None:
+                    self._add_to_semantic_cache(query_bundle, response, index_version)
+
+            query_event.on_end(payload={EventPayload.RESPONSE: response})
+
+        return response
+
+    async def abatch_query(
+            self,
+            queries: Sequence[str],
+            max_concurrency: int = DEFAULT_BATCH_CONCURRENCY
+    ) -> AsyncGenerator[Tuple[int, RESPONSE_TYPE], None]:
+        """
+        Answer many queries, yielding (position, response) pairs as the answers complete.
+
+        The queries are embedded together in batched calls, then retrieved concurrently, and at most
+        max_concurrency responses are synthesized at a time. A failed query yields its exception as the
+        response instead of stopping the batch.
+
+        ```python
+        async for position, response in query_engine.abatch_query(queries, max_concurrency=8):
+            if isinstance(response, Exception):
+                ...
+        ```
+
+        Parameters:
+            queries (Sequence[str]): The queries.
+            max_concurrency (int): The maximum number of concurrent response syntheses (LLM calls).
+
+        Yields:
+            (position, response) tuples, position being the index of the query in queries.
+        """
+        query_bundles = [QueryBundle(query) for query in queries]
+        if self._vector_store_index is not None and query_bundles:
+            embed_model = self._vector_store_index.service_context.embed_model
+            try:
+                embeddings = await aembed_queries(embed_model, [bundle.query_str for bundle in query_bundles])
+            except Exception:
+                # Each query is embedded with its own call instead, so that a failure only fails its query
+                logger.exception("Embedding the batch of queries failed.")
+            else:
+                for query_bundle, embedding in zip(query_bundles, embeddings):
+                    query_bundle.embedding = embedding
+
+        synthesis_semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def answer(position: int, query_bundle: QueryBundle) -> Tuple[int, RESPONSE_TYPE]:
+            try:
+                with self.callback_manager.as_trace("query"):
+                    return position, await self._aanswer(query_bundle, synthesis_semaphore)
+            except Exception as e:
+                return position, e
+
+        tasks = [
+            asyncio.ensure_future(answer(position, bundle)) for position, bundle in enumerate(query_bundles)
+        ]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            # The caller stopped iterating early, e.g. the client disconnected
+            for task in tasks:
+                task.cancel()
+
+    async def astream_query(self, str_or_query_bundle: QueryType) -> RESPONSE_TYPE:
+        """
+        Retrieve asynchronously and start streaming the answer from the LLM.
+
+        Returns a llama_index StreamingResponse as soon as the LLM starts answering, whose response_gen yields
+        the answer tokens as they are generated. Answers found in the semantic cache are returned as a
+        Response.
+        """
+        if self._streaming_response_synthesizer is None:
+            return await self.aquery(str_or_query_bundle)
+
+        if isinstance(str_or_query_bundle, str):
+            str_or_query_bundle = QueryBundle(str_or_query_bundle)
+
+        query_payload = {EventPayload.QUERY_STR: str_or_query_bundle.query_str}
+        with self.callback_manager.as_trace("query"):
+            with self.callback_manager.event(CBEventType.QUERY, payload=query_payload) as query_event:
+                if self._semantic_cache is not None:
+                    response, _ = await self._alookup_semantic_cache(str_or_query_bundle)
+                    if response is not None:
+                        query_event.on_end(payload={EventPayload.RESPONSE: response})
+                        return response
+
+                nodes = await self.aretrieve(str_or_query_bundle)
+                # The refine based synthesizers only stream synchronously, opening the LLM stream blocks until
+                # the first token arrives. It runs in the stream pool, which consumes the rest of the stream.
+                response = await run_in_thread(
+                    self._streaming_response_synthesizer.synthesize,
+                    query=str_or_query_bundle,
+                    nodes=nodes,
+                    executor=get_stream_executor())
+
+                query_event.on_end(payload={EventPayload.RESPONSE: response})
+
+        return response
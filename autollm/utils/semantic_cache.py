@@ -0,0 +1,138 @@
+"""Semantic answer cache matching paraphrased queries by the cosine similarity of their embeddings."""
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, List, Optional, Union
+
+import numpy as np
+from llama_index.core.response.schema import Response
+
+DEFAULT_SIMILARITY_THRESHOLD = 0.95
+DEFAULT_SEMANTIC_CACHE_MAX_SIZE = 1000
+
+
+@dataclass
+class SemanticCacheEntry:
+    query: str
+    response: Response
+    created_at: float
+
+
+class SemanticCache:
+    """
+    Caches the answers of a query engine by query embedding in a small in-memory vector index.
+
+    A query whose embedding has a cosine similarity of at least similarity_threshold with a cached query gets
+    the cached answer and source nodes. All entries are dropped when the version of the underlying index
+    changes, e.g. when documents are added to the LanceDB table.
+
+    Parameters:
+        similarity_threshold: The minimum cosine similarity of a cache hit.
+        max_size: The maximum number of cached answers. The oldest ones are evicted first.
+        ttl_seconds: The time an answer stays valid. None keeps answers until they are evicted.
+    """
+
+    def __init__(
+            self,
+            similarity_threshold: float = DEFAULT_SIMILARITY_THRESHOLD,
+            max_size: int = DEFAULT_SEMANTIC_CACHE_MAX_SIZE,
+            ttl_seconds: Optional[float] = None) -> None:
+        if not 0 < similarity_threshold <= 1:
+            raise ValueError("similarity_threshold must be in (0, 1]")
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+
+        self.similarity_threshold = similarity_threshold
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._embeddings: Optional[np.ndarray] = None
+        self._entries: List[SemanticCacheEntry] = []
+        self._index_version: Any = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._embeddings = None
+            self._entries = []
+
+    def _check_index_version(self, index_version: Any) -> None:
+        if index_version != self._index_version:
+            self._embeddings = None
+            self._entries = []
+            self._index_version = index_version
+
+    def lookup(self, embedding: List[float], index_version: Any = None) -> Optional[SemanticCacheEntry]:
+        """
+        Find the cached answer of the most similar query above the similarity threshold.
+
+        Parameters:
+            embedding (List[float]): The query embedding.
+            index_version: The current version of the queried index.
+
+        Returns:
+            SemanticCacheEntry: The cache entry, or None on a miss.
+        """
+        query_embedding = _normalize(embedding)
+        with self._lock:
+            self._check_index_version(index_version)
+            if self._embeddings is not None:
+                similarities = self._embeddings @ query_embedding
+                best = int(np.argmax(similarities))
+                entry = self._entries[best]
+                if similarities[best] >= self.similarity_threshold:
+                    if self.ttl_seconds is None or time.time() - entry.created_at <= self.ttl_seconds:
+                        self.hits += 1
+                        return entry
+                    self._remove(best)
+
+        self.misses += 1
+        return None
+
+    def add(self, embedding: List[float], query: str, response: Response, index_version: Any = None) -> None:
+        """Cache the answer of a query, made against the given version of the index."""
+        query_embedding = _normalize(embedding)
+        with self._lock:
+            self._check_index_version(index_version)
+            self._entries.append(SemanticCacheEntry(query=query, response=response, created_at=time.time()))
+            if self._embeddings is None:
+                self._embeddings = query_embedding[np.newaxis, :]
+            else:
+                self._embeddings = np.vstack([self._embeddings, query_embedding])
+            if len(self._entries) > self.max_size:
+                self._remove(0)
+
+    def _remove(self, position: int) -> None:
+        del self._entries[position]
+        self._embeddings = np.delete(self._embeddings, position, axis=0) if self._entries else None
+
+
+def _normalize(embedding: List[float]) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def create_semantic_cache(semantic_cache: Union[None, bool, dict, SemanticCache]) -> Optional[SemanticCache]:
+    """
+    Create a semantic cache from its config.
+
+    Parameters:
+        semantic_cache: True for the default settings, a dict with the SemanticCache parameters (e.g.
+            {"similarity_threshold": 0.97, "max_size": 500, "ttl_seconds": 3600}), or a SemanticCache
+            instance. None or False disables the cache.
+
+    Returns:
+        SemanticCache: The semantic cache, or None.
+    """
+    if not semantic_cache:
+        return None
+    if isinstance(semantic_cache, SemanticCache):
+        return semantic_cache
+    if semantic_cache is True:
+        return SemanticCache()
+    return SemanticCache(**semantic_cache)
@@ -0,0 +1,304 @@
+"""
+Offline stand-ins of the LLM and embedding backends, for tests and benchmarks that must not call paid APIs.
+
+The stubs are selected with a "stub/" model name, with their settings as query parameters:
+
+```python
+llm = AutoLiteLLM.from_defaults(model="stub/llm?latency_ms=300&tokens_per_second=50")
+embedding = AutoEmbedding(model="stub/embedding?dimension=384")
+```
+"""
+import asyncio
+import hashlib
+import math
+import re
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+from urllib.parse import parse_qsl
+
+from llama_index.bridge.pydantic import Field, PrivateAttr
+from llama_index.embeddings.base import BaseEmbedding, Embedding
+from llama_index.llms import (
+    ChatMessage,
+    ChatResponse,
+    ChatResponseAsyncGen,
+    ChatResponseGen,
+    CompletionResponse,
+    CompletionResponseAsyncGen,
+    CompletionResponseGen,
+    CustomLLM,
+    LLMMetadata,
+    MessageRole,
+)
+from llama_index.llms.base import llm_chat_callback, llm_completion_callback
+from llama_index.llms.generic_utils import (
+    completion_response_to_chat_response,
+    stream_completion_response_to_chat_response,
+)
+
+from autollm.utils.deadlines import check_deadline
+
+STUB_MODEL_PREFIX = "stub/"
+DEFAULT_STUB_EMBEDDING_DIMENSION = 256
+
+_WORD_PATTERN = re.compile(r"\w+")
+
+
+def is_stub_model(model: str) -> bool:
+    """Whether a model name selects an offline stub backend."""
+    return model.startswith(STUB_MODEL_PREFIX)
+
+
+def parse_stub_model(model: str) -> Dict[str, str]:
+    """
+    Parse the settings of a stub model name, e.g. "stub/llm?latency_ms=300&streaming=false".
+
+    Parameters:
+        model (str): The stub model name.
+
+    Returns:
+        Dict[str, str]: The settings of the stub, with the model name without its settings under "model".
+    """
+    if not is_stub_model(model):
+        raise ValueError(f"'{model}' is not a stub model, stub model names start with '{STUB_MODEL_PREFIX}'")
+    model_name, _, query = model.partition("?")
+    return {**dict(parse_qsl(query, strict_parsing=bool(query))), "model": model_name}
+
+
+def get_stub_embedding(text: str, dimension: int = DEFAULT_STUB_EMBEDDING_DIMENSION) -> Embedding:
+    """
+    Get a deterministic unit vector of a text by hashing its words into the dimensions of the vector, so that
+    texts sharing words have similar vectors and the retrieval results are meaningful.
+
+    Parameters:
+        text (str): The text to embed.
+        dimension (int): The dimension of the vector.
+
+    Returns:
+        Embedding: The vector of the text.
+    """
+    vector = [0.0] * dimension
+    for word in _WORD_PATTERN.findall(text.lower()):
+        word_hash = int.from_bytes(hashlib.blake2b(word.encode(), digest_size=8).digest(), "little")
+        vector[word_hash % dimension] += 1.0 if word_hash >> 63 else -1.0
+    norm = math.sqrt(sum(value * value for value in vector))
+    if norm == 0:
+        vector[0] = 1.0
+        return vector
+    return [value / norm for value in vector]
+
+
+class StubLLMError(Exception):
+    """Error of a failing StubLLM call, with the status code of the API error it stands for."""
+
+    def __init__(self, status_code: int) -> None:
+        super().__init__(f"The stub LLM call failed with status code {status_code}")
+        self.status_code = status_code
+
+
+class StubEmbedding(BaseEmbedding):
+    """
+    Embedding model returning deterministic hash-based vectors without any network call. Each call waits
+    latency_ms, whatever the number of texts embedded, like a batched API call.
+    """
+
+    dimension: int = Field(
+        default=DEFAULT_STUB_EMBEDDING_DIMENSION, description="The dimension of the vectors.", gt=0)
+    latency_ms: float = Field(default=0.0, description="The time each call takes.", ge=0)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "StubEmbedding"
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        return self._get_text_embeddings([query])[0]
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        return (await self._aget_text_embeddings([query]))[0]
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        return (await self._aget_text_embeddings([text]))[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        check_deadline()
+        time.sleep(self.latency_ms / 1000)
+        return [get_stub_embedding(text, self.dimension) for text in texts]
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        check_deadline()
+        await asyncio.sleep(self.latency_ms / 1000)
+        return [get_stub_embedding(text, self.dimension) for text in texts]
+
+
+class StubLLM(CustomLLM):
+    """
+    LLM generating a deterministic answer from the words of the prompt without any network call, with the
+    timing of a real backend: the first token comes after latency_ms, and the next ones at tokens_per_second.
+    A backend with streaming disabled sends the whole answer at once, when it is fully generated.
+
+    The stub records the prompts of its calls and the number of concurrent calls, and fails like an API with
+    error_status_code (e.g. 429 for a rate limit) when it is set.
+    """
+
+    model: str = Field(default="stub/llm", description="The model name.")
+    latency_ms: float = Field(default=0.0, description="The time until the first token.", ge=0)
+    tokens_per_second: float = Field(default=0.0, description="The generation speed, 0 for instant.", ge=0)
+    output_tokens: int = Field(default=32, description="The number of tokens of each answer.", gt=0)
+    max_tokens: int = Field(default=256, description="The maximum number of tokens generated.", gt=0)
+    context_window: int = Field(
+        default=4096, description="The context window reported by the metadata.", gt=0)
+    streaming: bool = Field(default=True, description="Whether tokens are streamed as they are generated.")
+    error_status_code: Optional[int] = Field(
+        default=None,
+        description="The status code of the StubLLMError raised by the calls, None to not fail.")
+    error_on: Optional[str] = Field(
+        default=None, description="The text of the prompts that fail, None to fail all of them.")
+
+    _prompts: List[str] = PrivateAttr(default_factory=list)
+    _running: int = PrivateAttr(default=0)
+    _max_running: int = PrivateAttr(default=0)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "StubLLM"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        # Prompted with chat messages like LiteLLM, so the query wrapper prompt is not applied
+        return LLMMetadata(
+            context_window=self.context_window,
+            num_output=self.max_tokens,
+            is_chat_model=True,
+            model_name=self.model)
+
+    @property
+    def prompts(self) -> List[str]:
+        """The prompts of the calls made so far."""
+        with self._lock:
+            return list(self._prompts)
+
+    @property
+    def running(self) -> int:
+        """The number of calls in progress."""
+        return self._running
+
+    @property
+    def max_running(self) -> int:
+        """The highest number of concurrent calls so far."""
+        return self._max_running
+
+    def _start_call(self, prompt: str) -> None:
+        with self._lock:
+            self._prompts.append(prompt)
+            self._running += 1
+            self._max_running = max(self._max_running, self._running)
+
+    def _end_call(self) -> None:
+        with self._lock:
+            self._running -= 1
+
+    def _check_error(self, prompt: str) -> None:
+        if self.error_status_code is not None and (self.error_on is None or self.error_on in prompt):
+            raise StubLLMError(self.error_status_code)
+
+    def _get_tokens(self, prompt: str) -> List[str]:
+        words = _WORD_PATTERN.findall(prompt) or ["stub"]
+        num_tokens = min(self.output_tokens, self.max_tokens)
+        # The answer repeats the end of the prompt, where the query is
+        return [words[(len(words) - num_tokens + i) % len(words)] + " " for i in range(num_tokens)]
+
+    def _get_delays(self, num_tokens: int) -> List[float]:
+        """The seconds waited before each streamed chunk, after the latency of the first token."""
+        token_seconds = 1 / self.tokens_per_second if self.tokens_per_second else 0.0
+        if not self.streaming:
+            return [self.latency_ms / 1000 + num_tokens * token_seconds]
+        return [self.latency_ms / 1000 + token_seconds] + [token_seconds] * (num_tokens - 1)
+
+    def _get_chunks(self, tokens: Sequence[str]) -> List[str]:
+        return list(tokens) if self.streaming else ["".join(tokens)]
+
+    def _generate(self, prompt: str) -> Iterator[CompletionResponse]:
+        check_deadline()
+        self._start_call(prompt)
+        try:
+            self._check_error(prompt)
+            tokens = self._get_tokens(prompt)
+            text = ""
+            for delay, delta in zip(self._get_delays(len(tokens)), self._get_chunks(tokens)):
+                time.sleep(delay)
+                text += delta
+                yield CompletionResponse(text=text, delta=delta)
+        finally:
+            self._end_call()
+
+    async def _agenerate(self, prompt: str) -> CompletionResponseAsyncGen:
+        check_deadline()
+        self._start_call(prompt)
+        try:
+            self._check_error(prompt)
+            tokens = self._get_tokens(prompt)
+            text = ""
+            for delay, delta in zip(self._get_delays(len(tokens)), self._get_chunks(tokens)):
+                await asyncio.sleep(delay)
+                text += delta
+                yield CompletionResponse(text=text, delta=delta)
+        finally:
+            self._end_call()
+
+    def _complete(self, prompt: str) -> CompletionResponse:
+        *_, response = self._generate(prompt)
+        return CompletionResponse(text=response.text)
+
+    async def _acomplete(self, prompt: str) -> CompletionResponse:
+        text = ""
+        async for response in self._agenerate(prompt):
+            text = response.text
+        return CompletionResponse(text=text)
+
+    # The chat methods do not call the completion methods, so that each call is a single LLM callback event
+
+    @llm_completion_callback()
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        return self._complete(prompt)
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponseGen:
+        return self._generate(prompt)
+
+    @llm_completion_callback()
+    async def acomplete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        return await self._acomplete(prompt)
+
+    @llm_completion_callback()
+    async def astream_complete(
+            self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponseAsyncGen:
+        return self._agenerate(prompt)
+
+    @llm_chat_callback()
+    def chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        return completion_response_to_chat_response(self._complete(self.messages_to_prompt(messages)))
+
+    @llm_chat_callback()
+    def stream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponseGen:
+        return stream_completion_response_to_chat_response(self._generate(self.messages_to_prompt(messages)))
+
+    @llm_chat_callback()
+    async def achat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        return completion_response_to_chat_response(await self._acomplete(self.messages_to_prompt(messages)))
+
+    @llm_chat_callback()
+    async def astream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponseAsyncGen:
+        completion_response_gen = self._agenerate(self.messages_to_prompt(messages))
+
+        async def gen() -> ChatResponseAsyncGen:
+            async for response in completion_response_gen:
+                yield ChatResponse(
+                    message=ChatMessage(role=MessageRole.ASSISTANT, content=response.text),
+                    delta=response.delta)
+
+        return gen()
@@ -29,3 +29,14 @@ Given the new context, refine the original answer to better
 answer the query (only if necessary).
 Refined Answer:
 '''
+
+MAP_REDUCE_PROMPT_TEMPLATE = '''
+Answers to the query, each based on a different part of the document information, are below.
+---------------------
+{context_str}
+---------------------
+Combine them into a single answer to the query, leaving out the answers saying
+that the information is not available.
+Query: {query_str}
+Answer:
+'''
@@ -0,0 +1,52 @@
+"""Token counts of nodes, computed once at ingest time and stored with the nodes."""
+from typing import Any, Dict, List, Optional, Sequence
+
+from llama_index.extractors.interface import BaseExtractor
+from llama_index.schema import BaseNode, MetadataMode
+from llama_index.utils import get_tokenizer
+
+TOKEN_COUNT_METADATA_KEY = "token_count"
+
+
+def count_tokens(text: str) -> int:
+    """Count the tokens of a text with the global llama_index tokenizer."""
+    return len(get_tokenizer()(text))
+
+
+def get_node_token_count(node: BaseNode) -> int:
+    """Get the token count of the LLM content of a node, from its metadata if counted at ingest time."""
+    token_count = node.metadata.get(TOKEN_COUNT_METADATA_KEY)
+    if token_count is not None:
+        return int(token_count)
+    return count_tokens(node.get_content(metadata_mode=MetadataMode.LLM))
+
+
+class TokenCountExtractor(BaseExtractor):
+    """
+    Stores the token count of the LLM content of each node in its "token_count" metadata, so that the context
+    of a query can be packed without tokenizing the retrieved nodes. The count is not shown to the LLM nor
+    embedded. Run it as the last transformation, after the other extractors added their metadata.
+    """
+
+    disable_template_rewrite: bool = True
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "TokenCountExtractor"
+
+    async def aextract(self, nodes: Sequence[BaseNode]) -> List[Dict]:
+        return [{
+            TOKEN_COUNT_METADATA_KEY: count_tokens(node.get_content(metadata_mode=MetadataMode.LLM))
+        } for node in nodes]
+
+    async def aprocess_nodes(
+            self,
+            nodes: List[BaseNode],
+            excluded_embed_metadata_keys: Optional[List[str]] = None,
+            excluded_llm_metadata_keys: Optional[List[str]] = None,
+            **kwargs: Any) -> List[BaseNode]:
+        return await super().aprocess_nodes(
+            nodes,
+            excluded_embed_metadata_keys=(excluded_embed_metadata_keys or []) + [TOKEN_COUNT_METADATA_KEY],
+            excluded_llm_metadata_keys=(excluded_llm_metadata_keys or []) + [TOKEN_COUNT_METADATA_KEY],
+            **kwargs)
@@ -36,18 +36,19 @@ IGNORED_TAGS = [
 class WebPageReader:
     """A class for reading and processing the content of a single web page."""
 
-    def load_data(self, url: str) -> List[Document]:
+    def load_data(self, url: str, allow_redirects: bool = True) -> List[Document]:
         """
         Reads a web page from the provided URL, extracts content using predefined selectors, removes all
         ignored tags, and returns a list of Document objects with the processed content.
 
         Parameters:
             url (str): The URL of the web page to read.
+            allow_redirects (bool): Whether to follow redirects, a redirected page is not read otherwise.
 
         Returns:
             List[Document]: A list containing Document objects with the processed content and its metadata.
         """
-        response = requests.get(url, timeout=WEBPAGE_READER_TIMEOUT)
+        response = requests.get(url, timeout=WEBPAGE_READER_TIMEOUT, allow_redirects=allow_redirects)
         if response.status_code != 200:
             logger.info(f"Failed to fetch the website: {response.status_code}")
             return []
@@ -0,0 +1,111 @@
+"""
+Measure the throughput of the AutoFastAPI /query endpoint under concurrent clients.
+
+The query engine is a real AutoQueryEngine over a temporary LanceDB table, with the offline stub LLM and
+embedding backends standing in for the API latency, so that retrieval, synthesis and serving all run their
+production code. The "async" engine is served as is, on the async query path. The "blocking" engine wraps the
+same query engine and calls its sync query from the async handler, blocking the event loop. The throughput of
+the "async" engine scales with the number of concurrent clients, the "blocking" one stays flat.
+
+Usage:
+    python benchmarks/benchmark_concurrency.py --llm-latency-ms 100 --requests 64 --concurrency 1 4 16 64
+"""
+import argparse
+import asyncio
+import json
+import tempfile
+import time
+from typing import Any
+
+import httpx
+from llama_index import Document
+from llama_index.indices.query.base import BaseQueryEngine
+from llama_index.response.schema import RESPONSE_TYPE
+from llama_index.schema import QueryBundle
+
+from autollm.auto.fastapi_app import AutoFastAPI
+from autollm.auto.query_engine import AutoQueryEngine
+
+
+class BlockingQueryEngine(BaseQueryEngine):
+    """Query engine answering its async queries with the sync query of another engine, on the event loop."""
+
+    def __init__(self, query_engine: BaseQueryEngine) -> None:
+        self._query_engine = query_engine
+        super().__init__(callback_manager=query_engine.callback_manager)
+
+    def _get_prompt_modules(self) -> dict:
+        return {}
+
+    def _query(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        return self._query_engine.query(query_bundle)
+
+    async def _aquery(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        return self._query_engine.query(query_bundle)
+
+
+def make_query_engine(lancedb_uri: str, num_documents: int, llm_model: str, embed_model: str) -> Any:
+    documents = [
+        Document(text=f"Document {number} explains how feature {number} of the product is configured.")
+        for number in range(num_documents)
+    ]
+    return AutoQueryEngine.from_defaults(
+        documents=documents,
+        lancedb_uri=lancedb_uri,
+        llm_model=llm_model,
+        embed_model=embed_model,
+        enable_cost_calculator=False)
+
+
+async def run_clients(app, num_requests: int, concurrency: int) -> float:
+    """Send num_requests queries with the given number of concurrent clients, return the throughput in QPS."""
+    semaphore = asyncio.Semaphore(concurrency)
+    transport = httpx.ASGITransport(app=app)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+
+        async def send(i: int) -> None:
+            async with semaphore:
+                response = await client.post("/query", json={"user_query": f"how is feature {i} configured?"})
+                response.raise_for_status()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(send(i) for i in range(num_requests)))
+        elapsed = time.perf_counter() - start
+
+    return num_requests / elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--llm-latency-ms", type=float, default=100.0, help="Latency of a stub LLM call in milliseconds.")
+    parser.add_argument(
+        "--embed-latency-ms",
+        type=float,
+        default=10.0,
+        help="Latency of a stub embedding call in milliseconds.")
+    parser.add_argument("--documents", type=int, default=100, help="Number of documents in the table.")
+    parser.add_argument("--requests", type=int, default=64, help="Number of requests per run.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    args = parser.parse_args()
+
+    llm_model = f"stub/llm?latency_ms={args.llm_latency_ms}"
+    embed_model = f"stub/embedding?latency_ms={args.embed_latency_ms}"
+    results = []
+    with tempfile.TemporaryDirectory() as lancedb_dir:
+        query_engine = make_query_engine(lancedb_dir, args.documents, llm_model, embed_model)
+        for mode in ("async", "blocking"):
+            served_engine = query_engine if mode == "async" else BlockingQueryEngine(query_engine)
+            app = AutoFastAPI.from_query_engine(served_engine, enable_metrics=False, enable_coalescing=False)
+            for concurrency in args.concurrency:
+                qps = asyncio.run(run_clients(app, args.requests, concurrency))
+                results.append({"mode": mode, "concurrency": concurrency, "qps": round(qps, 2)})
+                print(f"{mode:>8} engine, {concurrency:>3} clients: {qps:8.2f} queries/s")
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
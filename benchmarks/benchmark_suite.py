@@ -0,0 +1,320 @@
+"""
+End-to-end benchmark of ingestion, retrieval and serving on a synthetic corpus, with the offline stub LLM and
+embedding backends so that no API is called and the results only depend on the code of autollm.
+
+Stages:
+    reading: read_files_as_documents throughput on the markdown files of the corpus.
+    ingestion: throughput of chunking with the node parser of the service context and of embedding the
+        chunks.
+    retrieval: LanceDBVectorStore.query latency at several table sizes, with brute-force search (no ANN
+        index).
+    serving: AutoFastAPI /query throughput and latency percentiles under concurrent clients.
+
+The results are written to a JSON file with the commit they were measured at. Pass the result file of a
+previous commit as --baseline to print the relative change of each metric.
+
+Usage:
+    python benchmarks/benchmark_suite.py --documents 200 --table-sizes 1000 10000 --output results.json
+    python benchmarks/benchmark_suite.py --stages retrieval serving --baseline results.json
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+import httpx
+from llama_index import Document
+from llama_index.ingestion import run_transformations
+from llama_index.schema import TextNode
+from llama_index.vector_stores.types import VectorStoreQuery
+
+from autollm.auto.embedding import AutoEmbedding
+from autollm.auto.fastapi_app import AutoFastAPI
+from autollm.auto.query_engine import AutoQueryEngine
+from autollm.auto.service_context import AutoServiceContext
+from autollm.utils.document_reading import read_files_as_documents
+from autollm.utils.lancedb_vectorstore import LanceDBVectorStore
+from autollm.utils.stub_backends import get_stub_embedding
+
+STAGES = ("reading", "ingestion", "retrieval", "serving")
+# Latency metrics are better lower, throughput metrics higher, the other values are counts and not compared
+LATENCY_SUFFIXES = ("_ms", "_seconds")
+THROUGHPUT_SUFFIXES = ("_per_second", "qps")
+TABLE_BATCH_SIZE = 5000
+
+
+def generate_words(rng: random.Random, vocabulary: Sequence[str], num_words: int) -> str:
+    return " ".join(rng.choice(vocabulary) for _ in range(num_words))
+
+
+def get_vocabulary(size: int = 2000, seed: int = 0) -> List[str]:
+    rng = random.Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return ["".join(rng.choice(letters) for _ in range(rng.randint(3, 10))) for _ in range(size)]
+
+
+def generate_corpus(corpus_dir: Path, num_documents: int, words_per_document: int, seed: int = 0) -> int:
+    """Write markdown documents of sections of random words to corpus_dir, return their size in bytes."""
+    rng = random.Random(seed)
+    vocabulary = get_vocabulary(seed=seed)
+    corpus_dir.mkdir(parents=True, exist_ok=True)
+    total_bytes = 0
+    for document_number in range(num_documents):
+        sections = []
+        for _ in range(max(words_per_document // 100, 1)):
+            sections.append(
+                f"## {generate_words(rng, vocabulary, 3)}\n\n{generate_words(rng, vocabulary, 100)}\n")
+        text = f"# document {document_number}\n\n" + "\n".join(sections)
+        total_bytes += (corpus_dir / f"document_{document_number}.md").write_text(text)
+    return total_bytes
+
+
+def get_latency_stats(latencies: Sequence[float]) -> Dict[str, float]:
+    """Get the mean and percentiles of latencies in seconds, in milliseconds."""
+    latencies = sorted(latencies)
+
+    def percentile(value: float) -> float:
+        return latencies[min(len(latencies) - 1, int(len(latencies) * value / 100))] * 1000
+
+    return {
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+        "p50_ms": round(percentile(50), 3),
+        "p90_ms": round(percentile(90), 3),
+        "p99_ms": round(percentile(99), 3),
+    }
+
+
+def benchmark_reading(corpus_dir: Path, corpus_bytes: int) -> Dict[str, Any]:
+    start = time.perf_counter()
+    documents = read_files_as_documents(input_dir=str(corpus_dir), show_progress=False)
+    elapsed = time.perf_counter() - start
+    return {
+        "documents": len(documents),
+        "elapsed_seconds": round(elapsed, 3),
+        "documents_per_second": round(len(documents) / elapsed, 2),
+        "megabytes_per_second": round(corpus_bytes / elapsed / 1e6, 3),
+    }
+
+
+def benchmark_ingestion(
+        documents: Sequence[Document], embed_model: str, chunk_size: int,
+        embed_batch_size: int) -> Dict[str, Any]:
+    service_context = AutoServiceContext.from_defaults(
+        llm=None,
+        embed_model=AutoEmbedding(model=embed_model, embed_batch_size=embed_batch_size),
+        chunk_size=chunk_size)
+
+    start = time.perf_counter()
+    nodes = run_transformations(documents, service_context.transformations)
+    chunking_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    service_context.embed_model.get_text_embedding_batch([node.get_content() for node in nodes])
+    embedding_seconds = time.perf_counter() - start
+
+    return {
+        "documents": len(documents),
+        "nodes": len(nodes),
+        "chunking_seconds": round(chunking_seconds, 3),
+        "chunking_documents_per_second": round(len(documents) / chunking_seconds, 2),
+        "embedding_seconds": round(embedding_seconds, 3),
+        "embedding_nodes_per_second": round(len(nodes) / embedding_seconds, 2),
+        "documents_per_second": round(len(documents) / (chunking_seconds + embedding_seconds), 2),
+    }
+
+
+def benchmark_retrieval(
+        lancedb_uri: str,
+        table_sizes: Sequence[int],
+        dimension: int,
+        num_queries: int,
+        top_k: int,
+        seed: int = 0) -> Dict[str, Any]:
+    """Grow a table to each size in turn and measure the latency of vector queries at that size."""
+    rng = random.Random(seed)
+    vocabulary = get_vocabulary(seed=seed)
+    vector_store = LanceDBVectorStore(uri=lancedb_uri, table_name="benchmark")
+    results = {}
+    num_nodes = 0
+    for table_size in sorted(table_sizes):
+        while num_nodes < table_size:
+            batch_size = min(TABLE_BATCH_SIZE, table_size - num_nodes)
+            texts = [generate_words(rng, vocabulary, 50) for _ in range(batch_size)]
+            vector_store.add(
+                [TextNode(text=text, embedding=get_stub_embedding(text, dimension)) for text in texts])
+            num_nodes += batch_size
+
+        queries = [
+            VectorStoreQuery(
+                query_embedding=get_stub_embedding(generate_words(rng, vocabulary, 8), dimension),
+                similarity_top_k=top_k) for _ in range(num_queries)
+        ]
+        vector_store.query(queries[0])  # Warm up the table
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            vector_store.query(query)
+            latencies.append(time.perf_counter() - start)
+        results[str(table_size)] = get_latency_stats(latencies)
+        print(f"retrieval, {table_size:>7} rows: p50 {results[str(table_size)]['p50_ms']:.2f} ms")
+    return results
+
+
+async def run_clients(app, num_requests: int, concurrency: int) -> Dict[str, Any]:
+    """Send num_requests queries with the given number of concurrent clients, return the QPS and latencies."""
+    semaphore = asyncio.Semaphore(concurrency)
+    transport = httpx.ASGITransport(app=app)
+    latencies = []
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+
+        async def send(i: int) -> None:
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.post("/query", json={"user_query": f"benchmark query number {i}"})
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(send(i) for i in range(num_requests)))
+        elapsed = time.perf_counter() - start
+
+    return {"qps": round(num_requests / elapsed, 2), **get_latency_stats(latencies)}
+
+
+def benchmark_serving(
+        documents: Sequence[Document], lancedb_uri: str, llm_model: str, embed_model: str,
+        concurrency_levels: Sequence[int], num_requests: int) -> Dict[str, Any]:
+    query_engine = AutoQueryEngine.from_defaults(
+        documents=documents, lancedb_uri=lancedb_uri, llm_model=llm_model, embed_model=embed_model)
+    app = AutoFastAPI.from_query_engine(query_engine, enable_metrics=False)
+    results = {}
+    for concurrency in concurrency_levels:
+        results[str(concurrency)] = asyncio.run(run_clients(app, num_requests, concurrency))
+        print(
+            f"serving, {concurrency:>3} clients: {results[str(concurrency)]['qps']:8.2f} queries/s, "
+            f"p99 {results[str(concurrency)]['p99_ms']:.1f} ms")
+    return results
+
+
+def get_git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"],
+                              cwd=Path(__file__).parent,
+                              capture_output=True,
+                              text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten_metrics(results: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+    metrics = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            metrics.update(flatten_metrics(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            metrics[f"{prefix}{key}"] = value
+    return metrics
+
+
+def compare_results(results: Dict[str, Any], baseline: Dict[str, Any]) -> None:
+    """Print the relative change of each metric measured in both runs, flagging the regressions over 10%."""
+    print(f"\ncompared to {baseline.get('commit')}:")
+    workload_parameters = [{
+        name: value
+        for name, value in run.get("parameters", {}).items() if name not in ("output", "baseline")
+    } for run in (results, baseline)]
+    if workload_parameters[0] != workload_parameters[1]:
+        print("the parameters of the runs differ, the metrics may not be comparable")
+    metrics = flatten_metrics(results["stages"])
+    baseline_metrics = flatten_metrics(baseline["stages"])
+    for name, value in metrics.items():
+        baseline_value = baseline_metrics.get(name)
+        if not baseline_value or not name.endswith(LATENCY_SUFFIXES + THROUGHPUT_SUFFIXES):
+            continue
+        change = (value - baseline_value) / baseline_value
+        is_regression = change > 0.1 if name.endswith(LATENCY_SUFFIXES) else change < -0.1
+        regression = " REGRESSION" if is_regression else ""
+        print(f"{name:<55} {baseline_value:>12} -> {value:>12} ({change:+.1%}){regression}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    parser.add_argument("--documents", type=int, default=200, help="Number of documents of the corpus.")
+    parser.add_argument("--words-per-document", type=int, default=1000)
+    parser.add_argument("--chunk-size", type=int, default=512)
+    parser.add_argument("--embed-batch-size", type=int, default=64)
+    parser.add_argument("--dimension", type=int, default=384, help="Dimension of the stub embeddings.")
+    parser.add_argument(
+        "--embed-latency-ms", type=float, default=0.0, help="Latency of a stub embedding call.")
+    parser.add_argument("--table-sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--queries", type=int, default=100, help="Number of queries per table size.")
+    parser.add_argument("--top-k", type=int, default=6)
+    parser.add_argument(
+        "--llm-latency-ms", type=float, default=200.0, help="Time to first token of the stub LLM.")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0, help="Stub LLM speed, 0 for instant.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=64, help="Number of requests per concurrency level.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_results.json", help="Path of the JSON results.")
+    parser.add_argument("--baseline", default=None, help="Path of the JSON results to compare to.")
+    args = parser.parse_args()
+
+    embed_model = f"stub/embedding?dimension={args.dimension}&latency_ms={args.embed_latency_ms}"
+    llm_model = f"stub/llm?latency_ms={args.llm_latency_ms}&tokens_per_second={args.tokens_per_second}"
+    stages = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        corpus_dir = Path(tmp_dir) / "corpus"
+        corpus_bytes = generate_corpus(corpus_dir, args.documents, args.words_per_document, seed=args.seed)
+        documents = read_files_as_documents(input_dir=str(corpus_dir), show_progress=False)
+
+        if "reading" in args.stages:
+            stages["reading"] = benchmark_reading(corpus_dir, corpus_bytes)
+            print(f"reading: {stages['reading']['documents_per_second']:.1f} documents/s")
+        if "ingestion" in args.stages:
+            stages["ingestion"] = benchmark_ingestion(
+                documents, embed_model, chunk_size=args.chunk_size, embed_batch_size=args.embed_batch_size)
+            print(f"ingestion: {stages['ingestion']['documents_per_second']:.1f} documents/s")
+        if "retrieval" in args.stages:
+            stages["retrieval"] = benchmark_retrieval(
+                str(Path(tmp_dir) / "retrieval"),
+                args.table_sizes,
+                args.dimension,
+                num_queries=args.queries,
+                top_k=args.top_k,
+                seed=args.seed)
+        if "serving" in args.stages:
+            stages["serving"] = benchmark_serving(
+                documents,
+                str(Path(tmp_dir) / "serving"),
+                llm_model,
+                embed_model,
+                concurrency_levels=args.concurrency,
+                num_requests=args.requests)
+
+    results = {
+        "commit": get_git_commit(),
+        "created_at": time.time(),
+        "python_version": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": vars(args),
+        "stages": stages,
+    }
+    Path(args.output).write_text(json.dumps(results, indent=2))
+    print(f"results written to {args.output}")
+
+    if args.baseline is not None:
+        compare_results(results, json.loads(Path(args.baseline).read_text()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+import pytest
+from llama_index import Document
+
+from autollm.auto.query_engine import AutoQueryEngine
+
+
+@pytest.fixture
+def make_query_engine(tmp_path):
+    """Build query engines over a temporary LanceDB table, with the offline stub LLM and embedding models."""
+
+    def make(documents=None, **kwargs):
+        params = {
+            "llm_model": "stub/llm",
+            "embed_model": "stub/embedding",
+            "lancedb_uri": str(tmp_path / "lancedb"),
+            "enable_cost_calculator": False,
+            **kwargs
+        }
+        return AutoQueryEngine.from_defaults(
+            documents=documents or [Document(text="autollm ships rag apps")], **params)
+
+    return make
@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+
+from autollm.serve.admission import AdmissionController, AdmissionLimit, AdmissionRejectedError
+
+
+def test_admission_queues_requests_over_the_limit():
+    changes = []
+    controller = AdmissionController(
+        default_limit=AdmissionLimit(max_concurrency=1, max_queue_size=1),
+        on_change=lambda task, running, queued: changes.append((running, queued)))
+
+    async def run():
+        first = await controller.acquire("qa")
+        second = asyncio.ensure_future(controller.acquire("qa"))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejectedError) as error:
+            await controller.acquire("qa")
+        first.release()
+        (await second).release()
+        return error.value
+
+    error = asyncio.run(run())
+
+    assert error.status_code == 429
+    assert error.retry_after > 0
+    assert changes == [(1, 0), (1, 1), (1, 0), (1, 0), (0, 0)]
+    assert controller.get_status("qa") == {"running": 0, "queued": 0}
+
+
+def test_admission_rejects_requests_waiting_too_long():
+    controller = AdmissionController(
+        task_limits={"qa": AdmissionLimit(max_concurrency=1, max_queue_size=4, max_queue_seconds=0.01)})
+
+    async def run():
+        ticket = await controller.acquire("qa")
+        with pytest.raises(AdmissionRejectedError) as error:
+            await controller.acquire("qa")
+        # Tasks without limits are not queued
+        await controller.acquire("summarize")
+        ticket.release()
+        ticket.release()
+        return error.value
+
+    error = asyncio.run(run())
+
+    assert error.status_code == 503
+    assert controller.get_status("qa") == {"running": 0, "queued": 0}
@@ -0,0 +1,69 @@
+import asyncio
+import json
+
+from fastapi.testclient import TestClient
+from llama_index.callbacks import CBEventType, EventPayload, LlamaDebugHandler
+from llama_index.query_engine import RetrieverQueryEngine as BaseRetrieverQueryEngine
+
+from autollm.auto.fastapi_app import AutoFastAPI
+from autollm.utils.stub_backends import StubLLMError
+
+# The queries containing "fail" fail with a server error
+LLM_MODEL = "stub/llm?latency_ms=10&error_status_code=500&error_on=fail"
+
+
+def test_batch_query_embeds_in_batches_and_bounds_concurrency(make_query_engine):
+    query_engine = make_query_engine(llm_model=LLM_MODEL, similarity_top_k=1)
+    service_context = query_engine.vector_store_index.service_context
+    service_context.embed_model.embed_batch_size = 4
+    debug_handler = LlamaDebugHandler()
+    query_engine.callback_manager.add_handler(debug_handler)
+    queries = [f"question {number}" for number in range(10)] + ["please fail"]
+
+    async def run():
+        return [result async for result in query_engine.abatch_query(queries, max_concurrency=3)]
+
+    results = dict(asyncio.run(run()))
+
+    assert sorted(results) == list(range(11))
+    assert all(results[position].response for position in range(10))
+    assert isinstance(results[10], StubLLMError)
+    embedding_batches = [
+        end_event.payload[EventPayload.CHUNKS]
+        for _, end_event in debug_handler.get_event_pairs(CBEventType.EMBEDDING)
+    ]
+    assert [len(batch) for batch in embedding_batches] == [4, 4, 3]
+    assert service_context.llm.max_running == 3
+
+
+def test_batch_query_endpoint_streams_ndjson(make_query_engine):
+    query_engine = make_query_engine(llm_model=LLM_MODEL, similarity_top_k=1)
+    client = TestClient(AutoFastAPI.from_query_engine(query_engine))
+
+    response = client.post("/query/batch", json={"queries": ["what is autollm?", "please fail"]})
+    empty_response = client.post("/query/batch", json={"queries": []})
+
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    results = sorted((json.loads(line) for line in response.text.splitlines()),
+                     key=lambda item: item["index"])
+    assert results[0]["response"]
+    assert results[0]["source_nodes"][0]["score"] is not None
+    assert results[1] == {"index": 1, "error": str(StubLLMError(500))}
+    assert empty_response.status_code == 400
+
+
+def test_batch_query_endpoint_without_batch_support_releases_its_slot(make_query_engine):
+    query_engine = make_query_engine()
+    # The llama-index query engine has no abatch_query
+    plain_query_engine = BaseRetrieverQueryEngine.from_args(
+        query_engine.retriever, service_context=query_engine.vector_store_index.service_context)
+    client = TestClient(
+        AutoFastAPI.from_query_engine(
+            plain_query_engine, admission={
+                "max_concurrency": 1,
+                "max_queue_seconds": 0.1
+            }))
+
+    responses = [client.post("/query/batch", json={"queries": ["what is autollm?"]}) for _ in range(2)]
+
+    assert [response.status_code for response in responses] == [400, 400]
@@ -0,0 +1,46 @@
+import pytest
+
+from autollm.callbacks.budget import BudgetExceededError, BudgetManager, estimate_query_usage
+
+
+def test_budget_manager_rejects_when_exhausted():
+    budget_manager = BudgetManager.from_config({
+        "window_seconds": 60,
+        "tasks": {
+            "qa": {
+                "max_tokens": 1000
+            }
+        },
+    })
+
+    reservation = budget_manager.reserve("qa", None, tokens=800, cost_usd=0.0)
+
+    with pytest.raises(BudgetExceededError) as e:
+        budget_manager.reserve("qa", None, tokens=800, cost_usd=0.0)
+    assert 0 < e.value.retry_after <= 60
+
+    # Settling with the actual usage frees the over-estimated part of the reservation
+    budget_manager.settle(reservation, tokens=100, cost_usd=0.0)
+    budget_manager.reserve("qa", None, tokens=800, cost_usd=0.0)
+
+    # Tasks without a budget are not limited
+    budget_manager.reserve("summarize", None, tokens=10**6, cost_usd=0.0)
+
+
+def test_budget_manager_default_api_key_budget():
+    budget_manager = BudgetManager.from_config({"api_keys": {"default": {"max_cost_usd": 1.0}}})
+
+    budget_manager.reserve("qa", "key-a", tokens=0, cost_usd=0.9)
+    with pytest.raises(BudgetExceededError):
+        budget_manager.reserve("qa", "key-a", tokens=0, cost_usd=0.2)
+
+    # Each key gets its own window with the default limits
+    budget_manager.reserve("qa", "key-b", tokens=0, cost_usd=0.9)
+
+
+def test_estimate_query_usage():
+    tokens, cost_usd = estimate_query_usage(
+        "why so serious?", model="gpt-3.5-turbo", similarity_top_k=2, chunk_size=100, max_tokens=50)
+
+    assert tokens > 2 * 100 + 50
+    assert cost_usd > 0
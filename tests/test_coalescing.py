@@ -0,0 +1,84 @@
+import asyncio
+import time
+from contextvars import ContextVar
+
+from autollm.serve.coalescing import QueryCoalescer, normalize_query
+from autollm.utils.deadlines import deadline_scope, get_deadline
+
+
+def test_normalize_query():
+    assert normalize_query("  Why so   Serious? ") == normalize_query("why so serious?")
+
+
+def test_concurrent_identical_queries_run_once():
+    calls = []
+
+    async def answer():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "because"
+
+    async def main():
+        coalescer = QueryCoalescer()
+        key = ("qa", normalize_query("why so serious?"))
+        answers = await asyncio.gather(*(coalescer.run(key, answer) for _ in range(5)))
+        other_answer = await coalescer.run(("qa", "other"), answer)
+        return answers, other_answer, coalescer.is_inflight(key)
+
+    answers, other_answer, is_inflight = asyncio.run(main())
+
+    assert answers == ["because"] * 5
+    assert other_answer == "because"
+    assert len(calls) == 2
+    assert not is_inflight
+
+
+def test_late_stream_subscriber_gets_all_items():
+
+    async def produce():
+        for item in ("a", "b", "c"):
+            yield item
+            await asyncio.sleep(0.02)
+
+    async def collect(events):
+        return [event async for event in events]
+
+    async def main():
+        coalescer = QueryCoalescer()
+        first_events = await coalescer.stream("key", produce)
+        first_collector = asyncio.ensure_future(collect(first_events))
+        await asyncio.sleep(0.03)
+        assert coalescer.is_inflight("key", streaming=True)
+        late_events = await coalescer.stream("key", produce)
+        return await first_collector, await collect(late_events)
+
+    first_items, late_items = asyncio.run(main())
+
+    assert first_items == late_items == ["a", "b", "c"]
+
+
+def test_shared_execution_runs_with_the_latest_deadline_of_its_waiters():
+    request_id = ContextVar("request_id", default=None)
+    seen = []
+
+    async def answer():
+        await asyncio.sleep(0.02)
+        seen.append((request_id.get(), get_deadline()))
+        return "because"
+
+    async def wait(coalescer, name, timeout_seconds):
+        request_id.set(name)
+        with deadline_scope(timeout_seconds=timeout_seconds):
+            return await coalescer.run("key", answer)
+
+    async def main():
+        coalescer = QueryCoalescer()
+        return await asyncio.gather(wait(coalescer, "leader", 1), wait(coalescer, "follower", 10))
+
+    start = time.monotonic()
+    answers = asyncio.run(main())
+
+    assert answers == ["because"] * 2
+    # The execution sees neither the context variables nor the shorter deadline of the request that started it
+    assert seen[0][0] is None
+    assert seen[0][1] >= start + 10
@@ -0,0 +1,40 @@
+from llama_index import Document, MockEmbedding
+from llama_index.llms import MockLLM
+from llama_index.schema import MetadataMode, NodeWithScore, QueryBundle, TextNode
+
+from autollm.auto.service_context import AutoServiceContext
+from autollm.auto.vector_store_index import AutoVectorStoreIndex
+from autollm.utils.node_postprocessors import TokenBudgetNodePostprocessor
+from autollm.utils.token_counting import TOKEN_COUNT_METADATA_KEY
+
+
+def make_node(num_tokens):
+    return NodeWithScore(
+        node=TextNode(text="word " * num_tokens, metadata={TOKEN_COUNT_METADATA_KEY: num_tokens}))
+
+
+def test_token_budget_packs_nodes_greedily_by_relevance():
+    nodes = [make_node(40), make_node(70), make_node(30), make_node(20)]
+    postprocessor = TokenBudgetNodePostprocessor(context_window=1000, num_output=100, token_budget=100)
+
+    packed = postprocessor.postprocess_nodes(nodes, QueryBundle("query"))
+
+    # The second node does not fit, the smaller ones after it do
+    assert [node.node.metadata[TOKEN_COUNT_METADATA_KEY] for node in packed] == [40, 30, 20]
+    # The available context is capped by the context window
+    assert postprocessor.get_available_tokens() == 100
+    assert TokenBudgetNodePostprocessor(context_window=300, num_output=100).get_available_tokens() < 200
+
+
+def test_token_counts_are_stored_at_ingest_time(tmp_path):
+    service_context = AutoServiceContext.from_defaults(
+        llm=MockLLM(), embed_model=MockEmbedding(embed_dim=8), enable_token_count_extractor=True)
+    index = AutoVectorStoreIndex.from_defaults(
+        lancedb_uri=str(tmp_path / "lancedb"),
+        documents=[Document(text="autollm ships rag apps")],
+        service_context=service_context)
+
+    node = index.as_retriever(similarity_top_k=1).retrieve("autollm")[0].node
+
+    assert node.metadata[TOKEN_COUNT_METADATA_KEY] > 0
+    assert TOKEN_COUNT_METADATA_KEY not in node.get_content(metadata_mode=MetadataMode.LLM)
@@ -0,0 +1,90 @@
+import pytest
+import yaml
+from fastapi.testclient import TestClient
+from llama_index import Document
+
+from autollm.auto.fastapi_app import AutoFastAPI
+from autollm.utils.deadlines import (
+    DeadlineExceededError,
+    DeadlineLiteLLM,
+    check_deadline,
+    deadline_scope,
+    get_remaining_seconds,
+)
+
+
+def test_deadline_scope_keeps_the_earlier_deadline():
+    assert get_remaining_seconds() is None
+
+    with deadline_scope(timeout_seconds=10):
+        with deadline_scope(timeout_seconds=60):
+            assert get_remaining_seconds() <= 10
+        with deadline_scope(timeout_seconds=0):
+            assert get_remaining_seconds() == 0.0
+            with pytest.raises(DeadlineExceededError):
+                check_deadline()
+        check_deadline()
+
+    assert get_remaining_seconds() is None
+
+
+def test_litellm_calls_time_out_at_the_deadline():
+    llm = DeadlineLiteLLM(model="gpt-3.5-turbo")
+
+    assert "timeout" not in llm._get_all_kwargs()
+    with deadline_scope(timeout_seconds=5):
+        assert 0 < llm._get_all_kwargs()["timeout"] <= 5
+    with deadline_scope(timeout_seconds=0), pytest.raises(DeadlineExceededError):
+        llm._get_all_kwargs()
+
+
+def test_query_past_its_deadline_is_cancelled(make_query_engine):
+    query_engine = make_query_engine(llm_model="stub/llm?latency_ms=500", similarity_top_k=1)
+    llm = query_engine.vector_store_index.service_context.llm
+    client = TestClient(AutoFastAPI.from_query_engine(query_engine, admission={"max_concurrency": 1}))
+
+    response = client.post("/query", json={"user_query": "a slow question", "timeout_seconds": 0.05})
+    header_response = client.post(
+        "/query", json={"user_query": "another slow question"}, headers={"X-Request-Timeout": "0.05"})
+    running_after_timeouts = llm.running
+    fast_response = client.post("/query", json={"user_query": "a quick question", "timeout_seconds": 5})
+    invalid_response = client.post(
+        "/query", json={"user_query": "a quick question"}, headers={"X-Request-Timeout": "soon"})
+
+    assert response.status_code == 504
+    assert header_response.status_code == 504
+    # The LLM calls of the cancelled queries stopped, and the queries released their admission slots
+    assert running_after_timeouts == 0
+    assert len(llm.prompts) == 3
+    assert fast_response.status_code == 200
+    assert invalid_response.status_code == 400
+    metrics = client.get("/metrics").text
+    assert 'autollm_cancelled_requests_total{reason="deadline",task="default"} 2' in metrics
+
+
+def test_query_cancelled_while_its_engine_is_built_releases_its_slot(tmp_path):
+    config_file_path = tmp_path / "config.yaml"
+    task_params = {
+        "name": "qa",
+        "llm_model": "stub/llm",
+        "embed_model": "stub/embedding?latency_ms=300",
+        "vector_store_type": "SimpleVectorStore",
+        "enable_cost_calculator": False
+    }
+    config_file_path.write_text(yaml.safe_dump({"tasks": [task_params]}))
+    app = AutoFastAPI.from_config(
+        str(config_file_path),
+        documents=[Document(text="autollm ships rag apps")],
+        lazy_init=True,
+        admission={
+            "max_concurrency": 1,
+            "max_queue_seconds": 0.5
+        })
+    client = TestClient(app)
+
+    response = client.post("/query", json={"task": "qa", "user_query": "what?", "timeout_seconds": 0.05})
+    next_response = client.post("/query", json={"task": "qa", "user_query": "what?", "timeout_seconds": 5})
+
+    assert response.status_code == 504
+    # The slot of the cancelled request was released, the next request is not rejected after queueing
+    assert next_response.status_code == 200
@@ -0,0 +1,62 @@
+import asyncio
+import time
+
+from autollm.utils.deadlines import deadline_scope, get_deadline
+from autollm.utils.embedding_batcher import EmbeddingMicroBatcher
+
+
+def test_embedding_micro_batcher_batches_concurrent_requests():
+    batches = []
+
+    async def embed_batch(texts):
+        batches.append(texts)
+        return [[float(len(text))] for text in texts]
+
+    async def run():
+        batcher = EmbeddingMicroBatcher(embed_batch, max_batch_size=4, max_wait_seconds=0.01)
+        return await asyncio.gather(
+            *(batcher.embed(text) for text in ["a", "bb", "a", "ccc", "dddd", "eeeee"]))
+
+    embeddings = asyncio.run(run())
+
+    assert embeddings == [[1.0], [2.0], [1.0], [3.0], [4.0], [5.0]]
+    # the first batch is sent when full, identical texts are embedded once
+    assert batches == [["a", "bb", "ccc"], ["dddd", "eeeee"]]
+
+
+def test_embedding_micro_batcher_propagates_errors():
+
+    async def embed_batch(texts):
+        raise RuntimeError("rate limited")
+
+    async def run():
+        batcher = EmbeddingMicroBatcher(embed_batch, max_wait_seconds=0.001)
+        return await asyncio.gather(batcher.embed("a"), batcher.embed("b"), return_exceptions=True)
+
+    results = asyncio.run(run())
+
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_embedding_micro_batcher_runs_batches_with_the_latest_deadline():
+    deadlines = []
+
+    async def embed_batch(texts):
+        deadlines.append(get_deadline())
+        return [[0.0] for _ in texts]
+
+    async def embed(batcher, text, timeout_seconds):
+        with deadline_scope(timeout_seconds=timeout_seconds):
+            return await batcher.embed(text)
+
+    async def run():
+        batcher = EmbeddingMicroBatcher(embed_batch, max_wait_seconds=0.01)
+        await asyncio.gather(embed(batcher, "a", 1), embed(batcher, "b", 10))
+        await asyncio.gather(embed(batcher, "a", 1), batcher.embed("b"))
+
+    start = time.monotonic()
+    asyncio.run(run())
+
+    assert deadlines[0] >= start + 10
+    # A caller without a deadline does not bound the batch
+    assert deadlines[1] is None
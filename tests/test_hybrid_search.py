@@ -0,0 +1,42 @@
+import asyncio
+
+from llama_index import Document, MockEmbedding, ServiceContext
+from llama_index.llms import MockLLM
+
+from autollm.auto.vector_store_index import AutoVectorStoreIndex
+from autollm.utils.lancedb_vectorstore import reciprocal_rank_fusion
+
+DOCUMENTS = [
+    Document(text="The upload failed because the disk was full."),
+    Document(text="Retry the request when the server returns error code E4291."),
+    Document(text="The dashboard shows the usage of each api key."),
+]
+
+
+def test_reciprocal_rank_fusion():
+    fused = reciprocal_rank_fusion([["a", "b", "c"], ["c", "a"]], k=60)
+
+    assert [id_ for id_, _ in fused] == ["a", "c", "b"]
+    assert fused[0][1] == 1 / 61 + 1 / 62
+
+
+def test_hybrid_search_finds_exact_identifiers(tmp_path):
+    # MockEmbedding embeds every text the same way, so only the full-text search can rank the nodes
+    service_context = ServiceContext.from_defaults(llm=MockLLM(), embed_model=MockEmbedding(embed_dim=8))
+    index = AutoVectorStoreIndex.from_defaults(
+        lancedb_uri=str(tmp_path / "lancedb"),
+        documents=DOCUMENTS,
+        service_context=service_context,
+        fts_index=True)
+    retriever = index.as_retriever(similarity_top_k=1, vector_store_query_mode="hybrid")
+
+    nodes = retriever.retrieve("what does E4291 mean?")
+    async_nodes = asyncio.run(retriever.aretrieve("what does E4291 mean?"))
+    # The full-text index is rebuilt by the write, the query does not build it
+    index.insert(Document(text="Error code E5003 means the quota is exhausted."))
+    inserted_nodes = index.as_retriever(
+        similarity_top_k=2, vector_store_query_mode="hybrid").retrieve("what does E5003 mean?")
+
+    assert nodes[0].node.get_content() == "Retry the request when the server returns error code E4291."
+    assert async_nodes[0].node.node_id == nodes[0].node.node_id
+    assert inserted_nodes[0].node.get_content() == "Error code E5003 means the quota is exhausted."
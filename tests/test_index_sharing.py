@@ -0,0 +1,53 @@
+from autollm.serve.utils import get_index_sharing_key, initialize_engines
+
+
+def test_get_index_sharing_key():
+    qa = {"embed_model": "text-embedding-ada-002", "chunk_size": 512, "system_prompt": "Answer questions."}
+    summarize = {
+        "embed_model": "text-embedding-ada-002",
+        "system_prompt": "Summarize.",
+        "llm_model": "gpt-4",
+        "similarity_top_k": 10
+    }
+
+    # Prompts, LLM and retrieval params do not change the index, missing params fall back to defaults
+    assert get_index_sharing_key(qa) == get_index_sharing_key(summarize)
+    assert get_index_sharing_key(qa) != get_index_sharing_key({**qa, "chunk_size": 1024})
+    assert get_index_sharing_key(qa) != get_index_sharing_key({**qa, "lancedb_table_name": "other"})
+    # Hybrid search maintains a full-text index in the vector store
+    assert get_index_sharing_key(qa) != get_index_sharing_key({**qa, "hybrid_search": True})
+    # The LLM is used at ingestion time by the extractors
+    qa_with_keywords = {**qa, "enable_keyword_extractor": True}
+    qa_with_gpt4_keywords = {**qa_with_keywords, "llm_model": "gpt-4"}
+    assert get_index_sharing_key(qa_with_keywords) != get_index_sharing_key(qa_with_gpt4_keywords)
+
+
+def test_initialize_engines_shares_index():
+    config = {
+        "tasks": [
+            {
+                "name": "qa",
+                "system_prompt": "Answer questions.",
+                "vector_store_type": "SimpleVectorStore"
+            },
+            {
+                "name": "summarize",
+                "system_prompt": "Summarize.",
+                "similarity_top_k": 2,
+                "vector_store_type": "SimpleVectorStore"
+            },
+            {
+                "name": "large_chunks",
+                "chunk_size": 1024,
+                "vector_store_type": "SimpleVectorStore"
+            },
+        ]
+    }
+
+    query_engines = initialize_engines(config, documents=[])
+
+    qa_index = query_engines["qa"].vector_store_index
+    assert query_engines["summarize"].vector_store_index.vector_store is qa_index.vector_store
+    assert query_engines["large_chunks"].vector_store_index.vector_store is not qa_index.vector_store
+    # Each task keeps its own service context
+    assert query_engines["summarize"].vector_store_index.service_context is not qa_index.service_context
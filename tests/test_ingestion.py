@@ -0,0 +1,117 @@
+import time
+
+from fastapi.testclient import TestClient
+from llama_index import Document
+
+from autollm.auto.fastapi_app import AutoFastAPI
+from autollm.serve.ingestion import JOB_FAILED, JOB_SUCCEEDED, IngestionManager, read_ingestion_documents
+
+
+def wait_for_job(get_status, timeout_seconds: float = 10.0) -> dict:
+    deadline = time.monotonic() + timeout_seconds
+    while time.monotonic() < deadline:
+        status = get_status()
+        if status["status"] in (JOB_SUCCEEDED, JOB_FAILED):
+            return status
+        time.sleep(0.01)
+    raise TimeoutError("the ingestion job did not finish")
+
+
+def test_ingestion_manager_inserts_documents_in_batches(make_query_engine):
+    query_engine = make_query_engine(similarity_top_k=10)
+    batches = []
+    ingestion_manager = IngestionManager(
+        batch_size=2, on_batch=lambda task, num_documents: batches.append(num_documents))
+    documents = [Document(text=f"release note number {number}") for number in range(5)]
+
+    job = ingestion_manager.submit(
+        "qa", get_index=lambda: query_engine.vector_store_index, read_documents=lambda: documents)
+    status = wait_for_job(job.get_status)
+    failed_job = ingestion_manager.submit("qa", get_index=lambda: None, read_documents=lambda: documents)
+    failed_status = wait_for_job(failed_job.get_status)
+
+    assert status["status"] == JOB_SUCCEEDED
+    assert status["total_documents"] == status["ingested_documents"] == 5
+    assert status["documents_per_second"] > 0
+    assert batches == [2, 2, 1]
+    # The retriever of the query engine reads the live table
+    assert len(query_engine.retriever.retrieve("release note")) == 6
+    assert failed_status["status"] == JOB_FAILED
+    assert [job.job_id for job in ingestion_manager.list_jobs()] == [job.job_id, failed_job.job_id]
+
+
+def test_ingest_endpoint_runs_jobs_in_the_background(tmp_path, make_query_engine):
+    docs_path = tmp_path / "docs"
+    docs_path.mkdir()
+    (docs_path / "changelog.md").write_text("# Changelog\n\nautollm now supports background ingestion.")
+    query_engine = make_query_engine(similarity_top_k=10)
+    client = TestClient(
+        AutoFastAPI.from_config(
+            task_name_to_query_engine={"qa": query_engine},
+            ingestion={
+                "batch_size": 4,
+                "allowed_root": str(docs_path)
+            }))
+
+    response = client.post("/ingest", json={"task": "qa", "input_dir": "."})
+    status = wait_for_job(lambda: client.get(f"/ingest/{response.json()['job_id']}").json())
+    retrieved = client.post(
+        "/retrieve", json={
+            "task": "qa",
+            "query": "changelog",
+            "fields": ["text"]
+        }).json()["nodes"]
+
+    assert response.status_code == 202
+    assert status["status"] == JOB_SUCCEEDED
+    assert status["ingested_documents"] == 1
+    assert any("background ingestion" in node["text"] for node in retrieved)
+    assert client.post("/ingest", json={"task": "qa"}).status_code == 400
+    assert client.get("/ingest/unknown").status_code == 404
+    assert 'autollm_ingested_documents_total{task="qa"} 1' in client.get("/metrics").text
+
+
+def test_ingest_endpoint_rejects_sources_outside_the_allowlist(tmp_path, make_query_engine):
+    docs_path = tmp_path / "docs"
+    docs_path.mkdir()
+    (tmp_path / "secret.txt").write_text("not to be ingested")
+    query_engine = make_query_engine(similarity_top_k=10)
+    client = TestClient(
+        AutoFastAPI.from_config(
+            task_name_to_query_engine={"qa": query_engine},
+            ingestion={
+                "allowed_root": str(docs_path),
+                "allowed_urls": ["https://docs.example.com/autollm/"]
+            }))
+    closed_client = TestClient(
+        AutoFastAPI.from_config(task_name_to_query_engine={"qa": query_engine}, ingestion=True))
+
+    def ingest(client, **payload):
+        return client.post("/ingest", json={"task": "qa", **payload}).status_code
+
+    assert ingest(client, input_files=["/etc/passwd"]) == 403
+    assert ingest(client, input_files=["../secret.txt"]) == 403
+    assert ingest(client, input_dir=str(tmp_path)) == 403
+    assert ingest(client, urls=["https://docs.example.com/other/"]) == 403
+    assert ingest(client, urls=["https://docs.example.com.evil.com/autollm/"]) == 403
+    assert ingest(client, urls=["file:///etc/passwd"]) == 403
+    assert ingest(closed_client, input_dir=str(docs_path)) == 403
+    assert ingest(closed_client, urls=["https://example.com/"]) == 403
+    assert client.get("/ingest").json() == []
+
+
+def test_ingestion_replaces_documents_ingested_again(tmp_path, make_query_engine):
+    query_engine = make_query_engine(similarity_top_k=10)
+    docs_path = tmp_path / "docs"
+    docs_path.mkdir()
+    (docs_path / "changelog.md").write_text("# Changelog\n\nautollm now replaces re-ingested files.")
+    ingestion_manager = IngestionManager(allowed_root=str(docs_path))
+    read_documents = lambda: read_ingestion_documents(input_dir=ingestion_manager.resolve_path("."))
+
+    for _ in range(2):
+        job = ingestion_manager.submit(
+            "qa", get_index=lambda: query_engine.vector_store_index, read_documents=read_documents)
+        assert wait_for_job(job.get_status)["status"] == JOB_SUCCEEDED
+
+    retrieved = query_engine.retriever.retrieve("re-ingested files")
+    assert sum("re-ingested files" in node.node.get_content() for node in retrieved) == 1
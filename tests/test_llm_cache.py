@@ -0,0 +1,104 @@
+import asyncio
+import time
+
+from llama_index.llms import ChatMessage, ChatResponse, LiteLLM
+
+from autollm.auto.llm import AutoLiteLLM
+from autollm.utils.deadlines import deadline_scope
+from autollm.utils.llm_cache import InMemoryLLMCache, SQLiteLLMCache, get_llm_cache_key
+
+MESSAGES = [{"role": "system", "content": "Be brief."}, {"role": "user", "content": "why so serious? "}]
+
+
+def test_get_llm_cache_key():
+    key = get_llm_cache_key("GPT-3.5-Turbo", {"temperature": 0.1, "api_key": "secret"}, MESSAGES)
+
+    assert key == get_llm_cache_key("gpt-3.5-turbo", {"temperature": 0.1}, MESSAGES)
+    assert key != get_llm_cache_key("gpt-3.5-turbo", {"temperature": 0.5}, MESSAGES)
+    assert key != get_llm_cache_key("gpt-4", {"temperature": 0.1}, MESSAGES)
+
+
+def test_in_memory_llm_cache_lru_and_ttl():
+    cache = InMemoryLLMCache(max_size=2, ttl_seconds=0.05)
+    cache.set("a", {"content": "a"})
+    cache.set("b", {"content": "b"})
+    cache.get("a")
+    cache.set("c", {"content": "c"})
+
+    # "b" is the least recently used
+    assert cache.get("b") is None
+    assert cache.get("a") == {"content": "a"}
+
+    time.sleep(0.1)
+    assert cache.get("a") is None
+
+
+def test_sqlite_llm_cache(tmp_path):
+    path = str(tmp_path / "llm_cache.sqlite")
+    cache = SQLiteLLMCache(path=path, max_size=2)
+    cache.set("a", {"content": "a"})
+    cache.set("b", {"content": "b"})
+    cache.set("c", {"content": "c"})
+
+    assert len(cache) == 2
+    # responses are kept across instances
+    assert SQLiteLLMCache(path=path).get("c") == {"content": "c"}
+
+
+def test_cached_litellm(monkeypatch):
+    calls = []
+
+    def chat(self, messages, **kwargs):
+        calls.append(messages)
+        return ChatResponse(
+            message=ChatMessage(role="assistant", content="because"),
+            raw={"usage": {
+                "prompt_tokens": 12,
+                "completion_tokens": 3
+            }})
+
+    async def achat(self, messages, **kwargs):
+        return chat(self, messages, **kwargs)
+
+    monkeypatch.setattr(LiteLLM, "_chat", chat)
+    monkeypatch.setattr(LiteLLM, "_achat", achat)
+    llm = AutoLiteLLM.from_defaults(model="gpt-3.5-turbo", cache="memory")
+    messages = [ChatMessage(role="user", content="why so serious?")]
+
+    first_response = llm.chat(messages)
+    cached_response = llm.chat(messages)
+    async_cached_response = asyncio.run(llm.achat(messages))
+
+    assert len(calls) == 1
+    assert cached_response.message.content == async_cached_response.message.content == "because"
+    assert first_response.raw["usage"]["prompt_tokens"] == 12
+    assert cached_response.raw["usage"]["prompt_tokens"] == 0
+    assert llm.cache.hits == 2
+
+
+def test_cached_litellm_key_ignores_the_deadline(monkeypatch, tmp_path):
+    calls = []
+
+    async def achat(self, messages, **kwargs):
+        calls.append(messages)
+        return ChatResponse(message=ChatMessage(role="assistant", content="because"))
+
+    monkeypatch.setattr(LiteLLM, "_achat", achat)
+    llm = AutoLiteLLM.from_defaults(
+        model="gpt-3.5-turbo", cache={
+            "type": "sqlite",
+            "path": str(tmp_path / "llm_cache.sqlite")
+        })
+    messages = [ChatMessage(role="user", content="why so serious?")]
+
+    async def chat_with_deadline(timeout_seconds):
+        with deadline_scope(timeout_seconds=timeout_seconds):
+            return await llm.achat(messages)
+
+    asyncio.run(chat_with_deadline(30))
+    # The remaining time differs, the cached response is still found
+    cached_response = asyncio.run(chat_with_deadline(10))
+
+    assert len(calls) == 1
+    assert cached_response.message.content == "because"
+    assert llm.cache.hits == 1
@@ -0,0 +1,97 @@
+import asyncio
+import time
+
+import pytest
+from llama_index.callbacks import CallbackManager
+
+from autollm.auto.llm import AutoLiteLLM
+from autollm.utils.llm_router import RouterLLM
+from autollm.utils.stub_backends import StubLLMError
+
+
+def make_llm(name: str, **settings):
+    query = "&".join(f"{setting}={value}" for setting, value in settings.items())
+    return AutoLiteLLM.from_defaults(model=f"stub/{name}?{query}" if query else f"stub/{name}")
+
+
+def test_router_fails_over_on_rate_limit():
+    primary = make_llm("primary", error_status_code=429)
+    fallback = make_llm("fallback")
+    llm = RouterLLM(backends=[primary, fallback], routing="ordered")
+
+    assert llm.complete("hi").text
+    # The rate limited backend cools down and is not called again
+    assert llm.complete("hi").text
+    assert list(llm.stream_complete("hi"))[-1].text
+    assert len(primary.prompts) == 1
+    assert len(fallback.prompts) == 3
+    assert llm.get_backend_stats()[0]["available"] is False
+
+
+def test_router_raises_non_retryable_errors():
+    primary = make_llm("primary", error_status_code=400)
+    fallback = make_llm("fallback")
+    llm = RouterLLM(backends=[primary, fallback])
+
+    with pytest.raises(StubLLMError):
+        llm.complete("hi")
+    assert fallback.prompts == []
+
+
+def test_router_prefers_the_fastest_backend():
+    slow = make_llm("slow", latency_ms=50)
+    fast = make_llm("fast")
+    llm = RouterLLM(backends=[slow, fast])
+
+    for _ in range(5):
+        llm.complete("hi")
+
+    assert len(slow.prompts) == 1
+    assert len(fast.prompts) == 4
+
+
+def test_router_hedges_slow_calls():
+    primary = make_llm("primary", latency_ms=10)
+    backup = make_llm("backup", latency_ms=10)
+    llm = RouterLLM(backends=[primary, backup], routing="ordered", hedge_percentile=90, hedge_min_samples=3)
+
+    async def main():
+        for _ in range(3):
+            await llm.acomplete("hi")
+        primary.latency_ms = 1000
+        start_time = time.perf_counter()
+        response = await llm.acomplete("hi")
+        return response, time.perf_counter() - start_time
+
+    response, latency = asyncio.run(main())
+
+    assert response.text
+    assert len(backup.prompts) == 1
+    assert latency < 0.5
+
+
+def test_router_times_out_slow_backends():
+    fallback = make_llm("fallback")
+    llm = RouterLLM(backends=[make_llm("stuck", latency_ms=1000), fallback], timeout=0.1)
+
+    assert asyncio.run(llm.acomplete("hi")).text
+    assert len(fallback.prompts) == 1
+
+
+def test_router_skips_a_hedge_backend_that_failed():
+    primary = make_llm("primary")
+    backup = make_llm("backup")
+    last = make_llm("last")
+    llm = RouterLLM(
+        backends=[primary, backup, last], routing="ordered", hedge_percentile=90, hedge_min_samples=3)
+    for _ in range(3):
+        llm.complete("hi")
+    primary.latency_ms, primary.error_status_code = 50, 429
+    backup.error_status_code = 429
+
+    assert llm.complete("hi").text
+    # The backup failed as the hedge of the primary, the failover goes to the last backend
+    assert len(backup.prompts) == 1
+    assert len(last.prompts) == 1
+    llm.callback_manager = CallbackManager([])
+    assert primary.callback_manager is backup.callback_manager is llm.callback_manager
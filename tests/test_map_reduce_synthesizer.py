@@ -0,0 +1,88 @@
+import asyncio
+import time
+
+from llama_index import ServiceContext
+from llama_index.callbacks import CallbackManager, CBEventType, LlamaDebugHandler
+
+from autollm.auto.embedding import AutoEmbedding
+from autollm.auto.llm import AutoLiteLLM
+from autollm.utils.map_reduce_synthesizer import MapReduceSynthesizer
+
+TEXT_CHUNKS = [f"chunk number {number} " * 60 for number in range(6)]
+
+
+def make_llm(latency_ms: int = 100, context_window: int = 400):
+    # A chunk fills most of the context window, the short answers of the groups fit a single reduce call
+    return AutoLiteLLM.from_defaults(
+        model=f"stub/llm?latency_ms={latency_ms}&context_window={context_window}", max_tokens=32)
+
+
+def make_synthesizer(llm, **kwargs):
+    service_context = ServiceContext.from_defaults(llm=llm, embed_model=AutoEmbedding(model="stub/embedding"))
+    return MapReduceSynthesizer(service_context=service_context, **kwargs)
+
+
+def split_prompts(llm):
+    """Split the prompts of the stub LLM into the map prompts and the reduce prompts."""
+    reduce_prompts = [prompt for prompt in llm.prompts if "Combine them into a single answer" in prompt]
+    return [prompt for prompt in llm.prompts if prompt not in reduce_prompts], reduce_prompts
+
+
+def test_map_reduce_answers_groups_concurrently():
+    llm = make_llm()
+    synthesizer = make_synthesizer(llm, max_concurrency=8)
+
+    start_time = time.perf_counter()
+    response = synthesizer.get_response("what is the number?", TEXT_CHUNKS)
+    latency = time.perf_counter() - start_time
+
+    map_prompts, reduce_prompts = split_prompts(llm)
+    assert response
+    assert len(map_prompts) > 2
+    assert len(reduce_prompts) == 1
+    assert llm.max_running == len(map_prompts)
+    assert latency < 0.4
+
+
+def test_map_reduce_bounds_concurrency_and_fan_out():
+    llm = make_llm(latency_ms=10)
+    synthesizer = make_synthesizer(llm, max_concurrency=2, max_fan_out=3)
+
+    response = asyncio.run(synthesizer.aget_response("what is the number?", TEXT_CHUNKS))
+
+    map_prompts, reduce_prompts = split_prompts(llm)
+    assert response
+    assert len(map_prompts) == 3
+    assert len(reduce_prompts) == 1
+    assert llm.max_running == 2
+    assert "chunk number 5" not in "".join(map_prompts)
+
+
+def test_map_reduce_answers_a_single_group_directly():
+    # The first chunk alone is over max_context_tokens and would not fit a single call
+    llm = make_llm(latency_ms=0, context_window=300)
+    synthesizer = make_synthesizer(llm, max_context_tokens=100)
+
+    synthesizer.get_response("what is the number?", TEXT_CHUNKS)
+
+    assert len(llm.prompts) == 1
+    assert "chunk number 0" in llm.prompts[0]
+    assert "chunk number 1" not in llm.prompts[0]
+
+
+def test_map_reduce_terminates_when_the_answers_do_not_shrink():
+    # Each answer takes most of the context window, so the answers never fit fewer reduce calls
+    llm = AutoLiteLLM.from_defaults(model="stub/llm?output_tokens=400&context_window=1000", max_tokens=400)
+    debug_handler = LlamaDebugHandler()
+    service_context = ServiceContext.from_defaults(
+        llm=llm,
+        embed_model=AutoEmbedding(model="stub/embedding"),
+        callback_manager=CallbackManager([debug_handler]))
+    synthesizer = MapReduceSynthesizer(service_context=service_context, max_fan_out=4)
+
+    response = synthesizer.get_response("what is the number?", TEXT_CHUNKS)
+    async_response = asyncio.run(synthesizer.aget_response("what is the number?", TEXT_CHUNKS))
+
+    assert response == async_response
+    # At most max_fan_out * (max_reduce_levels + 1) + 1 calls per query
+    assert len(debug_handler.get_event_pairs(CBEventType.LLM)) <= 2 * (4 * 3 + 1)
@@ -0,0 +1,78 @@
+from llama_index.callbacks.schema import CBEventType, EventPayload
+from llama_index.llms import ChatMessage, ChatResponse
+
+from autollm.callbacks.metrics import MetricsCallbackHandler, MetricsRegistry
+
+
+def test_metrics_registry_render_prometheus():
+    registry = MetricsRegistry(buckets=(0.1, 1.0))
+    registry.inc("autollm_requests_total", {"task": "qa", "status": "success"})
+    registry.observe("autollm_request_latency_seconds", {"task": "qa"}, 0.5)
+
+    text = registry.render_prometheus()
+
+    assert '# TYPE autollm_requests_total counter' in text
+    assert 'autollm_requests_total{status="success",task="qa"} 1' in text
+    assert 'autollm_request_latency_seconds_bucket{task="qa",le="0.1"} 0' in text
+    assert 'autollm_request_latency_seconds_bucket{task="qa",le="1"} 1' in text
+    assert 'autollm_request_latency_seconds_count{task="qa"} 1' in text
+
+
+def test_metrics_callback_handler():
+    registry = MetricsRegistry()
+    handler = MetricsCallbackHandler(task_name="qa", registry=registry)
+
+    handler.on_event_start(CBEventType.QUERY, event_id="query", parent_id="root")
+    handler.on_event_start(CBEventType.RETRIEVE, event_id="retrieve", parent_id="query")
+    handler.on_event_start(CBEventType.EMBEDDING, event_id="embedding", parent_id="retrieve")
+    handler.on_event_end(CBEventType.EMBEDDING, event_id="embedding")
+    handler.on_event_end(CBEventType.RETRIEVE, event_id="retrieve")
+
+    messages = [ChatMessage(role="user", content="why so serious?")]
+    response = ChatResponse(
+        message=ChatMessage(role="assistant", content="because"),
+        raw={"usage": {
+            "prompt_tokens": 12,
+            "completion_tokens": 3
+        }})
+    handler.on_event_start(
+        CBEventType.LLM,
+        payload={EventPayload.SERIALIZED: {
+            "model": "gpt-3.5-turbo"
+        }},
+        event_id="llm",
+        parent_id="query")
+    handler.on_event_end(
+        CBEventType.LLM,
+        payload={
+            EventPayload.MESSAGES: messages,
+            EventPayload.RESPONSE: response
+        },
+        event_id="llm")
+    handler.on_event_end(CBEventType.QUERY, payload={}, event_id="query")
+
+    assert registry.get_counter("autollm_requests_total", {"task": "qa", "status": "success"}) == 1
+    assert registry.get_counter("autollm_llm_tokens_total", {"task": "qa", "type": "prompt"}) == 12
+    assert registry.get_counter("autollm_llm_tokens_total", {"task": "qa", "type": "completion"}) == 3
+    assert registry.get_counter("autollm_llm_cost_usd_total", {"task": "qa"}) > 0
+    for stage in ("embedding", "retrieval", "llm"):
+        stage_labels = {"task": "qa", "stage": stage}
+        assert registry.get_histogram("autollm_stage_latency_seconds", stage_labels).count == 1
+
+
+def test_metrics_callback_handler_forgets_embeddings_outside_retrieval():
+    registry = MetricsRegistry()
+    handler = MetricsCallbackHandler(task_name="qa", registry=registry)
+
+    # The semantic cache embeds the query directly under the query event
+    handler.on_event_start(CBEventType.QUERY, event_id="query", parent_id="root")
+    handler.on_event_start(CBEventType.EMBEDDING, event_id="embedding", parent_id="query")
+    handler.on_event_end(CBEventType.EMBEDDING, event_id="embedding")
+    handler.on_event_end(CBEventType.QUERY, payload={}, event_id="query")
+
+    assert registry.get_histogram(
+        "autollm_stage_latency_seconds", {
+            "task": "qa",
+            "stage": "embedding"
+        }).count == 1
+    assert not handler._nested_embedding_time
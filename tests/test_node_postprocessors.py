@@ -0,0 +1,48 @@
+import numpy as np
+from llama_index.schema import NodeRelationship, NodeWithScore, QueryBundle, RelatedNodeInfo, TextNode
+
+from autollm.utils.node_postprocessors import (
+    MMRNodePostprocessor,
+    get_text_overlap,
+    maximal_marginal_relevance,
+)
+
+
+def make_node(text, embedding, doc_id="doc"):
+    node = TextNode(
+        text=text,
+        embedding=embedding,
+        relationships={NodeRelationship.SOURCE: RelatedNodeInfo(node_id=doc_id)})
+    return NodeWithScore(node=node, score=1.0)
+
+
+def test_maximal_marginal_relevance_skips_near_duplicates():
+    query_embedding = np.array([1.0, 0.0])
+    embeddings = np.array([[1.0, 0.1], [1.0, 0.11], [0.7, 0.7]])
+
+    assert maximal_marginal_relevance(query_embedding, embeddings, top_n=2, mmr_lambda=0.3) == [0, 2]
+    assert maximal_marginal_relevance(query_embedding, embeddings, top_n=2, mmr_lambda=1.0) == [0, 1]
+
+
+def test_get_text_overlap():
+    first = "LanceDB stores the vectors. The overlap between chunks is repeated"
+    second = "The overlap between chunks is repeated in the next chunk."
+
+    assert get_text_overlap(first, second) == len("The overlap between chunks is repeated")
+    assert get_text_overlap(second, first) == 0
+
+
+def test_mmr_postprocessor_strips_chunk_overlap():
+    nodes = [
+        make_node("Autollm ships rag apps. Each app is configured in yaml", [1.0, 0.0]),
+        make_node("Each app is configured in yaml and served with fastapi.", [0.6, 0.8]),
+        make_node("Autollm ships rag apps. Each app is configured in yaml", [1.0, -0.05], doc_id="other"),
+    ]
+    postprocessor = MMRNodePostprocessor(top_n=2)
+
+    selected = postprocessor.postprocess_nodes(nodes, QueryBundle("what is autollm?", embedding=[1.0, 0.2]))
+
+    texts = [node.node.get_content() for node in selected]
+    assert texts == ["Autollm ships rag apps. Each app is configured in yaml", " and served with fastapi."]
+    # The retrieved node is not modified
+    assert nodes[1].node.get_content() == "Each app is configured in yaml and served with fastapi."
@@ -0,0 +1,83 @@
+import time
+
+import lancedb
+import pytest
+import yaml
+from fastapi.testclient import TestClient
+from llama_index import Document, MockEmbedding, ServiceContext
+from llama_index.llms import MockLLM
+from llama_index.schema import TextNode
+
+from autollm.auto.fastapi_app import AutoFastAPI
+from autollm.auto.vector_store_index import AutoVectorStoreIndex
+from autollm.serve.build import build_indexes
+from autollm.serve.registry import TASK_LOADED, TaskRegistry
+from autollm.serve.utils import get_task_name_to_params
+
+
+def write_config(tmp_path) -> str:
+    lancedb_uri = str(tmp_path / "lancedb")
+    service_context = ServiceContext.from_defaults(llm=MockLLM(), embed_model=MockEmbedding(embed_dim=8))
+    AutoVectorStoreIndex.from_defaults(
+        lancedb_uri=lancedb_uri,
+        documents=[Document(text="autollm ships rag apps")],
+        service_context=service_context)
+
+    config_file_path = tmp_path / "config.yaml"
+    task_params = {"name": "qa", "system_prompt": "Answer.", "lancedb_uri": lancedb_uri}
+    config_file_path.write_text(yaml.safe_dump({"tasks": [task_params]}))
+    return str(config_file_path)
+
+
+def test_read_only_tasks_do_not_write_to_the_table(tmp_path):
+    config = yaml.safe_load(open(write_config(tmp_path)))
+    registry = TaskRegistry(get_task_name_to_params(config, read_only=True))
+
+    vector_store = registry.get("qa").vector_store_index.vector_store
+
+    assert vector_store.read_only
+    with pytest.raises(PermissionError):
+        vector_store.add([TextNode(text="a new node", embedding=[0.0] * 8)])
+    with pytest.raises(ValueError):
+        in_memory_config = {"tasks": [{"name": "qa", "vector_store_type": "SimpleVectorStore"}]}
+        get_task_name_to_params(in_memory_config, read_only=True)
+
+
+def test_read_only_workers_build_their_engines_at_startup(tmp_path):
+    config_file_path = write_config(tmp_path)
+
+    with pytest.raises(ValueError):
+        AutoFastAPI.from_config(
+            config_file_path, documents=[Document(text="ingested per worker")], read_only=True)
+
+    app = AutoFastAPI.from_config(config_file_path, read_only=True)
+    client = TestClient(app)
+    # Nothing is opened before the worker starts
+    assert client.get("/health").json()["tasks"]["qa"]["status"] != TASK_LOADED
+
+    with TestClient(app) as client:
+        deadline = time.monotonic() + 10
+        while client.get("/health").json()["tasks"]["qa"]["status"] != TASK_LOADED:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+
+
+def test_rebuilding_replaces_the_documents(tmp_path):
+    lancedb_uri = str(tmp_path / "lancedb")
+    config_file_path = tmp_path / "config.yaml"
+    task_params = {
+        "name": "qa",
+        "llm_model": "stub/llm",
+        "embed_model": "stub/embedding",
+        "lancedb_uri": lancedb_uri,
+        "enable_cost_calculator": False
+    }
+    config_file_path.write_text(yaml.safe_dump({"tasks": [task_params]}))
+    documents = [Document(text="autollm ships rag apps", doc_id="docs/autollm.md")]
+
+    build_indexes(str(config_file_path), documents)
+    build_indexes(
+        str(config_file_path), [Document(text="autollm ships fast rag apps", doc_id="docs/autollm.md")])
+
+    table = lancedb.connect(lancedb_uri).open_table("vectors")
+    assert table.to_pandas()["text"].tolist() == ["autollm ships fast rag apps"]
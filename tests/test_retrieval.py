@@ -0,0 +1,65 @@
+from fastapi.testclient import TestClient
+from llama_index import Document
+
+from autollm.auto.fastapi_app import AutoFastAPI
+
+DOCUMENTS = [
+    Document(text="Uploads are limited to 10 MB.", metadata={"section": "limits"}),
+    Document(text="Each api key can send 60 requests per minute.", metadata={"section": "limits"}),
+    Document(text="The dashboard shows the usage of each api key.", metadata={"section": "dashboard"}),
+]
+
+
+def test_search_with_filters_top_k_and_fields(make_query_engine):
+    query_engine = make_query_engine(DOCUMENTS, similarity_top_k=2)
+
+    nodes = query_engine.search(
+        "what is the usage?", filters={"section": "dashboard"}, fields=["text", "score"])
+    all_nodes = query_engine.search("what is the usage?", top_k=3)
+
+    assert nodes == [{"text": "The dashboard shows the usage of each api key.", "score": nodes[0]["score"]}]
+    assert len(all_nodes) == 3
+    assert set(all_nodes[0]) == {"id", "score", "text", "metadata"}
+
+
+def test_retrieve_endpoint(make_query_engine):
+    client = TestClient(AutoFastAPI.from_query_engine(make_query_engine(DOCUMENTS, similarity_top_k=2)))
+
+    response = client.post(
+        "/retrieve", json={
+            "query": "limits",
+            "filters": {
+                "section": "limits"
+            },
+            "fields": ["metadata"]
+        })
+    invalid_response = client.post("/retrieve", json={"query": "limits", "fields": ["embedding"]})
+
+    assert response.status_code == 200
+    assert response.json() == {"nodes": [{"metadata": {"section": "limits"}}] * 2}
+    assert invalid_response.status_code == 400
+
+
+def test_search_returns_the_task_top_k_with_mmr(make_query_engine):
+    query_engine = make_query_engine(DOCUMENTS, similarity_top_k=1, mmr=True)
+
+    # The retriever fetches more candidates for MMR, search returns the top_k of the task
+    assert len(query_engine.search("what is the usage of an api key?")) == 1
+    assert len(query_engine.search("what is the usage of an api key?", top_k=2)) == 2
+
+
+def test_retrieve_endpoint_rejects_unsafe_filters(make_query_engine, tmp_path):
+    client = TestClient(AutoFastAPI.from_query_engine(make_query_engine(DOCUMENTS, similarity_top_k=3)))
+
+    def retrieve(filters):
+        return client.post("/retrieve", json={"query": "limits", "filters": filters})
+
+    injected_response = retrieve({"section": "dashboard\" OR \"1\" = \"1"})
+    quoted_response = retrieve({"section": "dashboard' OR '1' = '1"})
+    unknown_key_response = retrieve({"unknown": "limits"})
+
+    assert injected_response.json() == {"nodes": []}
+    assert quoted_response.json() == {"nodes": []}
+    assert unknown_key_response.status_code == 400
+    assert str(tmp_path) not in unknown_key_response.text
+    assert retrieve({"text": "Uploads are limited to 10 MB."}).status_code == 400
@@ -0,0 +1,45 @@
+import asyncio
+
+from llama_index import Document, MockEmbedding, ServiceContext, VectorStoreIndex
+from llama_index.core.response.schema import Response
+from llama_index.llms import MockLLM
+from llama_index.response_synthesizers import get_response_synthesizer
+
+from autollm.utils.retriever_query_engine import RetrieverQueryEngine
+from autollm.utils.semantic_cache import SemanticCache
+
+
+def test_semantic_cache_lookup():
+    cache = SemanticCache(similarity_threshold=0.9)
+    cache.add([1.0, 0.0],
+              "how do I reset my password?",
+              Response(response="Use the reset link."),
+              index_version=1)
+
+    assert cache.lookup([0.99, 0.1], index_version=1).response.response == "Use the reset link."
+    assert cache.lookup([0.0, 1.0], index_version=1) is None
+    # A new version of the index invalidates the cached answers
+    assert cache.lookup([1.0, 0.0], index_version=2) is None
+    assert len(cache) == 0
+
+
+def test_query_engine_answers_from_semantic_cache():
+    service_context = ServiceContext.from_defaults(
+        llm=MockLLM(max_tokens=5), embed_model=MockEmbedding(embed_dim=8))
+    index = VectorStoreIndex.from_documents([Document(text="autollm ships rag apps")],
+                                            service_context=service_context)
+    query_engine = RetrieverQueryEngine(
+        retriever=index.as_retriever(similarity_top_k=1),
+        response_synthesizer=get_response_synthesizer(service_context=service_context),
+        callback_manager=service_context.callback_manager,
+        vector_store_index=index,
+        semantic_cache=SemanticCache())
+
+    response = asyncio.run(query_engine.aquery("what does autollm ship?"))
+    # MockEmbedding embeds every text the same way, so the paraphrase hits the cache
+    cached_response = query_engine.query("what is shipped by autollm?")
+
+    assert cached_response.response == response.response
+    assert cached_response.metadata["semantic_cache_query"] == "what does autollm ship?"
+    assert cached_response.source_nodes[0].node.get_content() == "autollm ships rag apps"
+    assert query_engine.semantic_cache.hits == 1
@@ -0,0 +1,59 @@
+import asyncio
+import json
+import threading
+
+from fastapi.testclient import TestClient
+from llama_index import Document, MockEmbedding, ServiceContext, VectorStoreIndex
+from llama_index.llms import MockLLM
+from llama_index.response_synthesizers import get_response_synthesizer
+
+from autollm.auto.fastapi_app import AutoFastAPI
+from autollm.utils.async_utils import iterate_in_thread
+from autollm.utils.retriever_query_engine import RetrieverQueryEngine
+
+
+def parse_sse_events(text: str) -> list:
+    events = []
+    for block in text.strip().split("\n\n"):
+        event, data = block.split("\n")
+        events.append((event[len("event: "):], json.loads(data[len("data: "):])))
+    return events
+
+
+def test_query_streams_tokens_as_sse():
+    service_context = ServiceContext.from_defaults(
+        llm=MockLLM(max_tokens=5), embed_model=MockEmbedding(embed_dim=8))
+    index = VectorStoreIndex.from_documents([Document(text="autollm ships rag apps")],
+                                            service_context=service_context)
+    query_engine = RetrieverQueryEngine(
+        retriever=index.as_retriever(similarity_top_k=1),
+        response_synthesizer=get_response_synthesizer(service_context=service_context),
+        callback_manager=service_context.callback_manager,
+        streaming_response_synthesizer=get_response_synthesizer(
+            service_context=service_context, streaming=True))
+
+    app = AutoFastAPI.from_query_engine(query_engine)
+    client = TestClient(app)
+    response = client.post("/query", json={"user_query": "what does autollm ship?", "streaming": True})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = parse_sse_events(response.text)
+    tokens = [data["token"] for event, data in events if event == "token"]
+    assert len(tokens) == 5
+    end_event, end_data = events[-1]
+    assert end_event == "end"
+    assert end_data["source_nodes"][0]["text"] == "autollm ships rag apps"
+    assert end_data["usage"]["llm_calls"] == 1
+
+
+def test_streams_are_consumed_outside_the_shared_thread_pool():
+
+    def tokens():
+        for _ in range(3):
+            yield threading.current_thread().name
+
+    async def consume():
+        return [name async for name in iterate_in_thread(tokens())]
+
+    assert all(name.startswith("autollm-stream") for name in asyncio.run(consume()))
@@ -0,0 +1,63 @@
+import asyncio
+import time
+
+from llama_index import Document
+
+from autollm.auto.embedding import AutoEmbedding
+from autollm.auto.llm import AutoLiteLLM
+from autollm.auto.query_engine import AutoQueryEngine
+from autollm.utils.stub_backends import StubLLM, get_stub_embedding
+
+
+def test_stub_embedding_is_deterministic():
+    embedding = AutoEmbedding(model="stub/embedding?dimension=64")
+
+    vector = embedding.get_text_embedding("autollm ships rag apps")
+    vectors = embedding.get_text_embedding_batch(["autollm ships rag apps", "a recipe for pancakes"])
+
+    assert len(vector) == 64
+    assert vector == vectors[0] == get_stub_embedding("autollm ships rag apps", 64)
+    assert abs(sum(value * value for value in vector) - 1.0) < 1e-9
+    query_vector = asyncio.run(embedding.aget_query_embedding("rag apps"))
+    similarities = [sum(a * b for a, b in zip(query_vector, vector)) for vector in vectors]
+    assert similarities[0] > similarities[1]
+
+
+def test_stub_llm_streams_at_the_configured_speed():
+    llm = AutoLiteLLM.from_defaults(model="stub/llm?latency_ms=50&tokens_per_second=200&output_tokens=10")
+    buffered_llm = AutoLiteLLM.from_defaults(model="stub/llm?tokens_per_second=200&streaming=false")
+
+    assert isinstance(llm, StubLLM)
+    assert llm.complete("what is autollm").text == llm.complete("what is autollm").text
+    start = time.monotonic()
+    responses = list(llm.stream_complete("what is autollm"))
+    first_token_seconds = None
+
+    async def stream():
+        nonlocal first_token_seconds
+        start = time.monotonic()
+        async for _ in await llm.astream_complete("what is autollm"):
+            first_token_seconds = first_token_seconds or time.monotonic() - start
+
+    asyncio.run(stream())
+
+    assert len(responses) == 10
+    assert time.monotonic() - start >= 0.05 + 10 / 200
+    assert 0.05 <= first_token_seconds < 0.05 + 10 / 200
+    assert len(list(buffered_llm.stream_complete("what is autollm"))) == 1
+    assert buffered_llm.max_tokens == 256
+
+
+def test_query_engine_runs_offline_with_stubs():
+    query_engine = AutoQueryEngine.from_defaults(
+        documents=[Document(text="autollm ships rag apps"),
+                   Document(text="a recipe for pancakes")],
+        llm_model="stub/llm?output_tokens=4",
+        embed_model="stub/embedding",
+        vector_store_type="SimpleVectorStore",
+        similarity_top_k=1)
+
+    response = query_engine.query("what does autollm ship")
+
+    assert len(response.response.split()) == 4
+    assert response.source_nodes[0].node.text == "autollm ships rag apps"
@@ -0,0 +1,137 @@
+import asyncio
+import threading
+
+import httpx
+import pytest
+import yaml
+from llama_index import Document
+
+from autollm.auto.fastapi_app import AutoFastAPI
+from autollm.serve.registry import TASK_LOADED, TASK_NOT_LOADED, TaskRegistry, TaskRegistryReloader
+
+TASK_NAME_TO_PARAMS = {
+    "qa": {
+        "system_prompt": "Answer questions.",
+        "vector_store_type": "SimpleVectorStore"
+    },
+    "summarize": {
+        "system_prompt": "Summarize.",
+        "vector_store_type": "SimpleVectorStore"
+    },
+}
+
+
+def test_task_registry_builds_once_on_first_use():
+    built_tasks = []
+    build_threads = []
+
+    def on_engine_built(task_name, query_engine):
+        built_tasks.append(task_name)
+        build_threads.append(threading.current_thread().name)
+
+    registry = TaskRegistry(TASK_NAME_TO_PARAMS, documents=[], on_engine_built=on_engine_built)
+
+    assert registry.get_status()["qa"]["status"] == TASK_NOT_LOADED
+
+    async def first_requests():
+        return await asyncio.gather(*(registry.aget("qa") for _ in range(5)))
+
+    query_engines = asyncio.run(first_requests())
+
+    assert built_tasks == ["qa"]
+    # Builds do not take the threads of the shared pool serving the queries
+    assert build_threads[0].startswith("autollm-build")
+    assert all(query_engine is query_engines[0] for query_engine in query_engines)
+    assert registry.get_status()["qa"]["status"] == TASK_LOADED
+    assert registry.get_status()["summarize"]["status"] == TASK_NOT_LOADED
+
+
+def test_task_registry_evicts_least_recently_used():
+    registry = TaskRegistry(TASK_NAME_TO_PARAMS, documents=[], max_loaded_engines=1)
+
+    qa_query_engine = registry.get("qa")
+    summarize_query_engine = registry.get("summarize")
+
+    assert registry.get_status()["qa"]["status"] == TASK_NOT_LOADED
+    assert registry.get_status()["summarize"]["status"] == TASK_LOADED
+    # Tasks with the same ingestion settings share the index
+    qa_vector_store = qa_query_engine.vector_store_index.vector_store
+    assert summarize_query_engine.vector_store_index.vector_store is qa_vector_store
+
+
+def test_reloader_swaps_registry_and_drains_the_old_one():
+    registry = TaskRegistry(TASK_NAME_TO_PARAMS, documents=[])
+    qa_query_engine = registry.get("qa")
+    new_task_name_to_params = {
+        "qa": dict(TASK_NAME_TO_PARAMS["qa"], system_prompt="Answer questions briefly."),
+        "summarize": TASK_NAME_TO_PARAMS["summarize"],
+        "chat": {
+            "vector_store_type": "SimpleVectorStore",
+            "chunk_size": 256
+        },
+    }
+    reloader = TaskRegistryReloader(registry, load_task_params=lambda: new_task_name_to_params)
+
+    leased_registry, release = reloader.lease()
+    changes = asyncio.run(reloader.reload())
+
+    assert changes == {"qa": "changed", "summarize": "unchanged", "chat": "added"}
+    assert reloader.generation == 1
+    new_qa_query_engine = reloader.registry.get("qa")
+    assert new_qa_query_engine is not qa_query_engine
+    # The index of the unchanged ingestion settings is reused instead of ingesting again
+    qa_vector_store = qa_query_engine.vector_store_index.vector_store
+    assert new_qa_query_engine.vector_store_index.vector_store is qa_vector_store
+    assert reloader.registry.get_status()["chat"]["status"] == TASK_LOADED
+    # The old registry is closed once its last request finished
+    assert leased_registry.get_status()["qa"]["status"] == TASK_LOADED
+    release()
+    release()
+    assert leased_registry.get_status()["qa"]["status"] == TASK_NOT_LOADED
+
+
+def test_failed_reload_keeps_the_current_registry():
+    registry = TaskRegistry(TASK_NAME_TO_PARAMS, documents=[])
+    registry.get("qa")
+    reloader = TaskRegistryReloader(
+        registry, load_task_params=lambda: {"qa": {
+            "vector_store_type": "UnknownVectorStore"
+        }})
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(reloader.reload())
+
+    assert reloader.registry is registry
+    assert reloader.generation == 0
+    assert registry.get_status()["qa"]["status"] == TASK_LOADED
+
+
+def test_queries_after_a_reload_do_not_join_queries_of_the_old_engine(tmp_path):
+    config_file_path = tmp_path / "config.yaml"
+    task_params = {
+        "name": "qa",
+        "llm_model": "stub/llm?latency_ms=300",
+        "embed_model": "stub/embedding",
+        "vector_store_type": "SimpleVectorStore",
+        "enable_cost_calculator": False
+    }
+    config_file_path.write_text(yaml.safe_dump({"tasks": [task_params]}))
+    app = AutoFastAPI.from_config(
+        str(config_file_path), documents=[Document(text="autollm ships rag apps")], enable_reload=True)
+    payload = {"task": "qa", "user_query": "what does autollm ship?"}
+
+    async def main():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app),
+                                     base_url="http://test") as client:
+            old_query = asyncio.create_task(client.post("/query", json=payload))
+            await asyncio.sleep(0.1)
+            config_file_path.write_text(yaml.safe_dump({"tasks": [{**task_params, "similarity_top_k": 2}]}))
+            reload_response = await client.post("/admin/reload")
+            new_response = await client.post("/query", json=payload)
+            return reload_response, (await old_query), new_response, (await client.get("/metrics")).text
+
+    reload_response, old_response, new_response, metrics = asyncio.run(main())
+
+    assert reload_response.json()["tasks"] == {"qa": "changed"}
+    assert old_response.status_code == new_response.status_code == 200
+    assert "autollm_coalesced_requests_total" not in metrics
@@ -0,0 +1,83 @@
+import json
+
+from fastapi.testclient import TestClient
+from llama_index import Document
+
+from autollm.auto.fastapi_app import AutoFastAPI
+from autollm.callbacks.tracing import (
+    InMemorySpanExporter,
+    JSONLSpanExporter,
+    RequestTrace,
+    Tracer,
+    to_otlp_payload,
+    trace_request,
+)
+from autollm.serve.utils import add_tracing_handler
+
+DOCUMENTS = [Document(text="autollm ships rag apps"), Document(text="a recipe for pancakes")]
+
+
+def test_tracing_handler_records_nested_spans(make_query_engine):
+    query_engine = make_query_engine(DOCUMENTS, llm_model="stub/llm?output_tokens=4", similarity_top_k=1)
+    add_tracing_handler(query_engine)
+    trace = RequestTrace(name="query")
+
+    query_engine.query("not traced")
+    with trace_request(trace):
+        query_engine.query("what does autollm ship")
+
+    spans = {span.name: span for span in trace.get_spans()}
+    assert {"query", "retrieve", "embedding", "synthesize", "llm"} <= set(spans)
+    assert len(trace.get_spans()) == len({span.span_id for span in trace.get_spans()})
+    assert spans["query"].parent_span_id == trace.span_id
+    assert spans["embedding"].parent_span_id == spans["retrieve"].span_id
+    assert spans["retrieve"].attributes["num_nodes"] == 1
+    assert spans["llm"].attributes["completion_tokens"] > 0
+    # The stage durations exclude the nested stages
+    stage_durations = trace.get_stage_durations()
+    assert stage_durations[
+        "retrieve"] <= spans["retrieve"].duration_seconds - spans["embedding"].duration_seconds
+    assert "llm;dur=" in trace.format_server_timing()
+
+
+def test_span_exporters(tmp_path):
+    trace = RequestTrace(name="query", attributes={"task": "qa"})
+    trace.add_stage("admission", trace.start_time)
+    memory_exporter = InMemorySpanExporter(max_traces=2)
+    jsonl_exporter = JSONLSpanExporter(path=str(tmp_path / "traces.jsonl"))
+
+    tracer = Tracer(jsonl_exporter)
+    tracer.end_trace(trace)
+    tracer.end_trace(trace)
+    jsonl_exporter.shutdown()
+    for name in ("first", "second", "third"):
+        memory_exporter.export(RequestTrace(name=name))
+    otlp_spans = to_otlp_payload([trace])["resourceSpans"][0]["scopeSpans"][0]["spans"]
+
+    lines = (tmp_path / "traces.jsonl").read_text().splitlines()
+    assert len(lines) == 1
+    assert json.loads(lines[0])["spans"][0]["name"] == "admission"
+    assert [trace.name for trace in memory_exporter.get_traces()] == ["third", "second"]
+    assert otlp_spans[0]["spanId"] == otlp_spans[1]["parentSpanId"] == trace.span_id
+    assert "parentSpanId" not in otlp_spans[0]
+    assert {"key": "task", "value": {"stringValue": "qa"}} in otlp_spans[0]["attributes"]
+
+
+def test_query_responses_carry_their_trace(make_query_engine):
+    client = TestClient(
+        AutoFastAPI.from_query_engine(
+            make_query_engine(DOCUMENTS, llm_model="stub/llm?output_tokens=4", similarity_top_k=1),
+            tracing={"server_timing": True}))
+
+    response = client.post("/query", json={"user_query": "what does autollm ship"})
+    streamed_response = client.post("/query", json={"user_query": "pancakes", "streaming": True})
+    traces = client.get("/traces").json()
+
+    assert "llm;dur=" in response.headers["Server-Timing"]
+    assert "total;dur=" in response.headers["Server-Timing"]
+    assert "Server-Timing" not in streamed_response.headers
+    assert [trace["trace_id"]
+            for trace in traces] == [streamed_response.headers["X-Trace-Id"], response.headers["X-Trace-Id"]]
+    assert traces[1]["attributes"]["task"] == "default"
+    assert traces[1]["attributes"]["llm_calls"] == 1
+    assert "admission" in [span["name"] for span in traces[1]["spans"]]